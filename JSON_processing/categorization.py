@@ -0,0 +1,322 @@
+'''async, rate-limited LLM categorization of Slack messages with index-tagged output'''
+import os
+import re
+import json
+import time
+import random
+import sqlite3
+import asyncio
+import hashlib
+import logging
+from pathlib import Path
+from typing import List
+
+from langchain_core.messages import SystemMessage, HumanMessage
+
+CATEGORIZATION_MODEL = "mistralai/Mixtral-8x7B-Instruct-v0.1"
+CATEGORIZE_BATCH_SIZE = int(os.getenv("CATEGORIZE_BATCH_SIZE", "50"))
+CATEGORIZE_CONCURRENCY = int(os.getenv("CATEGORIZE_CONCURRENCY", "8"))        # requests in flight
+CATEGORIZE_RPS = float(os.getenv("CATEGORIZE_RPS", "4"))                      # request starts per second
+CATEGORIZE_MAX_RETRIES = int(os.getenv("CATEGORIZE_MAX_RETRIES", "5"))
+CATEGORIZE_BACKOFF_SECONDS = float(os.getenv("CATEGORIZE_BACKOFF_SECONDS", "1"))
+FALLBACK_CATEGORY = "Other"
+# where a message's category came from, stored with it as category_source ('human' is for manual labels)
+SOURCE_LLM, SOURCE_LOCAL, SOURCE_FALLBACK, SOURCE_HUMAN = "llm", "local", "fallback", "human"
+CATEGORY_CACHE_ENABLED = os.getenv("CATEGORY_CACHE_ENABLED", "true").lower() == "true"
+CATEGORY_CACHE_PATH = Path(os.getenv(
+    "CATEGORY_CACHE_PATH",
+    Path(__file__).resolve().parent / "cache" / "categories.sqlite"
+))
+
+# "[12] Survey FAQs", also tolerates "12. Survey FAQs" / "12) ..." from models that ignore the brackets
+TAGGED_LINE = re.compile(r"^\s*\[?(\d+)\]?[.):\-]?\s+(.+?)\s*$")
+
+
+def load_categories(categories_file):
+    with open(categories_file, 'r') as f:
+        categories = json.load(f)
+    # Get list of allowed categories.
+    return categories["categories"] if isinstance(categories, dict) else categories
+
+
+def build_llm(model=CATEGORIZATION_MODEL):
+    from langchain_together import ChatTogether
+    api_key = os.getenv("TOGETHER_API_KEY")
+    if not api_key:
+        raise ValueError("TOGETHER_API_KEY is missing. Please check your .env file.")
+    return ChatTogether(together_api_key=api_key, model=model)
+
+
+def normalize_text(text):
+    return " ".join((text or "").lower().split())
+
+def text_hash(text):
+    return hashlib.sha1(normalize_text(text).encode("utf-8")).hexdigest()
+
+def categories_version(categories):
+    """Content hash of the category list, so editing categories.json starts a fresh cache automatically."""
+    return hashlib.sha1(json.dumps(list(categories)).encode("utf-8")).hexdigest()[:16]
+
+
+class CategoryCache:
+    """Persistent (normalized text hash, category list version, model) -> category map in SQLite."""
+
+    def __init__(self, categories, model, path=CATEGORY_CACHE_PATH):
+        self.version = categories_version(categories)
+        self.model = model
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(path, timeout=30)
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS categories (
+                text_hash TEXT NOT NULL,
+                categories_version TEXT NOT NULL,
+                model TEXT NOT NULL,
+                category TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (text_hash, categories_version, model)
+            )
+        """)
+        self._db.commit()
+
+    def get_many(self, hashes):
+        found = {}
+        hashes = list(set(hashes))
+        for start in range(0, len(hashes), 500):
+            chunk = hashes[start:start + 500]
+            found.update(self._db.execute(
+                f"SELECT text_hash, category FROM categories WHERE categories_version = ? AND model = ? "
+                f"AND text_hash IN ({','.join('?' * len(chunk))})",
+                (self.version, self.model, *chunk)
+            ).fetchall())
+        return found
+
+    def put_many(self, categories_by_hash):
+        now = time.time()
+        self._db.executemany(
+            "INSERT OR REPLACE INTO categories (text_hash, categories_version, model, category, created_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [(h, self.version, self.model, category, now) for h, category in categories_by_hash.items()]
+        )
+        self._db.commit()
+
+
+class RateLimiter:
+    """Spaces request starts at least 1/rps seconds apart (rps <= 0 disables it)."""
+
+    def __init__(self, requests_per_second):
+        self.interval = 1.0 / requests_per_second if requests_per_second > 0 else 0.0
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        if not self.interval:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class CategorizationEngine:
+    """
+    Dispatches message batches to the LLM concurrently, capped by `max_concurrency` requests in
+    flight and `requests_per_second`. Failed requests are retried with exponential backoff and jitter.
+    Each message is sent with an index tag and matched by that index in the reply. A line the model
+    drops is retried in a smaller follow-up batch instead of shifting every later category.
+    """
+
+    def __init__(self, categories: List[str], llm=None, model=CATEGORIZATION_MODEL, batch_size=CATEGORIZE_BATCH_SIZE,
+                 max_concurrency=CATEGORIZE_CONCURRENCY, requests_per_second=CATEGORIZE_RPS,
+                 max_retries=CATEGORIZE_MAX_RETRIES, backoff_seconds=CATEGORIZE_BACKOFF_SECONDS,
+                 cache: CategoryCache = None, classifier=None):
+        self.categories = list(categories)
+        self.model = model
+        self.llm = llm or build_llm(model)
+        if cache is None and CATEGORY_CACHE_ENABLED:
+            cache = CategoryCache(self.categories, model)
+        self.cache = cache
+        # optional local classifier (category_classifier.CentroidClassifier), only its low-margin messages reach the LLM
+        self.classifier = classifier
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.max_concurrency = max_concurrency
+        self.requests_per_second = requests_per_second
+        self._by_name = {c.lower(): c for c in self.categories}
+        self._system_prompt = self._build_system_prompt()
+        # one concurrency/rate budget per event loop, shared by every call running on it
+        self._budget_loop = None
+        self._semaphore = None
+        self._limiter = None
+
+        self.requests = 0
+        self.retries = 0
+        self.unparsed = 0  # messages that still had no valid answer after the follow-ups
+        self.cache_hits = 0
+        self.local_decisions = 0
+        self.calls_saved = 0  # batch requests the cache (and in-run de-duplication) made unnecessary
+
+    def _build_system_prompt(self):
+        category_list = "\n".join(f"- {c}" for c in self.categories)
+        return f"""You are a support assistant categorizing Slack messages.
+Classify each message into one of the following categories:
+
+{category_list}
+
+Each message starts with an index in square brackets. Answer with exactly one line per message,
+starting with the same index, followed by the category name copied exactly from the list.
+If a message does not fit any category, use "{FALLBACK_CATEGORY}".
+
+Return format:
+[1] <Category>
+[2] <Category>
+...
+"""
+
+    def normalize(self, answer):
+        """Map the model's answer onto the category list, None if it isn't one of them."""
+        answer = answer.strip().strip('"*').strip()
+        exact = self._by_name.get(answer.lower())
+        if exact:
+            return exact
+        # "Other - probably about X", "Survey FAQs (gift card question)"
+        for name, category in sorted(self._by_name.items(), key=lambda item: -len(item[0])):
+            if answer.lower().startswith(name):
+                return category
+        return None
+
+    def parse(self, raw_output, count):
+        """{index (0-based): category} for every well-formed, in-range line of the reply."""
+        parsed = {}
+        for line in raw_output.splitlines():
+            match = TAGGED_LINE.match(line)
+            if not match:
+                continue
+            index = int(match.group(1)) - 1
+            category = self.normalize(match.group(2))
+            if 0 <= index < count and category and index not in parsed:
+                parsed[index] = category
+        return parsed
+
+    def _budget(self):
+        """The semaphore and rate limiter shared by every categorize call on the running event loop."""
+        loop = asyncio.get_running_loop()
+        if self._budget_loop is not loop:
+            self._budget_loop = loop
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._limiter = RateLimiter(self.requests_per_second)
+        return self._semaphore, self._limiter
+
+    async def _request(self, texts, semaphore, limiter):
+        tagged = "\n".join(f"[{i + 1}] {' '.join(text.split())}" for i, text in enumerate(texts))
+        prompt = [SystemMessage(content=self._system_prompt), HumanMessage(content=f"Classify these messages:\n\n{tagged}")]
+        for attempt in range(self.max_retries + 1):
+            async with semaphore:
+                await limiter.wait()
+                self.requests += 1
+                try:
+                    response = await self.llm.ainvoke(prompt)
+                    return response.content
+                except Exception as e:
+                    if attempt == self.max_retries:
+                        raise
+                    error = e
+            self.retries += 1
+            delay = self.backoff_seconds * (2 ** attempt) * (0.5 + random.random())
+            logging.warning(f"Categorization request failed ({type(error).__name__}: {error}), "
+                            f"retrying in {delay:.1f}s ({attempt + 1}/{self.max_retries})")
+            await asyncio.sleep(delay)
+
+    async def _categorize_batch(self, texts, semaphore, limiter):
+        results = [None] * len(texts)
+        pending = list(range(len(texts)))
+        # the first pass plus up to two follow-ups for the lines the model skipped or garbled
+        for _ in range(3):
+            if not pending:
+                break
+            raw = await self._request([texts[i] for i in pending], semaphore, limiter)
+            parsed = self.parse(raw, len(pending))
+            for position, category in parsed.items():
+                results[pending[position]] = category
+            pending = [i for position, i in enumerate(pending) if position not in parsed]
+
+        if pending:
+            self.unparsed += len(pending)
+            logging.warning(f"{len(pending)} messages got no valid category, recorded as {FALLBACK_CATEGORY}")
+        return results
+
+    async def categorize_many(self, texts_per_file, with_sources=False):
+        """
+        Categorize several message lists at once, sharing one concurrency/rate budget (also with any other call
+        running concurrently on the same event loop). Returns lists in order.
+        Cached answers are filled in first and identical texts are asked once, so only the remaining
+        unique texts are batched for the LLM.
+        With `with_sources`, each entry is a (category, source) pair: SOURCE_LLM for LLM answers (the cache only
+        holds those), SOURCE_LOCAL for the classifier's and SOURCE_FALLBACK when no valid answer came back.
+        """
+        semaphore, limiter = self._budget()
+        hashes_per_file = [[text_hash(t) for t in texts] for texts in texts_per_file]
+        known = self.cache.get_many([h for hashes in hashes_per_file for h in hashes]) if self.cache else {}
+
+        # one representative text per uncached hash, grouped by the file that first needs it
+        first_seen = {}
+        for file_index, (texts, hashes) in enumerate(zip(texts_per_file, hashes_per_file)):
+            for text, h in zip(texts, hashes):
+                if h not in known and h not in first_seen:
+                    first_seen[h] = (file_index, text)
+        local = {}
+        if self.classifier is not None and first_seen:
+            hashes = list(first_seen)
+            predictions = self.classifier.predict([first_seen[h][1] for h in hashes])
+            local = {h: category for h, (category, _) in zip(hashes, predictions) if category is not None}
+            self.local_decisions += len(local)
+        to_ask = [[] for _ in texts_per_file]
+        for h, (file_index, text) in first_seen.items():
+            if h not in local:
+                to_ask[file_index].append((h, text))
+
+        async def one(items):
+            batches = [items[i:i + self.batch_size] for i in range(0, len(items), self.batch_size)]
+            results = await asyncio.gather(
+                *(self._categorize_batch([text for _, text in batch], semaphore, limiter) for batch in batches)
+            )
+            return {h: category for batch, categories in zip(batches, results)
+                    for (h, _), category in zip(batch, categories)}
+
+        answered = {}
+        for result in await asyncio.gather(*(one(items) for items in to_ask)):
+            answered.update(result)
+        # unparsed answers are left out so the next run asks again
+        fresh = {h: category for h, category in answered.items() if category is not None}
+        if self.cache and fresh:
+            self.cache.put_many(fresh)
+
+        total = sum(len(texts) for texts in texts_per_file)
+        self.cache_hits += sum(1 for hashes in hashes_per_file for h in hashes if h in known)
+        needed_without_cache = sum(-(-len(texts) // self.batch_size) for texts in texts_per_file)
+        needed = sum(-(-len(items) // self.batch_size) for items in to_ask)
+        self.calls_saved += needed_without_cache - needed
+        if total:
+            print(f"Categorization: {total - len(first_seen)}/{total} messages answered from cache or duplicates, "
+                  f"{len(local)} by the local classifier, {needed_without_cache - needed} LLM calls saved")
+
+        categories = {**known, **local, **fresh}
+        if not with_sources:
+            return [[categories.get(h, FALLBACK_CATEGORY) for h in hashes] for hashes in hashes_per_file]
+        sources = {**dict.fromkeys(known, SOURCE_LLM), **dict.fromkeys(local, SOURCE_LOCAL),
+                   **dict.fromkeys(fresh, SOURCE_LLM)}
+        return [[(categories.get(h, FALLBACK_CATEGORY), sources.get(h, SOURCE_FALLBACK)) for h in hashes]
+                for hashes in hashes_per_file]
+
+    async def categorize(self, texts, with_sources=False):
+        return (await self.categorize_many([texts], with_sources))[0]
+
+    def categorize_sync(self, texts):
+        return asyncio.run(self.categorize(texts))
+
+    def stats(self):
+        return {"requests": self.requests, "retries": self.retries, "unparsed": self.unparsed,
+                "cache_hits": self.cache_hits, "local_decisions": self.local_decisions,
+                "llm_calls_saved": self.calls_saved}
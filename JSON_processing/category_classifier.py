@@ -0,0 +1,282 @@
+'''local nearest-centroid category classifier trained on the LLM- and human-labelled messages - decides confident messages without the LLM'''
+import os
+import sys
+import json
+import argparse
+import hashlib
+import threading
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+CATEGORY_CLASSIFIER_ENABLED = os.getenv("CATEGORY_CLASSIFIER_ENABLED", "true").lower() == "true"
+# a message is decided locally only if its best centroid beats the runner-up by this much (cosine)
+CATEGORY_CLASSIFIER_MARGIN = float(os.getenv("CATEGORY_CLASSIFIER_MARGIN", "0.08"))
+# ...and is at least this similar to it
+CATEGORY_CLASSIFIER_MIN_SIMILARITY = float(os.getenv("CATEGORY_CLASSIFIER_MIN_SIMILARITY", "0.3"))
+CATEGORY_CLASSIFIER_RETRAIN_AFTER_INGEST = os.getenv("CATEGORY_CLASSIFIER_RETRAIN_AFTER_INGEST", "true").lower() == "true"
+CATEGORY_CLASSIFIER_MODEL_PATH = Path(os.getenv(
+    "CATEGORY_CLASSIFIER_MODEL_PATH",
+    Path(__file__).resolve().parent / "models" / "category_centroids.npz"
+))
+CATEGORIES_FILE = Path(__file__).resolve().parent / "categories.json"
+EMBED_BATCH = 512
+# labels worth learning from (messages.category_source); the classifier's own predictions and fallbacks are not
+TRAINING_SOURCES = ("llm", "human")
+# incremental retrains re-read this much before the updated_at watermark, for rows a longer transaction committed late
+CATEGORY_CLASSIFIER_WATERMARK_OVERLAP_SECONDS = float(os.getenv("CATEGORY_CLASSIFIER_WATERMARK_OVERLAP_SECONDS", "300"))
+
+
+def text_digest(text):
+    return int.from_bytes(hashlib.md5(text.encode("utf-8")).digest()[:8], "little", signed=True)
+
+def unit(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class CentroidClassifier:
+    """
+    Keeps a running sum of unit-length message embeddings per category, and classifies by cosine
+    similarity to each category's mean. Sums and counts are stored, so new labelled rows can be
+    folded in incrementally. `updated_through` is the highest messages.updated_at training has read, and
+    `rows` maps each trained message id to its (category index, text digest), so a row read again is not
+    counted twice and a relabelled one moves between centroids.
+    """
+
+    def __init__(self, embed_fn, categories, sums=None, counts=None, updated_through=None, rows=None,
+                 margin=CATEGORY_CLASSIFIER_MARGIN, min_similarity=CATEGORY_CLASSIFIER_MIN_SIMILARITY):
+        self.embed_fn = embed_fn  # list of texts -> list of vectors
+        self.categories = list(categories)
+        self.sums = sums
+        self.counts = counts if counts is not None else np.zeros(len(self.categories), dtype=np.int64)
+        self.updated_through = updated_through
+        self.rows = rows if rows is not None else {}
+        self.margin = margin
+        self.min_similarity = min_similarity
+        self._index = {c.lower(): i for i, c in enumerate(self.categories)}
+        self.decided = 0
+        self.escalated = 0
+
+    @classmethod
+    def load(cls, embed_fn, categories, path=CATEGORY_CLASSIFIER_MODEL_PATH, **kwargs):
+        """Load trained centroids. A missing model, or one trained on a different category list, starts empty."""
+        if not Path(path).exists():
+            return cls(embed_fn, categories, **kwargs)
+        data = np.load(path, allow_pickle=False)
+        if list(data["categories"]) != list(categories):
+            print(f"Category list changed since {path} was trained, starting from scratch.")
+            return cls(embed_fn, categories, **kwargs)
+        if "updated_through" not in data:
+            # trained on an id watermark, before existing rows had a category_source
+            print(f"{path} predates the updated_at watermark, starting from scratch.")
+            return cls(embed_fn, categories, **kwargs)
+        updated_through = str(data["updated_through"])
+        rows = {int(i): (int(label), int(digest))
+                for i, label, digest in zip(data["row_ids"], data["row_labels"], data["row_digests"])}
+        return cls(embed_fn, categories, sums=data["sums"], counts=data["counts"], rows=rows,
+                   updated_through=datetime.fromisoformat(updated_through) if updated_through else None, **kwargs)
+
+    def save(self, path=CATEGORY_CLASSIFIER_MODEL_PATH):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        ids = np.fromiter(self.rows.keys(), dtype=np.int64, count=len(self.rows))
+        labels, digests = (np.array([row[i] for row in self.rows.values()], dtype=np.int64) for i in range(2))
+        np.savez(path, categories=np.array(self.categories), sums=self.sums, counts=self.counts,
+                 updated_through=np.array(self.updated_through.isoformat() if self.updated_through else ""),
+                 row_ids=ids, row_labels=labels, row_digests=digests)
+        print(f"Saved category classifier to {path} ({int(self.counts.sum())} labelled messages)")
+
+    @property
+    def trained(self):
+        return self.sums is not None and bool(self.counts.any())
+
+    def category_index(self, label):
+        return self._index.get((label or "").strip().lower())
+
+    def add(self, texts, labels):
+        """Fold labelled messages into the centroids. Labels outside the category list are ignored."""
+        pairs = [(t, self.category_index(l)) for t, l in zip(texts, labels)]
+        pairs = [(t, i, None) for t, i in pairs if i is not None and t and t.strip()]
+        self._accumulate(pairs)
+        return len(pairs)
+
+    def add_rows(self, rows):
+        """
+        Fold labelled message rows (id, text, category dicts) into the centroids. A row already trained with the
+        same text and label is skipped, a relabelled one is taken out of its old centroid. An edited text is
+        added alongside the old one, whose vector can't be taken out without it. Returns the rows folded in.
+        """
+        changes = []
+        for row in rows:
+            text, index = row.get("text"), self.category_index(row.get("category"))
+            if index is None or not (text and text.strip()):
+                continue
+            digest = text_digest(text)
+            previous = self.rows.get(row["id"])
+            if previous == (index, digest):
+                continue
+            # the same text under a new label embeds to the vector it was added with
+            changes.append((text, index, previous[0] if previous and previous[1] == digest else None))
+            self.rows[row["id"]] = (index, digest)
+        self._accumulate(changes)
+        return len(changes)
+
+    def _accumulate(self, changes):
+        """Add each (text, category index, index to take it out of or None) to the centroid sums and counts."""
+        for start in range(0, len(changes), EMBED_BATCH):
+            chunk = changes[start:start + EMBED_BATCH]
+            vectors = unit(self.embed_fn([t for t, _, _ in chunk]))
+            if self.sums is None:
+                self.sums = np.zeros((len(self.categories), vectors.shape[1]), dtype=np.float32)
+            indices = np.array([i for _, i, _ in chunk])
+            np.add.at(self.sums, indices, vectors)
+            np.add.at(self.counts, indices, 1)
+            moved = [row for row, (_, _, old) in enumerate(chunk) if old is not None]
+            if moved:
+                old_indices = np.array([chunk[row][2] for row in moved])
+                np.subtract.at(self.sums, old_indices, vectors[moved])
+                np.subtract.at(self.counts, old_indices, 1)
+
+    def scores(self, texts):
+        """(n messages, n categories) cosine similarities. Categories with no examples score -inf."""
+        centroids = unit(self.sums)
+        similarities = unit(self.embed_fn(list(texts))) @ centroids.T
+        similarities[:, self.counts == 0] = -np.inf
+        return similarities
+
+    def predict(self, texts):
+        """
+        One (category or None, margin) per text. None means the margin or similarity was too low
+        and the message should go to the LLM.
+        """
+        if not self.trained or not texts:
+            self.escalated += len(texts)
+            return [(None, 0.0)] * len(texts)
+        similarities = self.scores(texts)
+        top2 = np.sort(similarities, axis=1)[:, -2:] if similarities.shape[1] > 1 else None
+        best = similarities.argmax(axis=1)
+        results = []
+        for row, index in enumerate(best):
+            top = similarities[row, index]
+            runner_up = top2[row, 0] if top2 is not None else -np.inf
+            margin = float(top - runner_up) if np.isfinite(runner_up) else float("inf")
+            if top >= self.min_similarity and margin >= self.margin:
+                results.append((self.categories[index], margin))
+                self.decided += 1
+            else:
+                results.append((None, margin))
+                self.escalated += 1
+        return results
+
+    def stats(self):
+        total = self.decided + self.escalated
+        return {
+            "decided_locally": self.decided,
+            "escalated_to_llm": self.escalated,
+            "llm_share_avoided_pct": 100.0 * self.decided / total if total else 0.0,
+        }
+
+
+# ------- training / evaluation ----------
+
+def embedding_fn():
+    # same cached (and optionally multi-process) model the rest of the pipeline uses
+    from LangGraph.resources import get_embedding_model
+    return get_embedding_model().embed_documents
+
+def load_categories_list():
+    with open(CATEGORIES_FILE, 'r') as f:
+        categories = json.load(f)
+    return categories["categories"] if isinstance(categories, dict) else categories
+
+def labelled_rows(since=None, overlap_seconds=0):
+    from LangGraph.fetch_db_messages import fetch_labelled_messages
+    return [row for row in fetch_labelled_messages(since, TRAINING_SOURCES, overlap_seconds)
+            if row.get("text") and row.get("category")]
+
+def retrain(full=False, path=CATEGORY_CLASSIFIER_MODEL_PATH):
+    """
+    Fold rows added or edited since the last training run (by messages.updated_at) into the saved centroids,
+    everything with full=True. Re-categorized rows come back with a new updated_at, so relabels are picked up.
+    """
+    categories = load_categories_list()
+    classifier = (CentroidClassifier(embedding_fn(), categories) if full
+                  else CentroidClassifier.load(embedding_fn(), categories, path=path))
+    rows = labelled_rows(classifier.updated_through, CATEGORY_CLASSIFIER_WATERMARK_OVERLAP_SECONDS)
+    added = classifier.add_rows(rows)
+    if not added:
+        print(f"Category classifier is up to date (through {classifier.updated_through}).")
+        return classifier
+    classifier.updated_through = max(r["updated_at"] for r in rows)
+    print(f"Trained on {added} new or relabelled messages ({len(rows) - added} unchanged or outside the category list).")
+    classifier.save(path)
+    return classifier
+
+_retrain_lock = threading.Lock()
+
+def retrain_in_background():
+    """Incremental retrain after an ingest, off the request thread. Skipped if one is already running."""
+    if not (CATEGORY_CLASSIFIER_RETRAIN_AFTER_INGEST and CATEGORY_CLASSIFIER_MODEL_PATH.exists()):
+        return
+
+    def run():
+        if not _retrain_lock.acquire(blocking=False):
+            return
+        try:
+            retrain()
+        except Exception as e:
+            print(f"[Category Classifier Error]: retrain failed: {type(e).__name__} - {e}")
+        finally:
+            _retrain_lock.release()
+
+    threading.Thread(target=run, name="category-classifier-retrain", daemon=True).start()
+
+def evaluate(margin=CATEGORY_CLASSIFIER_MARGIN, min_similarity=CATEGORY_CLASSIFIER_MIN_SIMILARITY, holdout_every=10):
+    """
+    Train on all labelled rows except every `holdout_every`-th id, then compare against the
+    held-out LLM labels. Escalated messages count as correct, because in production they get the LLM's answer.
+    """
+    categories = load_categories_list()
+    rows = labelled_rows()
+    train_rows = [r for r in rows if r["id"] % holdout_every]
+    test_rows = [r for r in rows if not r["id"] % holdout_every]
+
+    classifier = CentroidClassifier(embedding_fn(), categories, margin=margin, min_similarity=min_similarity)
+    classifier.add([r["text"] for r in train_rows], [r["category"] for r in train_rows])
+    test_rows = [r for r in test_rows if classifier.category_index(r["category"]) is not None]
+    predictions = classifier.predict([r["text"] for r in test_rows])
+
+    decided = [(p, r["category"]) for (p, _), r in zip(predictions, test_rows) if p is not None]
+    correct = sum(p.lower() == label.strip().lower() for p, label in decided)
+    report = {
+        "train_messages": len(train_rows),
+        "held_out_messages": len(test_rows),
+        "coverage_pct": round(100.0 * len(decided) / len(test_rows), 1) if test_rows else 0.0,
+        "accuracy_on_local_decisions_pct": round(100.0 * correct / len(decided), 1) if decided else None,
+        "overall_agreement_pct": round(100.0 * (correct + len(test_rows) - len(decided)) / len(test_rows), 1)
+                                 if test_rows else None,
+        "margin": margin,
+        "min_similarity": min_similarity,
+    }
+    print(json.dumps(report, indent=2))
+    return report
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Train or evaluate the local category classifier.")
+    parser.add_argument("command", choices=["train", "evaluate"])
+    parser.add_argument("--full", action="store_true", help="retrain from scratch instead of incrementally")
+    parser.add_argument("--margin", type=float, default=CATEGORY_CLASSIFIER_MARGIN)
+    parser.add_argument("--min-similarity", type=float, default=CATEGORY_CLASSIFIER_MIN_SIMILARITY)
+    args = parser.parse_args(argv)
+
+    if args.command == "train":
+        retrain(full=args.full)
+    else:
+        evaluate(args.margin, args.min_similarity)
+
+if __name__ == "__main__":
+    sys.exit(main())
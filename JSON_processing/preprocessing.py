@@ -1,11 +1,16 @@
 import os
 import sys
 import json
+import time
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from tqdm import tqdm
 
 # Add the project root to the Python path
 project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(project_root)
+from JSON_processing.records import PIPELINE_FORMAT, RecordWriter, record_path, remove_other_formats
 
 def get_data_path():
     """Get the path to the Slack data folder."""
@@ -13,93 +18,207 @@ def get_data_path():
     # Update path to include rtc_data subfolder
     return os.path.join(project_root, "JSON_processing/data", "rtc_data")
 
-def preprocess_slack_data(source_dir, output_dir):
+# Folders to ignore
+IGNORE_FOLDERS = {'vector_store', 'processed', '.git', '__pycache__'}
+# per-day fragments and the manifest live here; no .json extension so downstream globs skip them
+STATE_DIR = ".preprocess"
+PREPROCESS_WORKERS = int(os.getenv("PREPROCESS_WORKERS", str(os.cpu_count() or 1)))
+# bump when clean_messages output or the fragment layout changes, so the next run rebuilds every fragment
+# (v2: thread_ts, v3: JSONL fragments)
+MANIFEST_NAME = "manifest-v3"
+
+
+def clean_messages(messages, channel, json_file):
+    """Clean one day file's messages (drops non-dicts and empty texts)."""
+    cleaned_messages = []
+    for msg in messages:
+        if not isinstance(msg, dict):
+            continue
+
+        # Extract text content
+        text = msg.get('text', '')
+
+        # Skip empty messages
+        if not text.strip():
+            continue
+
+        cleaned_msg = {
+            'channel': channel,
+            'user': msg.get('user', 'unknown'),
+            'ts': msg.get('ts'),
+            # set on thread parents and replies alike, lets indexing group a question with its answers
+            'thread_ts': msg.get('thread_ts'),
+            'text': text.strip(),
+            'date': json_file.split('.')[0]  # Get date from filename
+        }
+        cleaned_messages.append(cleaned_msg)
+    return cleaned_messages
+
+
+def file_fingerprint(file_path, previous=None):
+    """
+    (mtime, size, sha1) of a day file. The sha1 from `previous` is reused when mtime and size
+    match, so an unchanged export is never re-read.
+    """
+    stat = os.stat(file_path)
+    if previous and previous["mtime"] == stat.st_mtime and previous["size"] == stat.st_size:
+        return previous
+    digest = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return {"mtime": stat.st_mtime, "size": stat.st_size, "sha1": digest.hexdigest()}
+
+
+def load_manifest(output_dir):
+    path = os.path.join(output_dir, STATE_DIR, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_manifest(output_dir, manifest):
+    path = os.path.join(output_dir, STATE_DIR, MANIFEST_NAME)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+    os.replace(path + ".tmp", path)
+
+
+def process_channel(channel, source_dir, output_dir, previous, fmt=PIPELINE_FORMAT):
+    """
+    Bring one channel's output up to date. Only day files that are new or whose content
+    changed are parsed again. Each day's cleaned messages are kept as a JSONL fragment, and the
+    channel file is rebuilt in `fmt` by streaming the fragments together in date order.
+    Returns (channel, manifest entry, stats). Runs in a worker process in parallel mode.
+    """
+    channel_path = os.path.join(source_dir, channel)
+    fragment_dir = os.path.join(output_dir, STATE_DIR, channel)
+    os.makedirs(fragment_dir, exist_ok=True)
+
+    json_files = sorted(f for f in os.listdir(channel_path) if f.endswith('.json'))
+    entry, changed = {}, 0
+    for json_file in json_files:
+        file_path = os.path.join(channel_path, json_file)
+        fragment = os.path.join(fragment_dir, json_file[:-len('.json')] + ".part")
+        fingerprint = file_fingerprint(file_path, previous.get(json_file))
+        entry[json_file] = fingerprint
+        old = previous.get(json_file)
+        if old and old["sha1"] == fingerprint["sha1"] and os.path.exists(fragment):
+            continue
+
+        changed += 1
+        try:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                messages = json.load(f)
+            cleaned_messages = clean_messages(messages, channel, json_file)
+        except Exception as e:
+            print(f"Error processing {file_path}: {e}")
+            entry.pop(json_file)  # retried on the next run
+            cleaned_messages = []
+        # fragment = one JSON message per line
+        with open(fragment, 'w', encoding='utf-8') as f:
+            f.writelines(json.dumps(m, ensure_ascii=False) + "\n" for m in cleaned_messages)
+
+    removed = set(previous) - set(entry)
+    for json_file in removed:
+        fragment = os.path.join(fragment_dir, json_file[:-len('.json')] + ".part")
+        if os.path.exists(fragment):
+            os.remove(fragment)
+
+    channel_dir = os.path.join(output_dir, channel)
+    output_file = record_path(channel_dir, f"{channel}_processed", fmt)
+    stats = {"day_files": len(json_files), "changed": changed, "removed": len(removed), "messages": None}
+    if not changed and not removed and output_file.exists():
+        return channel, entry, stats
+
+    # Save channel data, streamed fragment by fragment
+    with RecordWriter(output_file, fmt) as writer:
+        for json_file in json_files:
+            fragment = os.path.join(fragment_dir, json_file[:-len('.json')] + ".part")
+            if not os.path.exists(fragment):
+                continue
+            with open(fragment, 'r', encoding='utf-8') as f:
+                for line in f:
+                    writer.write(json.loads(line))
+    written = writer.count
+    # output from before PIPELINE_FORMAT changed would be read twice downstream
+    remove_other_formats(output_file)
+
+    if written:
+        print(f"Processed {written} messages for channel: {channel}")
+    else:
+        output_file.unlink()
+    stats["messages"] = written
+    return channel, entry, stats
+
+
+def preprocess_slack_data(source_dir, output_dir, workers=PREPROCESS_WORKERS, full=False, fmt=PIPELINE_FORMAT):
     """
     Preprocess Slack data and save it in a structured format.
-    
+    Channels are processed in parallel across `workers` processes (1 = in this process).
+    A manifest of day file hashes means reruns only parse new or changed files. Pass full=True to ignore it.
+    Each channel is written as `<channel>_processed` in `fmt` ('jsonl', 'parquet' or 'json').
+
     Parameters:
         source_dir (str): Path to rtc_data directory containing channel folders
         output_dir (str): Path where processed data will be saved
+
+    Returns {channel: stats} with day file, changed file and message counts.
     """
     print("\nStarting preprocessing...")
-    
+    start = time.perf_counter()
+
     # Create output directory if it doesn't exist
     os.makedirs(output_dir, exist_ok=True)
     print(f"Created output directory: {output_dir}")
-    
-    # Dictionary to store all processed messages by channel
-    processed_data = {}
-    
-    # Folders to ignore
-    ignore_folders = {'vector_store', 'processed', '.git', '__pycache__'}
-    
+
+    manifest = {} if full else load_manifest(output_dir)
+    mode = "incremental" if manifest else "full"
+
     # Iterate through channel directories
-    channels = [d for d in os.listdir(source_dir) 
-               if os.path.isdir(os.path.join(source_dir, d)) 
-               and d not in ignore_folders]
-    
-    print(f"\nFound {len(channels)} channels to process")
-    
-    for channel in tqdm(channels, desc="Processing channels"):
-        channel_path = os.path.join(source_dir, channel)
-        print(f"\nProcessing channel: {channel}")
-        
-        # Initialize channel data
-        processed_data[channel] = []
-        
-        # Process all JSON files in the channel directory
-        json_files = [f for f in os.listdir(channel_path) if f.endswith('.json')]
-        print(f"Found {len(json_files)} JSON files in {channel}")
-        
-        for json_file in tqdm(json_files, desc=f"Processing {channel}", leave=False):
-            file_path = os.path.join(channel_path, json_file)
-            try:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    messages = json.load(f)
-                print(f"Successfully read {len(messages)} messages from {json_file}")
-                
-                # Clean and process messages
-                cleaned_messages = []
-                for msg in messages:
-                    if not isinstance(msg, dict):
-                        continue
-                        
-                    # Extract text content
-                    text = msg.get('text', '')
-                    
-                    # Skip empty messages
-                    if not text.strip():
-                        continue
-                        
-                    cleaned_msg = {
-                        'channel': channel,
-                        'user': msg.get('user', 'unknown'),
-                        'ts': msg.get('ts'),
-                        'text': text.strip(),
-                        'date': json_file.split('.')[0]  # Get date from filename
-                    }
-                    cleaned_messages.append(cleaned_msg)
-                    
-                processed_data[channel].extend(cleaned_messages)
-                    
-            except Exception as e:
-                print(f"Error processing {file_path}: {e}")
-                
-        # Save channel data
-        if processed_data[channel]:
-            channel_dir = os.path.join(output_dir, channel)
-            os.makedirs(channel_dir, exist_ok=True)
-            
-            output_file = os.path.join(channel_dir, f"{channel}_processed.json")
-            with open(output_file, 'w', encoding='utf-8') as f:
-                json.dump(processed_data[channel], f, indent=2, ensure_ascii=False)
-            
-            print(f"Processed {len(processed_data[channel])} messages for channel: {channel}")
-    
-    return processed_data
+    channels = [d for d in os.listdir(source_dir)
+               if os.path.isdir(os.path.join(source_dir, d))
+               and d not in IGNORE_FOLDERS]
+
+    print(f"\nFound {len(channels)} channels to process ({mode} run, {workers} worker(s))")
+
+    results = {}
+    jobs = [(channel, source_dir, output_dir, manifest.get(channel, {}), fmt) for channel in channels]
+    if workers > 1 and len(channels) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(channels))) as executor:
+            futures = [executor.submit(process_channel, *job) for job in jobs]
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Processing channels"):
+                channel, entry, stats = future.result()
+                manifest[channel] = entry
+                results[channel] = stats
+    else:
+        for job in tqdm(jobs, desc="Processing channels"):
+            channel, entry, stats = process_channel(*job)
+            manifest[channel] = entry
+            results[channel] = stats
+
+    for channel in set(manifest) - set(channels):
+        manifest.pop(channel)
+    save_manifest(output_dir, manifest)
+
+    elapsed = time.perf_counter() - start
+    changed = sum(stats["changed"] for stats in results.values())
+    total = sum(stats["day_files"] for stats in results.values())
+    print(f"Preprocessed {changed}/{total} day files in {elapsed:.2f}s "
+          f"({mode} run, {workers} worker(s))")
+    return results
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Clean the raw Slack export into one file per channel.")
+    parser.add_argument("--workers", type=int, default=PREPROCESS_WORKERS, help="channels processed in parallel")
+    parser.add_argument("--full", action="store_true", help="ignore the manifest and reprocess every day file")
+    parser.add_argument("--format", choices=["jsonl", "parquet", "json"], default=PIPELINE_FORMAT,
+                        help="output format (parquet needs pyarrow)")
+    args = parser.parse_args()
+
     print("Starting data preprocessing...")
     
     # Get source and output paths
@@ -115,12 +234,16 @@ def main():
         exit(1)
         
     # Process the data
-    processed_data = preprocess_slack_data(source_dir, output_dir)
+    results = preprocess_slack_data(source_dir, output_dir, workers=args.workers, full=args.full, fmt=args.format)
     
     # Print summary of processed data
     print("\nProcessing complete!")
-    for channel, messages in processed_data.items():
-        print(f"Channel {channel}: {len(messages)} messages processed")
+    for channel, stats in results.items():
+        if stats["messages"] is None:
+            print(f"Channel {channel}: unchanged")
+        else:
+            print(f"Channel {channel}: {stats['messages']} messages processed "
+                  f"({stats['changed']} new/changed, {stats['removed']} removed day files)")
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
@@ -0,0 +1,327 @@
+'''streaming record files for the JSON_processing pipeline - JSONL by default, optional Parquet, old JSON arrays still readable'''
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+from pathlib import Path
+from itertools import islice
+
+try:
+    import pyarrow
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet is optional, JSONL needs nothing extra
+    pyarrow = None
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from JSON_processing.utils import iter_json_array
+
+# what the pipeline stages write: 'jsonl', 'parquet' (needs pyarrow) or 'json' (arrays, the old format)
+PIPELINE_FORMAT = os.getenv("PIPELINE_FORMAT", "jsonl")
+# records per batch handed to readers, and per Parquet row group
+RECORD_BATCH_SIZE = int(os.getenv("RECORD_BATCH_SIZE", "5000"))
+PARQUET_COMPRESSION = os.getenv("PARQUET_COMPRESSION", "zstd")
+EXTENSIONS = {"jsonl": ".jsonl", "parquet": ".parquet", "json": ".json"}
+PARQUET_MAGIC = b"PAR1"
+
+
+def require_pyarrow():
+    if pyarrow is None:
+        raise RuntimeError("Parquet files need pyarrow: `pip install pyarrow`, or use PIPELINE_FORMAT=jsonl.")
+
+def format_of(path):
+    """Pipeline format of a path from its extension, None for anything else."""
+    suffix = Path(path).suffix.lower()
+    return next((fmt for fmt, extension in EXTENSIONS.items() if extension == suffix), None)
+
+def record_path(directory, stem, fmt=PIPELINE_FORMAT):
+    return Path(directory) / f"{stem}{EXTENSIONS[fmt]}"
+
+def record_files(directory):
+    """
+    Record files anywhere under `directory`, in any format, skipping hidden folders (e.g. .preprocess).
+    If one stem exists in several formats (left over from before PIPELINE_FORMAT changed), only the newest counts.
+    """
+    directory = Path(directory)
+    newest = {}
+    for path in directory.rglob("*"):
+        if not path.is_file() or format_of(path) is None:
+            continue
+        if any(part.startswith(".") for part in path.relative_to(directory).parts):
+            continue
+        stem = path.with_suffix("")
+        if stem not in newest or path.stat().st_mtime > newest[stem].stat().st_mtime:
+            newest[stem] = path
+    return sorted(newest.values())
+
+def sniff_format(file):
+    """Format of an open file from its first bytes (uploads carry no trustworthy extension). Leaves the position alone."""
+    start = file.tell()
+    head = file.read(4096)
+    file.seek(start)
+    if isinstance(head, str):
+        head = head.encode("utf-8")
+    if head.startswith(PARQUET_MAGIC):
+        return "parquet"
+    head = head.lstrip(b"\xef\xbb\xbf \t\r\n")
+    return "json" if head.startswith(b"[") else "jsonl"
+
+
+# ------- readers ----------
+
+def iter_jsonl_batches(file, batch_size=RECORD_BATCH_SIZE):
+    """
+    Yield lists of records from a JSONL file opened in text or binary mode. Each batch of lines is parsed
+    with one json.loads call, which keeps the per-record cost at the C parser's instead of a Python loop's.
+    """
+    first = True
+    while lines := list(islice(file, batch_size)):
+        if isinstance(lines[0], str):
+            lines = [line.encode("utf-8") for line in lines]
+        if first:
+            lines[0] = lines[0].removeprefix(b"\xef\xbb\xbf")
+            first = False
+        lines = [line for line in lines if line.strip()]
+        if lines:
+            yield json.loads(b"[" + b",".join(lines) + b"]")
+
+def iter_jsonl(file):
+    """Yield one record per non-blank line of a JSONL file."""
+    for batch in iter_jsonl_batches(file):
+        yield from batch
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+def _file_batches(file, fmt, batch_size):
+    if fmt == "parquet":
+        require_pyarrow()
+        for batch in pq.ParquetFile(file).iter_batches(batch_size=batch_size):
+            yield batch.to_pylist()
+        return
+    if fmt == "jsonl":
+        yield from iter_jsonl_batches(file, batch_size)
+        return
+    yield from batched(iter_json_array(file), batch_size)
+
+def iter_record_batches(source, batch_size=RECORD_BATCH_SIZE):
+    """
+    Yield lists of up to `batch_size` record dicts from a path or an open binary file, in any pipeline format.
+    Paths are read by extension, open files are sniffed from where they are positioned.
+    Only one batch is held at a time, whatever the file size.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, "rb") as file:
+            yield from _file_batches(file, format_of(source) or sniff_format(file), batch_size)
+    else:
+        yield from _file_batches(source, sniff_format(source), batch_size)
+
+def iter_records(source, batch_size=RECORD_BATCH_SIZE):
+    for batch in iter_record_batches(source, batch_size):
+        yield from batch
+
+def read_records(source):
+    return list(iter_records(source))
+
+
+# ------- writers ----------
+
+class RecordWriter:
+    """
+    Streams records to `path` in `fmt` (taken from the extension when not given). Output goes to a
+    temp file that replaces `path` only when the `with` block exits cleanly, so readers never see half a file.
+    JSON and JSONL are written as records arrive. Parquet buffers `batch_size` records per row group.
+    Its columns come from the first batch's fields, stored as nullable strings like every pipeline field.
+    """
+
+    def __init__(self, path, fmt=None, batch_size=RECORD_BATCH_SIZE):
+        self.path = Path(path)
+        self.fmt = fmt or format_of(path) or PIPELINE_FORMAT
+        if self.fmt == "parquet":
+            require_pyarrow()
+        self.batch_size = batch_size
+        self.count = 0
+        self._tmp = self.path.with_name(self.path.name + ".tmp")
+        self._file = None
+        self._parquet = None
+        self._columns = None
+        self._pending = []
+
+    def __enter__(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        if self.fmt != "parquet":
+            self._file = open(self._tmp, "w", encoding="utf-8")
+            if self.fmt == "json":
+                self._file.write("[")
+        return self
+
+    def write(self, record):
+        if self.fmt == "parquet":
+            self._pending.append(record)
+            if len(self._pending) >= self.batch_size:
+                self._flush()
+        else:
+            line = json.dumps(record, ensure_ascii=False)
+            if self.fmt == "json":
+                line = ("\n" if not self.count else ",\n") + line
+            else:
+                line += "\n"
+            self._file.write(line)
+        self.count += 1
+
+    def write_batch(self, records):
+        for record in records:
+            self.write(record)
+
+    def _flush(self):
+        if not self._pending:
+            return
+        if self._columns is None:
+            self._columns = list(dict.fromkeys(key for record in self._pending for key in record))
+            schema = pyarrow.schema([(column, pyarrow.string()) for column in self._columns])
+            self._parquet = pq.ParquetWriter(self._tmp, schema, compression=PARQUET_COMPRESSION)
+        extra = {key for record in self._pending for key in record} - set(self._columns)
+        if extra:
+            raise ValueError(f"Records gained fields after the first batch: {sorted(extra)}")
+        columns = {
+            column: [None if record.get(column) is None else str(record[column]) for record in self._pending]
+            for column in self._columns
+        }
+        self._parquet.write_table(pyarrow.table(columns, schema=self._parquet.schema))
+        self._pending = []
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if self.fmt == "parquet":
+                if exc_type is None:
+                    self._flush()
+                    if self._parquet is None:
+                        pq.write_table(pyarrow.table({}), self._tmp)  # no records, still a valid file
+                if self._parquet is not None:
+                    self._parquet.close()
+            else:
+                if self.fmt == "json" and exc_type is None:
+                    self._file.write("\n]\n")
+                self._file.close()
+        finally:
+            if exc_type is None:
+                os.replace(self._tmp, self.path)
+            elif self._tmp.exists():
+                self._tmp.unlink()
+
+def write_records(path, records, fmt=None):
+    """Write an iterable of records to `path`, returns how many were written."""
+    with RecordWriter(path, fmt) as writer:
+        writer.write_batch(records)
+    return writer.count
+
+def remove_other_formats(path):
+    """Delete copies of `path` in the other formats, so downstream stages don't pick up stale output."""
+    path = Path(path)
+    for extension in EXTENSIONS.values():
+        other = path.with_suffix(extension)
+        if other != path and other.exists():
+            other.unlink()
+
+
+# ------- benchmark ----------
+
+WORDS = ("the robotics portal password reset mentor session survey gift card deadline cohort "
+         "meeting zoom link workshop resume interview question thanks help please where when").split()
+
+def synthetic_records(count, seed=7):
+    """Categorized messages shaped like the pipeline's, with Slack-like text lengths."""
+    rng = random.Random(seed)
+    records = []
+    for i in range(count):
+        ts = f"{1700000000 + i * 37}.{rng.randrange(10 ** 6):06d}"
+        records.append({
+            "text": " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 60))),
+            "user": f"U{rng.randrange(500):05d}",
+            "ts": ts,
+            "team": "T00000001",
+            "channel": rng.choice(["general", "help", "mentors", "events"]),
+            "thread_ts": ts if rng.random() < 0.3 else "",
+            "category": rng.choice(["Survey FAQs", "Account", "Events", "Other"]),
+        })
+    return records
+
+def benchmark(rows, source=None):
+    """
+    Write the same records in each format and report size on disk, write time and full read time.
+    'json (indent=2)' is the old pipeline output read with json.load, the others go through iter_records.
+    """
+    if source:
+        records = []
+        for path in (record_files(source) if Path(source).is_dir() else [Path(source)]):
+            records.extend(iter_records(path))
+        records = (records * (rows // max(1, len(records)) + 1))[:rows]
+    else:
+        records = synthetic_records(rows)
+
+    formats = ["json (indent=2)", "jsonl"] + (["parquet"] if pyarrow is not None else [])
+    directory = Path(tempfile.mkdtemp(prefix="records-benchmark-"))
+    results = {}
+    try:
+        for name in formats:
+            if name == "json (indent=2)":
+                path = directory / "messages.json"
+                start = time.perf_counter()
+                with open(path, "w") as f:
+                    json.dump(records, f, indent=2)
+                written = time.perf_counter() - start
+                start = time.perf_counter()
+                with open(path, "r") as f:
+                    count = len(json.load(f))
+            else:
+                path = record_path(directory, "messages", name)
+                start = time.perf_counter()
+                write_records(path, records)
+                written = time.perf_counter() - start
+                start = time.perf_counter()
+                count = sum(len(batch) for batch in iter_record_batches(path))
+            loaded = time.perf_counter() - start
+            assert count == len(records)
+            results[name] = {
+                "size_mb": round(path.stat().st_size / (1024 * 1024), 2),
+                "write_seconds": round(written, 3),
+                "load_seconds": round(loaded, 3),
+            }
+            print(f"  {name:<16} {results[name]['size_mb']:>8} MB  write {results[name]['write_seconds']:>7}s  "
+                  f"load {results[name]['load_seconds']:>7}s")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    if pyarrow is None:
+        print("  parquet          skipped, pyarrow is not installed")
+    print(json.dumps({"records": len(records), "formats": results}, indent=2))
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare pipeline file formats, or convert files between them.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    bench = subparsers.add_parser("benchmark", help="size and load time of each format")
+    bench.add_argument("--rows", type=int, default=100000)
+    bench.add_argument("--source", help="record file or directory to take the records from (synthetic otherwise)")
+    convert = subparsers.add_parser("convert", help="rewrite every record file in a directory in another format")
+    convert.add_argument("directory")
+    convert.add_argument("--to", choices=list(EXTENSIONS), default=PIPELINE_FORMAT)
+    args = parser.parse_args(argv)
+
+    if args.command == "benchmark":
+        benchmark(args.rows, args.source)
+        return
+    for path in record_files(args.directory):
+        if format_of(path) == args.to:
+            continue
+        target = path.with_suffix(EXTENSIONS[args.to])
+        count = write_records(target, iter_records(path))
+        path.unlink()
+        print(f"{path} -> {target} ({count} records)")
+
+if __name__ == "__main__":
+    sys.exit(main())
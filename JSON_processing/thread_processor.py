@@ -1,120 +1,105 @@
-import json
 import os
+import sys
+import time
+import asyncio
 from pathlib import Path
 from typing import List
 
 from dotenv import load_dotenv
-from langchain_together import ChatTogether
-from langchain.prompts import ChatPromptTemplate
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from JSON_processing.categorization import CategorizationEngine, load_categories
+from JSON_processing.category_classifier import CATEGORY_CLASSIFIER_ENABLED, CentroidClassifier, embedding_fn
+from JSON_processing.records import (PIPELINE_FORMAT, RecordWriter, iter_record_batches, read_records, record_files,
+                                     record_path, remove_other_formats)
+
+# files categorized at once; their requests still share the engine's concurrency/rate budget
+CATEGORIZE_FILE_CONCURRENCY = int(os.getenv("CATEGORIZE_FILE_CONCURRENCY", "4"))
 
 load_dotenv()
 api_key = os.getenv("TOGETHER_API_KEY")
 if not api_key:
     raise ValueError("TOGETHER_API_KEY is missing. Please check your .env file.")
 
-def clean_message(message: dict, category: str) -> dict:
-    """Extract essential message data and assign a category."""
+def clean_message(message: dict, category: str, source: str = "") -> dict:
+    """Extract essential message data and assign a category (and where it came from, see categorization.SOURCE_*)."""
     return {
         "text": message.get("text", ""),
         "user": message.get("user", ""),
         "ts": message.get("ts", ""),
         "team": message.get("team", ""),
-        "category": category
+        "channel": message.get("channel", ""),
+        "thread_ts": message.get("thread_ts") or "",
+        "category": category,
+        "category_source": source
     }
 
-def batch_categorize_messages(processed_json_file_path: str, categories_file: str, batch_size: int = 50) -> List[str]:
+def batch_categorize_messages(processed_json_file_path: str, categories_file: str, batch_size: int = 50,
+                              engine: CategorizationEngine = None) -> List[str]:
     """
     Process messages in batches and return a flat list of categories.
     The categories are generated in the same order as the messages.
+    Pass an `engine` to reuse its LLM client and category list across files.
     """
-    with open(processed_json_file_path, 'r') as f:
-        messages = json.load(f)
-
-    with open(categories_file, 'r') as f:
-        categories = json.load(f)
-
-    # Get list of allowed categories.
-    category_values = categories["categories"] if isinstance(categories, dict) else categories
-    category_list = "\n".join(f"- {c}" for c in category_values)
-
-    llm = ChatTogether(
-        together_api_key=api_key,
-        model="mistralai/Mixtral-8x7B-Instruct-v0.1"
-    )
-
-    all_categories = []
-    total_messages = len(messages)
-
-    for i in range(0, total_messages, batch_size):
-        batch = messages[i:min(i + batch_size, total_messages)]
-        texts = [msg.get("text", "") for msg in batch]
-
-        numbered_messages = "\n".join([f"{idx + 1}. {text}" for idx, text in enumerate(texts)])
-        prompt = ChatPromptTemplate.from_messages([
-            ("system", f"""You are a support assistant categorizing Slack messages.
-Classify each message into one of the following categories:
-
-{category_list}
-
-Return only the category name for each message, in order. If a message does not fit any category, respond with "other" and what the message could be potentially related to.
-"""),
-            ("human", f"""Classify these messages:
-
-{numbered_messages}
-
-Return format:
-1. <Category>
-2. <Category>
-...
-""")
-        ])
-
-        chain = prompt | llm
-        response = chain.invoke({})
-        raw_output = response.content.strip().split("\n")
-        batch_categories = [line.split(". ", 1)[-1].strip() for line in raw_output if line]
-        
-        # Append the categories for this batch
-        all_categories.extend(batch_categories)
-
-    return all_categories
-
-def process_channel_data(input_dir: Path, output_dir: Path, categories_file: str, batch_size: int = 50):
+    messages = read_records(processed_json_file_path)
+
+    engine = engine or CategorizationEngine(load_categories(categories_file), batch_size=batch_size)
+    return engine.categorize_sync([msg.get("text", "") for msg in messages])
+
+async def categorize_file(input_file: Path, output_file: Path, engine: CategorizationEngine, fmt: str) -> int:
+    """Categorize one record file batch by batch, each batch written before the next is read. Returns the count."""
+    with RecordWriter(output_file, fmt) as writer:
+        for messages in iter_record_batches(input_file):
+            # one (category, source) per message, matched by index, so the zip below can't drift
+            categories = await engine.categorize([msg.get("text", "") for msg in messages], with_sources=True)
+            writer.write_batch(clean_message(msg, category, source) for msg, (category, source) in zip(messages, categories))
+    return writer.count
+
+async def categorize_files(input_files: List[Path], output_dir: Path, engine: CategorizationEngine,
+                           fmt: str = PIPELINE_FORMAT, file_concurrency: int = CATEGORIZE_FILE_CONCURRENCY):
+    """
+    Categorize the files one record batch at a time, so only a batch per file is held whatever the corpus size.
+    Up to `file_concurrency` files are worked on at once, and every batch's LLM requests go out under the
+    engine's shared concurrency/rate budget, so one file waiting on the LLM doesn't leave the budget idle.
+    Texts seen in earlier batches or files are answered from the category cache.
+    Input files can be in any pipeline format, output is written in `fmt`.
+    """
+    window = asyncio.Semaphore(max(1, file_concurrency))
+
+    async def one(input_file):
+        async with window:
+            print(f"Processing {input_file}")
+            output_file = record_path(output_dir, input_file.stem, fmt)
+            try:
+                count = await categorize_file(input_file, output_file, engine, fmt)
+            except Exception as e:
+                print(f"Error processing {input_file}: {e}")
+                return
+            remove_other_formats(output_file)
+            print(f"Saved {count} categorized messages to {output_file}")
+
+    await asyncio.gather(*(one(input_file) for input_file in input_files))
+
+def process_channel_data(input_dir: Path, output_dir: Path, categories_file: str, batch_size: int = 50,
+                         fmt: str = PIPELINE_FORMAT):
     """
-    For each JSON file in input_dir, process the messages in batches,
+    For each record file (JSONL, Parquet or JSON) in input_dir, process the messages in batches,
     add a category attribute, and write out the updated messages.
+    Categories and the LLM client are loaded once. Several files are categorized at once, and each record
+    batch's LLM requests go out concurrently.
+    With a trained local classifier, only its low-margin messages are sent to the LLM.
     """
-    for input_file in input_dir.glob("**/*.json"):
-        print(f"Processing {input_file}")
-        try:
-            with open(input_file, 'r') as f:
-                messages = json.load(f)
-            if not isinstance(messages, list):
-                print(f"Skipping {input_file}: Data is not a list")
-                continue
-
-            # Build a list of categories (in order) for all messages in the file.
-            generated_categories = batch_categorize_messages(str(input_file), categories_file, batch_size)
-
-            # In case the number of generated categories doesn't match, default missing ones to "other"
-            if len(generated_categories) < len(messages):
-                generated_categories.extend(["other"] * (len(messages) - len(generated_categories)))
-            elif len(generated_categories) > len(messages):
-                generated_categories = generated_categories[:len(messages)]
-
-            # Build updated messages by zipping messages and generated categories.
-            updated_messages = [
-                clean_message(msg, category)
-                for msg, category in zip(messages, generated_categories)
-            ]
-
-            # Save updated messages to output file.
-            output_file = output_dir / input_file.name
-            with open(output_file, 'w') as f:
-                json.dump(updated_messages, f, indent=2)
-            print(f"Saved categorized messages to {output_file}")
-        except Exception as e:
-            print(f"Error processing {input_file}: {e}")
+    start = time.perf_counter()
+    categories = load_categories(categories_file)
+    classifier = None
+    if CATEGORY_CLASSIFIER_ENABLED:
+        classifier = CentroidClassifier.load(embedding_fn(), categories)
+        if not classifier.trained:
+            print("No trained category classifier, every uncached message goes to the LLM.")
+            classifier = None
+    engine = CategorizationEngine(categories, batch_size=batch_size, classifier=classifier)
+    asyncio.run(categorize_files(record_files(input_dir), output_dir, engine, fmt))
+    print(f"Categorization finished in {time.perf_counter() - start:.1f}s: {engine.stats()}")
 
 def main():
    # Get the directory containing the current file
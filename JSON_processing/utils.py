@@ -0,0 +1,68 @@
+import json
+import codecs
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = " \t\n\r"
+
+
+def iter_json_array(file, chunk_size=1 << 16):
+    """
+    Yield the elements of a top-level JSON array one at a time without loading the whole file.
+    `file` may be opened in text or binary mode (binary is decoded as UTF-8, BOM tolerated).
+    """
+    decode = codecs.getincrementaldecoder("utf-8-sig")().decode
+
+    def read():
+        while True:
+            chunk = file.read(chunk_size)
+            if not isinstance(chunk, bytes):
+                return chunk
+            text = decode(chunk, final=not chunk)
+            # a chunk can end mid multi-byte character and decode to nothing yet
+            if text or not chunk:
+                return text
+
+    buffer, pos, eof = "", 0, False
+
+    def fill():
+        nonlocal buffer, pos, eof
+        chunk = read()
+        if not chunk:
+            eof = True
+        buffer = buffer[pos:] + chunk
+        pos = 0
+
+    def skip(chars):
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos] in chars:
+                pos += 1
+            if pos < len(buffer) or eof:
+                return
+            fill()
+
+    skip(_WHITESPACE)
+    if pos >= len(buffer) or buffer[pos] != "[":
+        raise ValueError("Expected a JSON array at the top level")
+    pos += 1
+
+    while True:
+        skip(_WHITESPACE + ",")
+        if pos >= len(buffer):
+            raise ValueError("Unexpected end of JSON array")
+        if buffer[pos] == "]":
+            return
+        try:
+            item, end = _decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            fill()
+            continue
+        # a scalar at the very end of the buffer (e.g. 12 of 123) may be cut short, read more first
+        if end == len(buffer) and not eof:
+            fill()
+            continue
+        pos = end
+        yield item
+
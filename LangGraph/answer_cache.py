@@ -0,0 +1,121 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# Tunables (can be overridden in .env)
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.92"))
+ANSWER_CACHE_TTL_SECONDS = float(os.getenv("ANSWER_CACHE_TTL_SECONDS", "3600"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "512"))
+# the bot and the upload interface run as separate processes, so invalidation is also signalled through this file
+ANSWER_CACHE_STAMP_FILE = os.getenv(
+    "ANSWER_CACHE_STAMP_FILE",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".answer_cache_stamp")
+)
+
+
+class SemanticAnswerCache:
+    """
+    Caches answered questions by embedding so near-repeats skip the LLM + Chroma round trips.
+    Entries expire after `ttl_seconds` and the least recently used one is evicted once `max_entries` is hit.
+    """
+
+    def __init__(self, embed_fn, threshold=ANSWER_CACHE_THRESHOLD,
+                 ttl_seconds=ANSWER_CACHE_TTL_SECONDS, max_entries=ANSWER_CACHE_MAX_ENTRIES,
+                 stamp_file=ANSWER_CACHE_STAMP_FILE):
+        self.embed_fn = embed_fn
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.stamp_file = stamp_file
+        self._seen_stamp = self._read_stamp()
+        self._entries = OrderedDict()  # {question: (unit vector, result, stored_at)}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _embed(self, question):
+        vector = np.asarray(self.embed_fn(question), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _read_stamp(self):
+        try:
+            return os.stat(self.stamp_file).st_mtime_ns
+        except OSError:
+            return None
+
+    def _evict_stale(self, now):
+        # another process (e.g. the upload interface) changed the knowledge base since we last looked
+        stamp = self._read_stamp()
+        if stamp != self._seen_stamp:
+            self._seen_stamp = stamp
+            if self._entries:
+                self._entries.clear()
+                self.invalidations += 1
+
+        expired = [q for q, (_, _, stored_at) in self._entries.items() if now - stored_at > self.ttl_seconds]
+        for q in expired:
+            del self._entries[q]
+
+    def lookup(self, question, vector=None):
+        """Return the cached result for the closest stored question, or None if nothing is similar enough."""
+        if vector is None:
+            vector = self._embed(question)
+
+        with self._lock:
+            self._evict_stale(time.monotonic())
+            best_question, best_score = None, -1.0
+            for cached_question, (cached_vector, _, _) in self._entries.items():
+                score = float(np.dot(vector, cached_vector))
+                if score > best_score:
+                    best_question, best_score = cached_question, score
+
+            if best_question is None or best_score < self.threshold:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._entries.move_to_end(best_question)
+            result = dict(self._entries[best_question][1])
+
+        print(f"Answer cache hit ({best_score:.3f}) for: {question!r} ~ {best_question!r}")
+        return result
+
+    def store(self, question, result, vector=None):
+        """Remember an answered question along with its response + category."""
+        if vector is None:
+            vector = self._embed(question)
+
+        with self._lock:
+            self._entries[question] = (vector, dict(result), time.monotonic())
+            self._entries.move_to_end(question)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self):
+        """Drop every cached answer (called whenever the knowledge base changes)."""
+        with self._lock:
+            self._entries.clear()
+            self.invalidations += 1
+            try:
+                with open(self.stamp_file, "w") as f:
+                    f.write(str(time.time()))
+            except OSError as e:
+                print(f"[Answer Cache] Could not write invalidation stamp: {e}")
+            self._seen_stamp = self._read_stamp()
+        print("Answer cache invalidated.")
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "invalidations": self.invalidations,
+        }
@@ -1,37 +1,101 @@
 import os
-from dotenv import load_dotenv
 from pydantic import BaseModel
-from langchain_together import ChatTogether
-import chromadb
-from langchain_huggingface import HuggingFaceEmbeddings
 import database
-from .fetch_db_messages import fetch_all_messages
+from .fetch_db_messages import fetch_all_messages, fetch_message_timestamps, fetch_message_rows, fetch_thread_messages
 from collections import Counter
-from database.schema_manager import SchemaManager
+from database.schema_manager import SchemaManager, message_key
+from database.connection_pool import get_pool
+from .answer_cache import SemanticAnswerCache
+from .query_embeddings import QueryEmbeddingCache
+from .context_packing import pack_context
+from .lexical_index import BM25Index, reciprocal_rank_fusion, document_text, thread_of, thread_documents
+from .intent_gate import IntentGate, INTENT_GATE_ENABLED
+from .resources import get_llm, get_embedding_model, get_collection
+from . import resources
+from . import metrics
+from JSON_processing.records import iter_records
+import sys
 import json
-import uuid
-
-# Load env
-load_dotenv(dotenv_path='./.env')
-CHROMA_HOST = os.getenv("CHROMA_HOST")
-CHROMA_PORT = int(os.getenv("CHROMA_PORT", "8000"))
-api_key = os.getenv("TOGETHER_API_KEY")
-
-# Ensure ChromaDB is running on your EC2
-if not CHROMA_HOST:
-    raise ValueError("CHROMA_HOST not set")
-if not CHROMA_PORT:
-    raise ValueError("CHROMA_PORT not set")
-
-# Ensure API key is set
-if not api_key:
-    raise ValueError("TOGETHER_API_KEY is missing. Please check your .env file.")
-
-# Initializing LLM + Embedding
-llm = ChatTogether(model="mistralai/Mistral-7B-Instruct-v0.2", together_api_key=api_key)
-embedding_model = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
-chroma_client = chromadb.HttpClient(host=CHROMA_HOST, port=CHROMA_PORT)
-collection = chroma_client.get_or_create_collection(name="slack-faqs")
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Annotated
+try:
+    import resource  # peak RSS reporting, not available on Windows
+except ImportError:
+    resource = None
+
+# LLM, embedding model and Chroma are loaded on first use through LangGraph.resources
+
+# ingest embeds and writes this many messages per Chroma request
+# (with EMBED_WORKERS > 1 keep it at least EMBED_WORKERS * EMBED_BATCH_SIZE so every worker gets a batch)
+EMBED_CHUNK_SIZE = int(os.getenv("EMBED_CHUNK_SIZE", "256"))
+
+# ids per get/delete round trip when deleting a date range from Chroma
+CHROMA_DELETE_PAGE_SIZE = int(os.getenv("CHROMA_DELETE_PAGE_SIZE", "1000"))
+
+# threads whose stored messages are looked up in one Postgres query while building thread documents
+THREAD_LOOKUP_BATCH_SIZE = int(os.getenv("THREAD_LOOKUP_BATCH_SIZE", "200"))
+
+# questions are embedded here with the ingest model, one vector per question shared by every stage
+query_embedding_cache = QueryEmbeddingCache(embed_fn=lambda text: get_embedding_model().embed_query(text))
+
+# near-repeat questions are answered from here instead of re-running the graph
+answer_cache = SemanticAnswerCache(embed_fn=query_embedding_cache.embed)
+
+# hybrid retrieval: BM25 over the messages table fused with the Chroma results
+HYBRID_RETRIEVAL_ENABLED = os.getenv("HYBRID_RETRIEVAL_ENABLED", "true").lower() == "true"
+HYBRID_VECTOR_WEIGHT = float(os.getenv("HYBRID_VECTOR_WEIGHT", "1.0"))
+HYBRID_LEXICAL_WEIGHT = float(os.getenv("HYBRID_LEXICAL_WEIGHT", "1.0"))
+RRF_K = int(os.getenv("RRF_K", "60"))
+# past this, lexical results are used alone rather than waiting on Chroma
+VECTOR_RETRIEVAL_TIMEOUT = float(os.getenv("VECTOR_RETRIEVAL_TIMEOUT", "5"))
+# and vector results alone rather than waiting on BM25 (e.g. while the index is still loading)
+LEXICAL_RETRIEVAL_TIMEOUT = float(os.getenv("LEXICAL_RETRIEVAL_TIMEOUT", "2"))
+# threads are indexed as whole question/reply documents, so a few results carry what 20 single messages did
+RETRIEVAL_N_RESULTS = int(os.getenv("RETRIEVAL_N_RESULTS", "8"))
+lexical_index = BM25Index()
+
+def _load_lexical_index():
+    if HYBRID_RETRIEVAL_ENABLED:
+        lexical_index.refresh(force=True)
+    return lexical_index
+
+# listed in WARM_UP_RESOURCES, the index is built at startup rather than under the first question
+resources.register("lexical_index", _load_lexical_index)
+retrieval_executor = ThreadPoolExecutor(max_workers=int(os.getenv("RETRIEVAL_WORKERS", "8")))
+
+# obvious messages ("thanks!", emoji, announcements) are decided locally without an LLM call
+intent_gate = IntentGate.load(embed_fn=query_embedding_cache.embed) if INTENT_GATE_ENABLED else None
+
+def embedding_store():
+    """The persistent document embedding cache, if the embedding model has been loaded with one."""
+    if not resources.is_loaded("embedding_model"):
+        return None
+    return getattr(get_embedding_model(), "store", None)
+
+# cache/gate counters show up as gauges on /metrics
+def _cache_gauges():
+    gauges = {}
+    for prefix, stats in (("answer_cache", answer_cache.stats()), ("query_embedding_cache", query_embedding_cache.stats())):
+        for key, value in stats.items():
+            gauges[f"{prefix}_{key}"] = value
+    if intent_gate is not None:
+        for key, value in intent_gate.stats().items():
+            gauges[f"intent_gate_{key}"] = value
+    gauges["lexical_index_documents"] = len(lexical_index.documents)
+    store = embedding_store()
+    if store is not None:
+        for key, value in store.stats().items():
+            gauges[f"embedding_store_{key}"] = value
+    return gauges
+
+metrics.register_collector(_cache_gauges)
+metrics.register_collector(lambda: {f"db_pool_{k}": v for k, v in get_pool().stats().items()})
+
+# per-stage timings from different nodes are merged instead of overwriting each other
+def merge_timings(current: dict, update: dict) -> dict:
+    return {**(current or {}), **(update or {})}
 
 # Define the query state schema
 class QueryState(BaseModel):
@@ -39,26 +103,99 @@ class QueryState(BaseModel):
     category: str | None = None  # actual question category (used for escalation)
     intent: str | None = None  # 'should_respond' or 'skip'
     response: str | None = None
+    timings: Annotated[dict[str, float], merge_timings] = {}  # stage name -> seconds
+
+def vector_search(query_embedding, n_results):
+    start = time.perf_counter()
+    results = get_collection().query(
+        query_embeddings=[query_embedding],
+        n_results=n_results,
+        include=["documents", "metadatas", "embeddings"]
+    )
+    documents = results.get("documents", [[]])[0]
+    metadatas = results.get("metadatas", [[]])[0]
+    embeddings = results.get("embeddings")
+    embeddings = embeddings[0] if embeddings is not None else [None] * len(documents)
+    hits = [{"document": d, "metadata": m, "embedding": e} for d, m, e in zip(documents, metadatas, embeddings)]
+    elapsed = time.perf_counter() - start
+    metrics.observe("chroma_query_seconds", elapsed)
+    metrics.observe("retrieval_documents", len(hits), retriever="vector")
+    return hits, elapsed
+
+def lexical_search(question, n_results):
+    start = time.perf_counter()
+    lexical_index.refresh()
+    hits = [{"document": d, "metadata": m, "embedding": None} for d, m, _ in lexical_index.search(question, n_results)]
+    elapsed = time.perf_counter() - start
+    metrics.observe("lexical_search_seconds", elapsed)
+    metrics.observe("retrieval_documents", len(hits), retriever="lexical")
+    return hits, elapsed
+
+# run both retrievers concurrently and merge them with reciprocal rank fusion
+def hybrid_search(question, query_embedding, n_results, timings):
+    vector_future = retrieval_executor.submit(vector_search, query_embedding, n_results)
+    lexical_future = retrieval_executor.submit(lexical_search, question, n_results)
+
+    vector_hits, lexical_hits = [], []
+    try:
+        vector_hits, timings["retrieve_vector"] = vector_future.result(timeout=VECTOR_RETRIEVAL_TIMEOUT)
+    except Exception as e:
+        print(f"[Vector Retrieval Error]: {type(e).__name__} - {e}, using lexical results only")
+    try:
+        lexical_hits, timings["retrieve_lexical"] = lexical_future.result(timeout=LEXICAL_RETRIEVAL_TIMEOUT)
+    except Exception as e:
+        print(f"[Lexical Retrieval Error]: {type(e).__name__} - {e}, using vector results only")
+
+    by_document = {}
+    for hit in vector_hits + lexical_hits:
+        by_document.setdefault(hit["document"], hit)
+    fused = reciprocal_rank_fusion(
+        {"vector": [h["document"] for h in vector_hits], "lexical": [h["document"] for h in lexical_hits]},
+        weights={"vector": HYBRID_VECTOR_WEIGHT, "lexical": HYBRID_LEXICAL_WEIGHT},
+        k=RRF_K
+    )
+    hits = [by_document[doc] for doc in fused[:n_results]]
+
+    # lexical-only hits have no stored vector, embed them so context packing can compare everything
+    missing = [hit for hit in hits if hit["embedding"] is None]
+    if missing:
+        vectors = get_embedding_model().embed_documents([hit["document"] for hit in missing])
+        for hit, vector in zip(missing, vectors):
+            hit["embedding"] = vector
+
+    print(f"Hybrid retrieval: {len(vector_hits)} vector + {len(lexical_hits)} lexical -> {len(hits)} fused")
+    return hits
 
 # Retrieve relevant context from ChromaDB
 def retrieve_context(state: QueryState):
-    # Query Chroma for relevant messages
-    results = collection.query(
-        query_texts=[state.question],
-        n_results=20  # try 20 for more context (increasing helps the bot ! it's able to grab the appropriate channels :D)
-    )
+    # Query Chroma for relevant messages, embedding locally so the vector matches the ingest model
+    query_embedding = query_embedding_cache.embed(state.question)
+    timings = {}
+    if HYBRID_RETRIEVAL_ENABLED:
+        hits = hybrid_search(state.question, query_embedding, RETRIEVAL_N_RESULTS, timings)
+    else:
+        hits, timings["retrieve_vector"] = vector_search(query_embedding, RETRIEVAL_N_RESULTS)
 
     # Join retrieved documents
-    documents = results.get("documents", [[]])[0]
-    metadatas = results.get("metadatas", [[]])[0]
-    print("Retrieved metadatas:", metadatas[0])
+    documents = [hit["document"] for hit in hits]
+    metadatas = [hit["metadata"] for hit in hits]
+    embeddings = [hit["embedding"] for hit in hits]
+    if any(e is None for e in embeddings):
+        embeddings = None
+    print("Retrieved metadatas:", metadatas[0] if metadatas else None)
+    print("Retriever latency:", {k: round(v, 3) for k, v in timings.items()})
 
     # Assign the category from top result (you could do voting logic if needed)
     # extracted_category = metadatas[0].get("category") if metadatas else None
     # state.category = extracted_category
-    context = "\n\n".join(documents)
-
-    # Extract all categories from the top 20 results
+    # every retrieved document still votes on the category, but only de-duplicated, diverse documents within budget reach the prompt
+    packed, packing_report = pack_context(query_embedding, documents, embeddings)
+    context = "\n\n".join(packed)
+    print(f"Context packing: {packing_report}")
+    metrics.observe("context_tokens_saved", packing_report["tokens_saved"])
+    metrics.observe("retrieval_documents", len(packed), retriever="packed")
+
+    # Extract all categories from the retrieved results
     categories = [meta.get("category") for meta in metadatas if meta.get("category")]
 
     # Use majority voting to determine most relevant category
@@ -73,18 +210,22 @@ def retrieve_context(state: QueryState):
 
     print(f"context from chroma: {context}")
     print(f"Retrieved category: {state.category}")
+    print(f"Query embedding cache: {query_embedding_cache.stats()}")
 
     return QueryState(
         question=state.question,
         intent = state.intent,
         category=state.category,
-        response=context
+        response=context,
+        timings=timings
     )
 
 
 # Define step 4: Generate response
-def generate_response(state: QueryState):
-    prompt = f"""You are a Slack assistant for RTC, otherwise known as Rewriting the Code. If RTC is ever mentioned, it is always referring to the organization Rewriting the Code. Use the context below to answer the user's question:
+RESPONSE_FOOTER = " Please react with the appropriate emoji to indicate if this was helpful or not."
+
+def build_response_prompt(state: QueryState) -> str:
+    return f"""You are a Slack assistant for RTC, otherwise known as Rewriting the Code. If RTC is ever mentioned, it is always referring to the organization Rewriting the Code. Use the context below to answer the user's question:
         
         Here is the question: {state.question}.
         
@@ -94,40 +235,276 @@ def generate_response(state: QueryState):
         
         Please provide a comprehensive and context-aware answer by only using the provided information but DO NOT directly mention that you are referencing the context provided. Treat it as if it is knowledge you are passing along to the user in order to help out. DO NOT  If you don't know the answer, say \"I'm not sure.\" Do not make up details.
         """
+
+def generate_response(state: QueryState):
+    prompt = build_response_prompt(state)
     
     # Use the LLM to generate the final answer (using .invoke() as per deprecation notice)
-    final_response = llm.invoke(prompt).content.strip() + " Please react with the appropriate emoji to indicate if this was helpful or not."
+    start = time.perf_counter()
+    llm_response = get_llm().invoke(prompt)
+    metrics.record_llm_call("generate_response", llm_response, time.perf_counter() - start)
+    final_response = llm_response.content.strip() + RESPONSE_FOOTER
     
     return QueryState(question=state.question, category=state.category, intent=state.intent, response=final_response)
 
-def create_and_store_embedding(files: list):
-    all_messages = []
-
-    # Load messages from uploaded files
-    for file in files:
-        file.seek(0)
-        raw = file.read().decode("utf-8")
-        parsed = json.loads(raw)
-        all_messages.extend(parsed)
-
-    texts, metadatas, ids = [], [], []
-
-    for i, item in enumerate(all_messages):
-        message = item.get("text", "")
-        category = item.get("category", "Unknown")
-
-        # same formatting logic as original create_and_store_embedding
-        formatted = f"text: {message}\ncategory: {category}"
-        texts.append(formatted)
-        metadatas.append({"text": message, "category": category})
-        ids.append(str(uuid.uuid4()))
-
-    # Embed and store
-    embeddings = embedding_model.embed_documents(texts)
-    collection = chroma_client.get_or_create_collection(name="slack-faqs")
-    collection.add(documents=texts, metadatas=metadatas, ids=ids, embeddings=embeddings)
-
-    print(f"✅ Stored {len(texts)} embeddings from uploaded files in ChromaDB.")
+# streaming variant of generate_response, yields text chunks as the LLM produces them (footer last)
+def stream_response(state: QueryState):
+    prompt = build_response_prompt(state)
+    started = False
+    pending = ""  # trailing whitespace is held back so the final text matches .strip()
+    start = time.perf_counter()
+    aggregate = None  # chunks add up to one message carrying any usage metadata
+    for chunk in get_llm().stream(prompt):
+        if aggregate is None:
+            metrics.observe("llm_first_token_seconds", time.perf_counter() - start, call="generate_response")
+        aggregate = chunk if aggregate is None else aggregate + chunk
+        text = pending + chunk.content
+        if not started:
+            text = text.lstrip()
+            started = bool(text)
+        stripped = text.rstrip()
+        pending = text[len(stripped):]
+        if stripped:
+            yield stripped
+    metrics.record_llm_call("generate_response_stream", aggregate, time.perf_counter() - start)
+    yield RESPONSE_FOOTER
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB (None where the resource module is unavailable)."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS reports bytes
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def message_timestamp(message):
+    """Slack ts as float unix seconds, stored as numeric metadata so range deletes can filter server side."""
+    try:
+        return float(message.get("ts"))
+    except (TypeError, ValueError):
+        return None
+
+def thread_document_id(thread, part):
+    """Vector id of a thread document: md5 of channel and thread_ts, with the part number after the first."""
+    channel, thread_ts = thread
+    key = hashlib.md5(f"thread:{channel}:{thread_ts}".encode("utf-8")).hexdigest()
+    return key if part == 0 else f"{key}:{part}"
+
+def message_document(item):
+    """(id, text, metadata) indexing one message on its own, under the message key Postgres uses."""
+    message = item.get("text", "")
+    category = item.get("category", "Unknown")
+    # same formatting logic as original create_and_store_embedding
+    text = document_text(message, category)
+    metadata = {
+        "text": message,
+        "category": category,
+        "text_hash": hashlib.md5(text.encode("utf-8")).hexdigest()
+    }
+    timestamp = message_timestamp(item)
+    if timestamp is not None:  # Chroma rejects None metadata values
+        metadata["timestamp"] = timestamp
+    return message_key(item), text, metadata
+
+def thread_entries(thread, members):
+    """(id, text, metadata, superseded ids) question/reply documents for one complete thread."""
+    question, texts = thread_documents(members)
+    timestamps = [t for t in map(message_timestamp, members) if t is not None]
+    for part, text in enumerate(texts):
+        metadata = {
+            "text": question.get("text", ""),
+            "category": question.get("category", "Unknown"),
+            "text_hash": hashlib.md5(text.encode("utf-8")).hexdigest(),
+            "channel": thread[0],
+            "thread_ts": str(thread[1]),
+            "messages": len(members),
+            "part": part,
+            "parts": len(texts),
+        }
+        if timestamps:
+            # a date range delete removes every thread that overlaps it
+            metadata["timestamp"] = min(timestamps)
+            metadata["last_timestamp"] = max(timestamps)
+        superseded = [message_key(m) for m in members] if part == 0 else []
+        yield thread_document_id(thread, part), text, metadata, superseded
+
+def merge_stored_threads(completed, stored_threads):
+    """
+    (thread, members) for each completed thread, with the thread's messages already stored merged in,
+    so a thread document never loses the replies an earlier upload brought. Uploaded copies win.
+    """
+    stored = {}
+    for row in stored_threads([thread for thread, _ in completed]):
+        stored.setdefault(thread_of(row), {})[message_key(row)] = row
+    for thread, members in completed:
+        merged = stored.get(thread, {})
+        merged.update((message_key(m), m) for m in members)
+        yield thread, list(merged.values())
+
+def iter_documents(open_records, stored_threads=None):
+    """
+    Turn a message stream into (id, text, metadata, superseded ids) index documents. `open_records()`
+    must return a fresh iterator over the messages each time, it is called twice.
+    The first pass only counts each thread's messages. On the second, standalone messages stream straight
+    through and a thread becomes question/reply documents as soon as its last message is read, so only
+    threads still in progress are held (for a date-ordered export, the threads active at one time).
+    With `stored_threads` (threads -> stored message rows, e.g. fetch_thread_messages) every thread is
+    completed with the messages already stored before its documents are built, THREAD_LOOKUP_BATCH_SIZE
+    threads per lookup. Without it the stream is taken to hold whole threads (as when it is the table itself).
+    `superseded` lists the per-message vector ids those messages had before threads were indexed.
+    """
+    sizes = Counter(thread for thread in map(thread_of, open_records()) if thread is not None)
+    in_progress, completed = {}, []
+
+    def documents(batch):
+        if stored_threads is not None:
+            batch = merge_stored_threads(batch, stored_threads)
+        for thread, members in batch:
+            if len(members) == 1:
+                # a question without replies (or a reply without its question): nothing to group
+                yield (*message_document(members[0]), [])
+            else:
+                yield from thread_entries(thread, members)
+
+    for item in open_records():
+        thread = thread_of(item)
+        if thread is None or (sizes[thread] == 1 and stored_threads is None):
+            yield (*message_document(item), [])
+            continue
+        members = in_progress.setdefault(thread, [])
+        members.append(item)
+        if len(members) < sizes[thread]:
+            continue
+        completed.append((thread, in_progress.pop(thread)))
+        if stored_threads is None or len(completed) >= THREAD_LOOKUP_BATCH_SIZE:
+            yield from documents(completed)
+            completed = []
+    yield from documents(completed)
+
+def chunk_documents(documents, chunk_size):
+    """Group (id, text, metadata, superseded ids) documents into (ids, texts, metadatas, superseded ids) chunks."""
+    ids, texts, metadatas, superseded = [], [], [], []
+    for doc_id, text, metadata, replaced in documents:
+        ids.append(doc_id)
+        texts.append(text)
+        metadatas.append(metadata)
+        superseded.extend(replaced)
+        if len(texts) >= chunk_size:
+            yield ids, texts, metadatas, superseded
+            ids, texts, metadatas, superseded = [], [], [], []
+    if texts:
+        yield ids, texts, metadatas, superseded
+
+def iter_file_documents(files):
+    """Documents for a whole upload; the files are read as one stream so a thread split across them is grouped."""
+    def read():
+        for file in files:
+            file.seek(0)
+            yield from iter_records(file)
+
+    return iter_documents(read, stored_threads=fetch_thread_messages)
+
+def iter_embedding_chunks(files, chunk_size):
+    """
+    Stream the uploaded record files (JSON arrays, JSONL or Parquet) as (ids, texts, metadatas, superseded ids)
+    chunks of `chunk_size` documents.
+    Ids are deterministic (message keys, or thread ids for thread documents), so re-uploading a file
+    maps onto the same vectors.
+    """
+    return chunk_documents(iter_file_documents(files), chunk_size)
+
+def iter_database_messages(batch_size=EMBED_CHUNK_SIZE):
+    """Every row of the messages table as a message dict, fetched `batch_size` rows at a time."""
+    last_id = 0
+    while rows := fetch_message_rows(last_id, batch_size):
+        last_id = rows[-1]["id"]
+        yield from rows
+
+def stale_thread_parts(doc_id, metadata, stored):
+    """Ids of trailing parts a thread document had before, when it now needs fewer (e.g. THREAD_DOC_MAX_CHARS grew)."""
+    if metadata.get("part") != 0:
+        return []
+    old_parts = (stored or {}).get("parts") or 0
+    return [f"{doc_id}:{part}" for part in range(metadata["parts"], old_parts)]
+
+def create_and_store_embedding(files: list, chunk_size=EMBED_CHUNK_SIZE, inserted_ids=None, superseded_ids=None):
+    """Embed uploaded record files into Chroma, see store_embedding_chunks."""
+    return store_embedding_chunks(iter_embedding_chunks(files, chunk_size), chunk_size, inserted_ids, superseded_ids)
+
+def store_embedding_chunks(chunks, chunk_size=EMBED_CHUNK_SIZE, inserted_ids=None, superseded_ids=None):
+    """
+    Embed uploaded messages and upsert them into Chroma chunk by chunk, so memory stays flat
+    regardless of upload size and no single request exceeds Chroma's limits.
+    Threads are stored as question/reply documents (see iter_documents), other messages one vector each.
+    Documents already stored with the same text_hash are skipped without being re-embedded.
+    Returns {"inserted", "updated", "skipped"} document counts. If `inserted_ids` is a list, ids of newly
+    added vectors are appended to it chunk by chunk, so a caller can undo a partial upload.
+    Vectors the thread documents replace are deleted as each chunk is stored, unless `superseded_ids` is a list:
+    then their ids are collected there, so the caller can delete them once the whole update has succeeded.
+    """
+    collection = get_collection()
+    embedding_model = get_embedding_model()
+    store = embedding_store()
+    hits_before, misses_before = (store.hits, store.misses) if store else (0, 0)
+    summary = {"inserted": 0, "updated": 0, "skipped": 0}
+    replaced = 0
+    start = time.perf_counter()
+
+    for ids, texts, metadatas, superseded in chunks:
+        # a key may appear twice in one upload, the last copy wins
+        latest = {doc_id: i for i, doc_id in enumerate(ids)}
+        summary["skipped"] += len(ids) - len(latest)
+
+        existing = collection.get(ids=list(latest), include=["metadatas"])
+        stored = {doc_id: metadata or {} for doc_id, metadata in zip(existing["ids"], existing["metadatas"])}
+
+        changed = [i for doc_id, i in latest.items()
+                   if stored.get(doc_id, {}).get("text_hash") != metadatas[i]["text_hash"]]
+        # same text, different metadata (e.g. vectors stored before timestamps were): no need to re-embed
+        changed_set = set(changed)
+        retagged = [i for doc_id, i in latest.items()
+                    if doc_id in stored and i not in changed_set and stored[doc_id] != metadatas[i]]
+        updated = sum(ids[i] in stored for i in changed)
+        summary["inserted"] += len(changed) - updated
+        summary["updated"] += updated + len(retagged)
+        summary["skipped"] += len(latest) - len(changed) - len(retagged)
+        if retagged:
+            collection.update(ids=[ids[i] for i in retagged], metadatas=[metadatas[i] for i in retagged])
+
+        # vectors the thread documents replace: single-message vectors and parts a thread no longer has
+        obsolete = superseded + [part for doc_id, i in latest.items()
+                                 for part in stale_thread_parts(doc_id, metadatas[i], stored.get(doc_id))]
+        if obsolete and superseded_ids is not None:
+            superseded_ids.extend(obsolete)
+        elif obsolete:
+            replaced += delete_existing_chroma_ids(obsolete)
+        if not changed:
+            continue
+
+        # Embed and store
+        chunk_texts = [texts[i] for i in changed]
+        embeddings = embedding_model.embed_documents(chunk_texts)
+        collection.upsert(
+            ids=[ids[i] for i in changed],
+            documents=chunk_texts,
+            metadatas=[metadatas[i] for i in changed],
+            embeddings=embeddings
+        )
+        if inserted_ids is not None:
+            inserted_ids.extend(ids[i] for i in changed if ids[i] not in stored)
+
+    elapsed = time.perf_counter() - start
+    processed = sum(summary.values())
+    print(f"✅ Upserted documents into ChromaDB in {elapsed:.1f}s: {summary['inserted']} inserted, "
+          f"{summary['updated']} updated, {summary['skipped']} unchanged "
+          f"({processed / elapsed if elapsed else 0:.1f} docs/sec, chunk size {chunk_size}, peak RSS {peak_rss_mb()} MB).")
+    if replaced:
+        print(f"Removed {replaced} per-message vectors now covered by thread documents.")
+    if store:
+        hits, misses = store.hits - hits_before, store.misses - misses_before
+        print(f"Embedding cache: {hits} hits, {misses} computed "
+              f"({100.0 * hits / (hits + misses) if hits + misses else 0:.1f}% hit rate).")
+    return summary
 
 # def create_and_store_embedding(state: QueryState):
 #     all_messages = fetch_all_messages()
@@ -147,44 +524,161 @@ def create_and_store_embedding(files: list):
 #
 #     return state, ids
 
-def delete_chroma_by_date(start_ts, end_ts):
-    chroma_client = chromadb.HttpClient(host="localhost", port=8000)
-    collection = chroma_client.get_or_create_collection("rtc")
-    results = collection.get(include=["metadatas", "documents"])
-
-    ids_to_delete = [
-        doc_id for doc_id, metadata in zip(results['ids'], results['metadatas'])
-        if metadata.get("timestamp") and start_ts <= metadata["timestamp"] <= end_ts
-    ]
-
-    if ids_to_delete:
-        collection.delete(ids=ids_to_delete)
-        print(f"Deleted {len(ids_to_delete)} entries from Chroma between {start_ts}–{end_ts}")
-        return len(ids_to_delete)
+def delete_chroma_ids(ids, batch_size=EMBED_CHUNK_SIZE):
+    """Delete vectors by id (message key). Returns how many ids were sent for deletion."""
+    collection = get_collection()
+    for start in range(0, len(ids), batch_size):
+        collection.delete(ids=ids[start:start + batch_size])
+    return len(ids)
+
+def delete_existing_chroma_ids(ids, batch_size=EMBED_CHUNK_SIZE):
+    """Delete whichever of `ids` are stored. Returns how many were."""
+    collection = get_collection()
+    deleted = 0
+    for start in range(0, len(ids), batch_size):
+        found = collection.get(ids=ids[start:start + batch_size], include=[])["ids"]
+        if found:
+            collection.delete(ids=found)
+            deleted += len(found)
+    return deleted
+
+def delete_chroma_by_date(start_ts, end_ts, page_size=CHROMA_DELETE_PAGE_SIZE, deleted_threads=None):
+    """
+    Delete every vector whose timestamp metadata falls in [start_ts, end_ts] (unix seconds), and every
+    thread document whose first..last message span overlaps the range.
+    Chroma does the range filtering itself. Matching ids come back one page at a time, and each
+    page is deleted before the next is fetched, so memory stays bounded on a large collection.
+    Returns the number of vectors deleted. A thread document covers several messages, so this is
+    usually lower than the Postgres delete for the same range.
+    If `deleted_threads` is a list, the [channel, thread_ts] of every thread document deleted is added to it:
+    their messages outside the range are still in Postgres, rebuild_chroma_threads puts them back.
+    """
+    collection = get_collection()
+    where = {"$or": [
+        {"$and": [{"timestamp": {"$gte": float(start_ts)}}, {"timestamp": {"$lte": float(end_ts)}}]},
+        # threads that started before the range but have replies inside it
+        {"$and": [{"timestamp": {"$lte": float(end_ts)}}, {"last_timestamp": {"$gte": float(start_ts)}}]},
+    ]}
+    deleted = 0
+    while True:
+        # deleted ids drop out of the result, so the next page is always at offset 0
+        page = collection.get(where=where, limit=page_size, include=["metadatas"])
+        if not page["ids"]:
+            break
+        if deleted_threads is not None:
+            deleted_threads.extend([metadata["channel"], metadata["thread_ts"]] for metadata in page["metadatas"]
+                                   if metadata and metadata.get("part") == 0)
+        page = page["ids"]
+        collection.delete(ids=page)
+        deleted += len(page)
+
+    if deleted:
+        print(f"Deleted {deleted} entries from Chroma between {start_ts}–{end_ts}")
     else:
         print("No entries matched ChromaDB deletion range.")
-        return 0
-
-
-def should_respond(state: QueryState) -> QueryState:
+    return deleted
+
+def rebuild_chroma_threads(threads, chunk_size=EMBED_CHUNK_SIZE):
+    """
+    Re-index [channel, thread_ts] threads from what Postgres holds now, e.g. after a range delete removed
+    their documents: the remaining messages become thread documents again (or a lone message's vector).
+    Returns the upsert summary.
+    """
+    threads = list({thread_of({"channel": channel, "thread_ts": thread_ts}) for channel, thread_ts in threads} - {None})
+    rows = []
+    for start in range(0, len(threads), THREAD_LOOKUP_BATCH_SIZE):
+        rows.extend(fetch_thread_messages(threads[start:start + THREAD_LOOKUP_BATCH_SIZE]))
+    return store_embedding_chunks(chunk_documents(iter_documents(lambda: iter(rows)), chunk_size), chunk_size)
+
+def backfill_chroma_timestamps(batch_size=EMBED_CHUNK_SIZE):
+    """
+    Add timestamp metadata to vectors stored before ingest recorded it, using ts from Postgres.
+    Only vectors whose id is a message key can be matched. Older random-id vectors need a re-upload.
+    """
+    collection = get_collection()
+    updated, last_id = 0, 0
+    while rows := fetch_message_timestamps(last_id, batch_size):
+        last_id = rows[-1]["id"]
+        timestamps = {row["msg_key"]: float(row["ts"]) for row in rows if row["msg_key"] and row["ts"] is not None}
+        if not timestamps:
+            continue
+        existing = collection.get(ids=list(timestamps), include=["metadatas"])
+        stale = [(doc_id, metadata) for doc_id, metadata in zip(existing["ids"], existing["metadatas"])
+                 if (metadata or {}).get("timestamp") != timestamps[doc_id]]
+        if stale:
+            collection.update(
+                ids=[doc_id for doc_id, _ in stale],
+                metadatas=[{**(metadata or {}), "timestamp": timestamps[doc_id]} for doc_id, metadata in stale]
+            )
+            updated += len(stale)
+    print(f"Backfilled timestamp metadata on {updated} Chroma vectors.")
+    return updated
+
+def reindex_chroma(batch_size=EMBED_CHUNK_SIZE, page_size=CHROMA_DELETE_PAGE_SIZE):
+    """
+    Rebuild the vector index from the messages table: every message (or thread) is upserted under its
+    current id, then vectors under any other id are deleted. Those are the random-id vectors from before
+    ids were message keys and vectors under keys that migration 6 (rekey_messages) replaced.
+    Unchanged documents are not re-embedded. Run once after migrating, with uploads paused.
+    Returns {"stored": upsert summary, "pruned": vectors deleted}.
+    """
+    current = set()
+
+    def documents():
+        for doc_id, text, metadata, replaced in iter_documents(lambda: iter_database_messages(batch_size)):
+            current.add(doc_id)
+            yield doc_id, text, metadata, replaced
+
+    stored = store_embedding_chunks(chunk_documents(documents(), batch_size), batch_size)
+
+    collection = get_collection()
+    pruned, offset = 0, 0
+    while page := collection.get(limit=page_size, offset=offset, include=[])["ids"]:
+        stale = [doc_id for doc_id in page if doc_id not in current]
+        if stale:
+            collection.delete(ids=stale)
+            pruned += len(stale)
+        # deleted ids drop out, so the next page starts after the ids that were kept
+        offset += len(page) - len(stale)
+    print(f"Reindexed {len(current)} documents from Postgres, removed {pruned} vectors under old ids.")
+    return {"stored": stored, "pruned": pruned}
+
+
+# ask the LLM whether a message is a support question the bot should answer
+def llm_should_respond(question: str) -> bool:
     decision_prompt = f"""
 You are a Slack bot that only responds to valid support questions.
 Given the message below, determine if it's a question the bot should respond to:
 
 Message:
-{state.question}
+{question}
 
 Answer with ONLY 'yes' or 'no'. Do not explain.
 """
-    answer = llm.invoke(decision_prompt).content.strip().lower()
-    if answer.startswith("yes"):
-        state.intent = "should_respond"
-    else:
-        state.intent = "skip"
+    start = time.perf_counter()
+    llm_response = get_llm().invoke(decision_prompt)
+    metrics.record_llm_call("should_respond", llm_response, time.perf_counter() - start)
+    answer = llm_response.content.strip().lower()
+    return answer.startswith("yes")
+
+# 'should_respond' or 'skip' when the intent gate can tell without the LLM, None when it has to ask
+def local_intent(question: str) -> str | None:
+    if intent_gate is None:
+        return None
+    intent, confidence, source = intent_gate.decide(question)
+    if intent:
+        print(f"Intent gate ({source}, {confidence:.2f}): {intent}")
+    return intent
+
+def should_respond(state: QueryState) -> QueryState:
+    intent = local_intent(state.question)
+    if intent is None:
+        intent = "should_respond" if llm_should_respond(state.question) else "skip"
+    state.intent = intent
     return state
 
 def inspect_embeddings(ids=None):
-    collection = chroma_client.get_or_create_collection(name="slack-faqs")
+    collection = get_collection()
 
     # Get all if no specific IDs provided
     if ids is None:
@@ -199,3 +693,12 @@ def inspect_embeddings(ids=None):
         print("------")
 
     return data
+
+if __name__ == "__main__":
+    # one-off maintenance: python -m LangGraph.common_workflow backfill-timestamps|reindex
+    if sys.argv[1:] == ["backfill-timestamps"]:
+        backfill_chroma_timestamps()
+    elif sys.argv[1:] == ["reindex"]:
+        reindex_chroma()
+    else:
+        print("usage: python -m LangGraph.common_workflow backfill-timestamps|reindex")
@@ -0,0 +1,97 @@
+import os
+
+import numpy as np
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+CONTEXT_DEDUP_THRESHOLD = float(os.getenv("CONTEXT_DEDUP_THRESHOLD", "0.95"))
+# 1.0 = pure relevance ordering, lower values favour documents that add something new
+CONTEXT_MMR_LAMBDA = float(os.getenv("CONTEXT_MMR_LAMBDA", "0.7"))
+
+
+def estimate_tokens(text):
+    """Rough token count (~4 characters per token for English with the Mistral tokenizer)."""
+    return max(1, (len(text) + 3) // 4) if text else 0
+
+def clip_to_tokens(text, tokens):
+    """Cut `text` to about `tokens` tokens (the inverse of estimate_tokens), at a word boundary when there is one."""
+    limit = max(tokens, 0) * 4
+    if len(text) <= limit:
+        return text
+    clipped = text[:limit]
+    return clipped.rsplit(" ", 1)[0] if " " in clipped else clipped
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+def pack_context(query_embedding, documents, embeddings, token_budget=CONTEXT_TOKEN_BUDGET,
+                 dedup_threshold=CONTEXT_DEDUP_THRESHOLD, mmr_lambda=CONTEXT_MMR_LAMBDA):
+    """
+    Drop near-duplicate documents, order the rest by maximal marginal relevance and keep as many as fit
+    in `token_budget`. The first document in that order is always kept, clipped to the budget if it is
+    longer, so an oversized best match never leaves the context empty. Returns (selected documents, report).
+    """
+    tokens_before = sum(estimate_tokens(doc) for doc in documents) + 2 * max(len(documents) - 1, 0)
+    if not documents:
+        return [], {"documents_in": 0, "documents_out": 0, "duplicates_dropped": 0,
+                    "tokens_before": 0, "tokens_after": 0, "tokens_saved": 0}
+
+    if embeddings is None or len(embeddings) != len(documents):
+        # no vectors to compare, fall back to exact-text dedup in retrieval order
+        seen, candidates = set(), []
+        for i, doc in enumerate(documents):
+            key = " ".join(doc.lower().split())
+            if key not in seen:
+                seen.add(key)
+                candidates.append(i)
+        duplicates = len(documents) - len(candidates)
+        order = candidates
+    else:
+        doc_vectors = _normalize(embeddings)
+        query_vector = _normalize(query_embedding)
+        relevance = doc_vectors @ query_vector
+        similarity = doc_vectors @ doc_vectors.T
+
+        # near-duplicates: keep the more relevant copy (Chroma returns results best first)
+        candidates = []
+        for i in range(len(documents)):
+            if all(similarity[i, j] < dedup_threshold for j in candidates):
+                candidates.append(i)
+        duplicates = len(documents) - len(candidates)
+
+        # MMR rerank
+        order, remaining = [], list(candidates)
+        while remaining:
+            def mmr_score(i):
+                redundancy = max((similarity[i, j] for j in order), default=0.0)
+                return mmr_lambda * relevance[i] - (1 - mmr_lambda) * redundancy
+            best = max(remaining, key=mmr_score)
+            order.append(best)
+            remaining.remove(best)
+
+    # the best document goes in even when it alone is over budget, then pack greedily,
+    # smaller documents further down the order can still fill leftover budget
+    first = documents[order[0]]
+    clipped = estimate_tokens(first) > token_budget
+    if clipped:
+        first = clip_to_tokens(first, token_budget)
+    selected, used = [first], estimate_tokens(first)
+    for i in order[1:]:
+        cost = estimate_tokens(documents[i]) + (2 if selected else 0)
+        if used + cost > token_budget:
+            continue
+        selected.append(documents[i])
+        used += cost
+
+    report = {
+        "documents_in": len(documents),
+        "documents_out": len(selected),
+        "duplicates_dropped": duplicates,
+        "first_document_clipped": clipped,
+        "tokens_before": tokens_before,
+        "tokens_after": used,
+        "tokens_saved": tokens_before - used,
+    }
+    return selected, report
@@ -0,0 +1,142 @@
+'''multi-process batched embedding for large ingests - shards document batches across worker processes'''
+import os
+import sys
+import json
+import time
+import atexit
+import argparse
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# 0/1 keeps embedding in-process
+EMBED_WORKERS = int(os.getenv("EMBED_WORKERS", "0"))
+# documents per task sent to a worker
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "64"))
+
+# ------- worker side ----------
+
+_worker_model = None
+
+def _init_worker(model_name, torch_threads):
+    """Runs once per worker process: load the model and stop each worker from grabbing every core."""
+    global _worker_model
+    try:
+        import torch
+        torch.set_num_threads(torch_threads)
+    except ImportError:
+        pass
+    from langchain_huggingface import HuggingFaceEmbeddings
+    _worker_model = HuggingFaceEmbeddings(model_name=model_name)
+
+def _embed_batch(texts):
+    return _worker_model.embed_documents(texts)
+
+
+class EmbeddingEngine:
+    """
+    Wraps an in-process embeddings model and sends large embed_documents calls to a process pool.
+    Each worker loads its own copy of the model once, in its initializer. Batches are
+    fanned out with executor.map, so the output order matches the input order.
+    Calls no bigger than one batch, including queries, stay in-process to skip the IPC round trip.
+    """
+
+    def __init__(self, model, model_name, workers=EMBED_WORKERS, batch_size=EMBED_BATCH_SIZE):
+        self.model = model
+        self.model_name = model_name
+        self.workers = workers
+        self.batch_size = batch_size
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _pool(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    # spawn: forking a process that already holds torch/tokenizer threads can deadlock
+                    torch_threads = max(1, (os.cpu_count() or 1) // self.workers)
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=self.workers,
+                        mp_context=multiprocessing.get_context("spawn"),
+                        initializer=_init_worker,
+                        initargs=(self.model_name, torch_threads)
+                    )
+                    atexit.register(self.shutdown)
+        return self._executor
+
+    def embed_documents(self, texts):
+        texts = list(texts)
+        if self.workers <= 1 or len(texts) <= self.batch_size:
+            return self.model.embed_documents(texts)
+        batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        vectors = []
+        for batch_vectors in self._pool().map(_embed_batch, batches):
+            vectors.extend(batch_vectors)
+        return vectors
+
+    def embed_query(self, text):
+        return self.model.embed_query(text)
+
+    def warm_up(self):
+        """Start the workers and wait for every model to load, so the first ingest doesn't pay for it."""
+        if self.workers > 1:
+            list(self._pool().map(_embed_batch, [["warm up"]] * self.workers))
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+
+# ------- benchmark ----------
+
+def benchmark_texts(limit, source=None):
+    """Messages from a categorized record file if given, synthetic Slack-sized messages otherwise."""
+    if source:
+        from JSON_processing.records import iter_records
+        from .lexical_index import document_text
+        texts = [document_text(m.get("text", ""), m.get("category", "Unknown")) for m in iter_records(source)]
+        return (texts * (limit // max(1, len(texts)) + 1))[:limit]
+    return [f"text: benchmark message {i} about resetting a password for the robotics portal\ncategory: Other"
+            for i in range(limit)]
+
+def benchmark(num_docs, worker_counts, batch_size, source=None):
+    """Embed the same documents with each worker count and report documents/sec (pool startup excluded)."""
+    from langchain_huggingface import HuggingFaceEmbeddings
+    from .resources import EMBEDDING_MODEL_NAME
+
+    texts = benchmark_texts(num_docs, source)
+    model = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL_NAME)
+    results = {}
+    for workers in worker_counts:
+        engine = EmbeddingEngine(model, EMBEDDING_MODEL_NAME, workers=workers, batch_size=batch_size)
+        try:
+            engine.warm_up()
+            start = time.perf_counter()
+            engine.embed_documents(texts)
+            elapsed = time.perf_counter() - start
+        finally:
+            engine.shutdown()
+        results[workers] = round(len(texts) / elapsed, 1)
+        label = f"{workers} worker(s)" if workers > 1 else "in-process"
+        print(f"  {label}: {results[workers]} docs/sec")
+    print(json.dumps({"documents": len(texts), "batch_size": batch_size, "docs_per_sec": results}, indent=2))
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark multi-process document embedding.")
+    parser.add_argument("--benchmark", type=int, default=2000, metavar="DOCS", help="number of documents to embed")
+    parser.add_argument("--workers", default=f"1,2,4,{os.cpu_count() or 1}",
+                        help="comma separated worker counts to compare")
+    parser.add_argument("--batch-size", type=int, default=EMBED_BATCH_SIZE)
+    parser.add_argument("--source", help="categorized record file (JSONL, Parquet or JSON) to take the documents from")
+    args = parser.parse_args(argv)
+
+    worker_counts = sorted({int(w) for w in args.workers.split(",") if w.strip()})
+    benchmark(args.benchmark, worker_counts, args.batch_size, args.source)
+
+if __name__ == "__main__":
+    sys.exit(main())
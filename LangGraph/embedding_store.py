@@ -0,0 +1,243 @@
+'''persistent content-addressed cache of document embeddings, shared by every process on the box'''
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from pathlib import Path
+
+import numpy as np
+
+EMBEDDING_CACHE_ENABLED = os.getenv("EMBEDDING_CACHE_ENABLED", "true").lower() == "true"
+EMBEDDING_CACHE_DIR = Path(os.getenv(
+    "EMBEDDING_CACHE_DIR",
+    Path(__file__).resolve().parent / "cache" / "embeddings"
+))
+# upper bound for the vector files of each model, least recently used vectors are evicted past it
+EMBEDDING_CACHE_MAX_MB = float(os.getenv("EMBEDDING_CACHE_MAX_MB", "512"))
+INITIAL_CAPACITY = 4096
+
+
+def text_hash(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingStore:
+    """
+    Embeddings keyed by (model name, sha1 of the text).
+    The index lives in SQLite and the vectors in one float32 memory-mapped array per model, where
+    each index row points at a slot. When the array reaches its size bound, the least recently
+    used slots are reused.
+
+    Several processes (the bot, the front-end, ingest scripts) can share one directory. Writes take
+    SQLite's exclusive lock and reads run inside a read transaction, so a reader never sees a slot
+    while another process is overwriting it.
+    """
+
+    def __init__(self, model_name, directory=EMBEDDING_CACHE_DIR, max_mb=EMBEDDING_CACHE_MAX_MB):
+        self.model_name = model_name
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.vector_path = self.directory / (model_name.replace("/", "__") + ".f32")
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.directory / "index.sqlite", timeout=30,
+                                   check_same_thread=False, isolation_level=None)
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS models (
+                model TEXT PRIMARY KEY,
+                dim INTEGER NOT NULL,
+                capacity INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                text_hash TEXT NOT NULL,
+                slot INTEGER NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (model, text_hash)
+            );
+            CREATE INDEX IF NOT EXISTS embeddings_lru ON embeddings (model, last_used);
+        """)
+        self._vectors = None
+        self._mapped = 0  # slots covered by the current mapping
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # ------- vector file ----------
+
+    def _meta(self):
+        return self._db.execute("SELECT dim, capacity FROM models WHERE model = ?", (self.model_name,)).fetchone()
+
+    def _map(self, dim, capacity):
+        """(Re)map the vector file when another process, or this one, has grown it."""
+        if self._vectors is not None and self._mapped >= capacity:
+            return
+        with open(self.vector_path, "ab") as f:
+            if f.tell() < capacity * dim * 4:
+                f.truncate(capacity * dim * 4)
+        self._vectors = np.memmap(self.vector_path, dtype=np.float32, mode="r+", shape=(capacity, dim))
+        self._mapped = capacity
+
+    def _max_slots(self, dim):
+        return max(1, self.max_bytes // (dim * 4))
+
+    # ------- cache API ----------
+
+    def _lookup(self, hashes):
+        """{text_hash: slot} for the hashes present, queried in chunks to stay under SQLite's variable limit."""
+        found = {}
+        hashes = list(set(hashes))
+        for start in range(0, len(hashes), 500):
+            chunk = hashes[start:start + 500]
+            found.update(self._db.execute(
+                f"SELECT text_hash, slot FROM embeddings WHERE model = ? "
+                f"AND text_hash IN ({','.join('?' * len(chunk))})",
+                (self.model_name, *chunk)
+            ).fetchall())
+        return found
+
+    def _touch(self, hashes, now):
+        self._db.executemany(
+            "UPDATE embeddings SET last_used = ? WHERE model = ? AND text_hash = ?",
+            [(now, self.model_name, h) for h in hashes]
+        )
+
+    def get_many(self, texts):
+        """Returns a list aligned with `texts`, holding a float32 vector for each hit and None for each miss."""
+        hashes = [text_hash(t) for t in texts]
+        found = {}
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                meta = self._meta()
+                slots = self._lookup(hashes) if meta else {}
+                if slots:
+                    self._map(*meta)
+                    found = {h: np.array(self._vectors[slot]) for h, slot in slots.items()}
+            finally:
+                self._db.execute("COMMIT")
+
+            if found:
+                # recency only drives eviction, a lookup shouldn't fail because the index is busy
+                try:
+                    self._db.execute("BEGIN")
+                    self._touch(found, time.time())
+                    self._db.execute("COMMIT")
+                except sqlite3.OperationalError:
+                    self._db.execute("ROLLBACK")
+
+            results = [found.get(h) for h in hashes]
+            hit_count = sum(r is not None for r in results)
+            self.hits += hit_count
+            self.misses += len(results) - hit_count
+        return results
+
+    def put_many(self, texts, vectors):
+        """Store vectors for texts, evicting least recently used entries once the size bound is reached."""
+        entries = {text_hash(t): np.asarray(v, dtype=np.float32) for t, v in zip(texts, vectors)}
+        if not entries:
+            return
+        dim = len(next(iter(entries.values())))
+
+        with self._lock:
+            self._db.execute("BEGIN EXCLUSIVE")
+            try:
+                meta = self._meta()
+                if meta is None:
+                    meta = (dim, min(INITIAL_CAPACITY, self._max_slots(dim)))
+                    self._db.execute("INSERT INTO models (model, dim, capacity) VALUES (?, ?, ?)",
+                                     (self.model_name, *meta))
+                dim, capacity = meta
+                max_slots = self._max_slots(dim)
+                now = time.time()
+
+                existing = self._lookup(entries)
+                # rewritten entries become the most recent, so eviction below never picks them
+                self._touch(existing, now)
+                new = [h for h in entries if h not in existing]
+                new = new[max(0, len(new) - (max_slots - len(existing))):]  # keep the tail of an oversized batch
+
+                # slots 0..used-1 are always occupied, evicted slots are reused straight away
+                used = self._db.execute("SELECT COUNT(*) FROM embeddings WHERE model = ?",
+                                        (self.model_name,)).fetchone()[0]
+                needed = used + len(new)
+                # grow the file (doubling) before evicting anything
+                if needed > capacity and capacity < max_slots:
+                    capacity = min(max_slots, max(needed, capacity * 2))
+                    self._db.execute("UPDATE models SET capacity = ? WHERE model = ?", (capacity, self.model_name))
+
+                free_slots = list(range(used, min(capacity, needed)))
+                evict = len(new) - len(free_slots)
+                if evict > 0:
+                    victims = self._db.execute(
+                        "SELECT text_hash, slot FROM embeddings WHERE model = ? ORDER BY last_used LIMIT ?",
+                        (self.model_name, evict)
+                    ).fetchall()
+                    self._db.executemany("DELETE FROM embeddings WHERE model = ? AND text_hash = ?",
+                                         [(self.model_name, h) for h, _ in victims])
+                    free_slots += [slot for _, slot in victims]
+                    self.evictions += len(victims)
+
+                self._map(dim, capacity)
+                for h, slot in existing.items():
+                    self._vectors[slot] = entries[h]
+                for h, slot in zip(new, free_slots):
+                    self._vectors[slot] = entries[h]
+                self._vectors.flush()
+                self._db.executemany(
+                    "INSERT INTO embeddings (model, text_hash, slot, last_used) VALUES (?, ?, ?, ?)",
+                    [(self.model_name, h, slot, now) for h, slot in zip(new, free_slots)]
+                )
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def stats(self):
+        total = self.hits + self.misses
+        with self._lock:
+            entries = self._db.execute("SELECT COUNT(*) FROM embeddings WHERE model = ?",
+                                       (self.model_name,)).fetchone()[0]
+            meta = self._meta()
+        return {
+            "entries": entries,
+            "capacity": meta[1] if meta else 0,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+class CachedEmbeddings:
+    """
+    Drop-in wrapper around a LangChain embeddings model that serves embed_documents from an EmbeddingStore.
+    Only misses reach the model. Queries pass straight through because QueryEmbeddingCache
+    already handles them and one-off questions would only churn the store.
+    """
+
+    def __init__(self, model, store):
+        self.model = model
+        self.store = store
+
+    def embed_documents(self, texts):
+        texts = list(texts)
+        vectors = self.store.get_many(texts)
+        missing = [i for i, v in enumerate(vectors) if v is None]
+        if missing:
+            # identical texts in one batch are embedded once
+            unique = list(dict.fromkeys(texts[i] for i in missing))
+            computed = dict(zip(unique, self.model.embed_documents(unique)))
+            self.store.put_many(unique, [computed[t] for t in unique])
+            for i in missing:
+                vectors[i] = computed[texts[i]]
+        return [list(map(float, v)) for v in vectors]
+
+    def embed_query(self, text):
+        return self.model.embed_query(text)
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
@@ -12,17 +12,14 @@ from langchain_together import ChatTogether
 
 parent_dir = Path(__file__).resolve().parent.parent
 sys.path.append(str(parent_dir))
-from database.connection_pool import ConnectionPool
-
-pool = ConnectionPool()
+from database.connection_pool import get_pool
 
 def fetch_all_messages():
     """
     Pulls everything from the 'messages' table and returns a list of dictionaries,
-    each containing the 'text' and 'category' fields.
+    each containing the 'id', 'text' and 'category' fields.
     """
-    conn = pool.get_connection()
-    with conn.cursor() as cur:
+    with get_pool().connection() as conn, conn.cursor() as cur:
         cur.execute("SELECT * FROM messages;")
         rows = cur.fetchall()
         colnames = [desc[0] for desc in cur.description]
@@ -31,6 +28,7 @@ def fetch_all_messages():
         for row in rows:
             record = dict(zip(colnames, row))
             messages.append({
+                "id": record.get("id"),
                 "text": record.get("text"),
                 "category": record.get("category")
             })
@@ -38,7 +36,97 @@ def fetch_all_messages():
     return messages
 
 
+def fetch_messages_changed(since, overlap_seconds=0):
+    """
+    Rows inserted or edited at or after `since` (a messages.updated_at value, None for every row) minus
+    `overlap_seconds`, as (id, text, category, ts, channel, thread_ts, updated_at) dicts in id order.
+    The overlap re-reads recent rows, so ones committed late by a longer transaction aren't missed.
+    """
+    with get_pool().connection() as conn, conn.cursor() as cur:
+        if since is None:
+            cur.execute("SELECT id, text, category, ts, channel, thread_ts, updated_at FROM messages ORDER BY id;")
+        else:
+            cur.execute("""
+                SELECT id, text, category, ts, channel, thread_ts, updated_at FROM messages
+                WHERE updated_at >= %s - %s * interval '1 second' ORDER BY id;
+            """, (since, overlap_seconds))
+        rows = [{"id": row[0], "text": row[1], "category": row[2], "ts": row[3], "channel": row[4],
+                 "thread_ts": row[5], "updated_at": row[6]} for row in cur.fetchall()]
+    return rows
+
+
+def fetch_labelled_messages(since, sources, overlap_seconds=0):
+    """
+    Rows whose category_source is one of `sources`, inserted or edited at or after `since` (a messages.updated_at
+    value, None for every row) minus `overlap_seconds`, as (id, text, category, updated_at) dicts in id order.
+    """
+    with get_pool().connection() as conn, conn.cursor() as cur:
+        if since is None:
+            cur.execute("""
+                SELECT id, text, category, updated_at FROM messages
+                WHERE category_source = ANY(%s) ORDER BY id;
+            """, (list(sources),))
+        else:
+            cur.execute("""
+                SELECT id, text, category, updated_at FROM messages
+                WHERE category_source = ANY(%s) AND updated_at >= %s - %s * interval '1 second' ORDER BY id;
+            """, (list(sources), since, overlap_seconds))
+        rows = [{"id": row[0], "text": row[1], "category": row[2], "updated_at": row[3]} for row in cur.fetchall()]
+    return rows
+
+
+def fetch_message_timestamps(last_id, limit):
+    """Up to `limit` rows with id > last_id as (id, msg_key, ts), oldest first."""
+    with get_pool().connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT id, msg_key, ts FROM messages WHERE id > %s ORDER BY id LIMIT %s;", (last_id, limit))
+        rows = [{"id": row[0], "msg_key": row[1], "ts": row[2]} for row in cur.fetchall()]
+    return rows
+
+
+def fetch_message_rows(last_id, limit):
+    """
+    Up to `limit` rows with id > last_id as message dicts (id, text, category, ts, team, user, channel,
+    thread_ts), oldest first. The same fields an export record has, for rebuilding the vector index.
+    """
+    with get_pool().connection() as conn, conn.cursor() as cur:
+        cur.execute("""
+            SELECT id, text, category, ts, team, username, channel, thread_ts
+            FROM messages WHERE id > %s ORDER BY id LIMIT %s;
+        """, (last_id, limit))
+        rows = [{"id": row[0], "text": row[1], "category": row[2], "ts": row[3], "team": row[4], "user": row[5],
+                 "channel": row[6], "thread_ts": row[7]} for row in cur.fetchall()]
+    return rows
+
+
+def fetch_thread_messages(threads):
+    """
+    Every stored message of the given (channel, thread_ts) threads, as fetch_message_rows dicts in id order.
+    Looked up on messages_thread_idx, so threads without a channel aren't found.
+    """
+    threads = [(channel, thread_ts) for channel, thread_ts in threads if channel]
+    if not threads:
+        return []
+    with get_pool().connection() as conn, conn.cursor() as cur:
+        cur.execute("""
+            SELECT m.id, m.text, m.category, m.ts, m.team, m.username, m.channel, m.thread_ts
+            FROM messages m JOIN unnest(%s::text[], %s::numeric[]) AS t(channel, thread_ts)
+                ON m.channel = t.channel AND m.thread_ts = t.thread_ts
+            ORDER BY m.id;
+        """, ([channel for channel, _ in threads], [thread_ts for _, thread_ts in threads]))
+        rows = [{"id": row[0], "text": row[1], "category": row[2], "ts": row[3], "team": row[4], "user": row[5],
+                 "channel": row[6], "thread_ts": row[7]} for row in cur.fetchall()]
+    return rows
+
+
+def count_messages_through(last_id):
+    """Number of rows with id <= last_id, drops below what an index consumed once rows are deleted."""
+    with get_pool().connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT COUNT(*) FROM messages WHERE id <= %s;", (last_id,))
+        count = cur.fetchone()[0]
+    return count
+
+
 def main():
     slack_messages = fetch_all_messages()
     print(f"Fetched {len(slack_messages)} messages.")
-    return slack_messages
\ No newline at end of file
+    return slack_messages
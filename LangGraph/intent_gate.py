@@ -0,0 +1,238 @@
+'''cheap local gate in front of the should_respond LLM call - decides the obvious messages itself and escalates the rest'''
+import os
+import re
+import sys
+import json
+import random
+import argparse
+from pathlib import Path
+
+import numpy as np
+
+INTENT_GATE_ENABLED = os.getenv("INTENT_GATE_ENABLED", "true").lower() == "true"
+# the gate answers on its own only when P(should respond) is outside [skip, respond]
+INTENT_GATE_RESPOND_THRESHOLD = float(os.getenv("INTENT_GATE_RESPOND_THRESHOLD", "0.9"))
+INTENT_GATE_SKIP_THRESHOLD = float(os.getenv("INTENT_GATE_SKIP_THRESHOLD", "0.1"))
+INTENT_GATE_MODEL_PATH = Path(os.getenv(
+    "INTENT_GATE_MODEL_PATH",
+    Path(__file__).resolve().parent / "models" / "intent_gate.npz"
+))
+
+ACKNOWLEDGEMENTS = {
+    "thanks", "thank you", "thanks so much", "thank you so much", "thanks all", "thanks everyone",
+    "ty", "thx", "tysm", "ok", "okay", "k", "got it", "sounds good", "awesome", "great", "cool",
+    "nice", "perfect", "amazing", "love this", "lol", "haha", "yay", "congrats", "congratulations",
+    "welcome", "will do", "noted", "+1", "same", "yes", "no", "done",
+}
+MENTION = re.compile(r"<[@#!][^>]*>")          # <@U123>, <#C123|general>, <!here>
+EMOJI_CODE = re.compile(r":[a-z0-9_+\-']+:")    # :tada: :+1::skin-tone-2:
+BROADCAST = re.compile(r"^\s*<!(channel|here|everyone)>", re.IGNORECASE)
+QUESTION_WORDS = re.compile(
+    r"^(how|what|when|where|who|whom|which|why|can|could|is|are|do|does|did|will|would|should|may|has|have)\b",
+    re.IGNORECASE
+)
+
+
+def heuristic_decision(text):
+    """
+    Rule-based decisions for messages that never need the LLM.
+    Returns (intent, confidence) or (None, 0.0) when the rules have no opinion.
+    """
+    text = (text or "").strip()
+    stripped = EMOJI_CODE.sub("", MENTION.sub("", text)).strip()
+
+    # empty, emoji-only or mention-only messages
+    if not re.search(r"[A-Za-z0-9]", stripped):
+        return "skip", 0.99
+
+    normalized = re.sub(r"[^\w\s+]", "", stripped.lower()).strip()
+    normalized = re.sub(r"\s+", " ", normalized)
+    if normalized in ACKNOWLEDGEMENTS:
+        return "skip", 0.97
+
+    # @channel/@here broadcasts without a question are announcements
+    if BROADCAST.match(text) and "?" not in text:
+        return "skip", 0.9
+
+    return None, 0.0
+
+
+def message_features(text):
+    """A handful of shape features that sit alongside the sentence embedding."""
+    text = (text or "").strip()
+    words = text.split()
+    return np.array([
+        1.0 if "?" in text else 0.0,
+        1.0 if QUESTION_WORDS.match(text) else 0.0,
+        min(len(words), 100) / 100.0,
+        1.0 if BROADCAST.match(text) else 0.0,
+        1.0 if re.search(r"https?://", text) else 0.0,
+    ], dtype=np.float32)
+
+
+class IntentGate:
+    """Logistic regression over [embedding, shape features] predicting whether the LLM would respond."""
+
+    def __init__(self, embed_fn, weights=None, bias=0.0,
+                 respond_threshold=INTENT_GATE_RESPOND_THRESHOLD, skip_threshold=INTENT_GATE_SKIP_THRESHOLD):
+        self.embed_fn = embed_fn
+        self.weights = weights
+        self.bias = bias
+        self.respond_threshold = respond_threshold
+        self.skip_threshold = skip_threshold
+        self.decided = 0
+        self.escalated = 0
+
+    @classmethod
+    def load(cls, embed_fn, path=INTENT_GATE_MODEL_PATH, **kwargs):
+        """Load a trained gate. Without a model file only the heuristics are used."""
+        if not Path(path).exists():
+            print(f"Intent gate model not found at {path}, using heuristics only.")
+            return cls(embed_fn, **kwargs)
+        data = np.load(path)
+        return cls(embed_fn, weights=data["weights"], bias=float(data["bias"]), **kwargs)
+
+    def save(self, path=INTENT_GATE_MODEL_PATH):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        np.savez(path, weights=self.weights, bias=np.float32(self.bias))
+        print(f"Saved intent gate model to {path}")
+
+    def _vectors(self, texts):
+        embeddings = np.asarray([self.embed_fn(t) for t in texts], dtype=np.float32)
+        features = np.stack([message_features(t) for t in texts])
+        return np.hstack([embeddings, features])
+
+    def probability(self, text):
+        """P(the LLM would answer this message), or None when no model is trained."""
+        if self.weights is None:
+            return None
+        x = self._vectors([text])[0]
+        return float(1.0 / (1.0 + np.exp(-(x @ self.weights + self.bias))))
+
+    def decide(self, text):
+        """
+        Returns (intent, confidence, source). intent is None when the message is uncertain and
+        should be escalated to the LLM.
+        """
+        intent, confidence = heuristic_decision(text)
+        if intent:
+            self.decided += 1
+            return intent, confidence, "heuristic"
+
+        p = self.probability(text)
+        if p is not None:
+            if p >= self.respond_threshold:
+                self.decided += 1
+                return "should_respond", p, "model"
+            if p <= self.skip_threshold:
+                self.decided += 1
+                return "skip", 1.0 - p, "model"
+
+        self.escalated += 1
+        return None, p or 0.0, "llm"
+
+    def fit(self, texts, labels, epochs=300, lr=0.5, l2=1e-3):
+        """Train on (message, LLM said yes?) pairs with plain batch gradient descent."""
+        x = self._vectors(texts)
+        y = np.asarray(labels, dtype=np.float32)
+        self.weights = np.zeros(x.shape[1], dtype=np.float32)
+        self.bias = 0.0
+        for _ in range(epochs):
+            p = 1.0 / (1.0 + np.exp(-(x @ self.weights + self.bias)))
+            error = p - y
+            self.weights -= lr * (x.T @ error / len(y) + l2 * self.weights)
+            self.bias -= lr * float(error.mean())
+        return self
+
+    def stats(self):
+        total = self.decided + self.escalated
+        return {
+            "decided_locally": self.decided,
+            "escalated_to_llm": self.escalated,
+            "llm_calls_avoided_pct": 100.0 * self.decided / total if total else 0.0,
+        }
+
+
+# ------- offline training / evaluation ----------
+
+def sample_messages(limit, seed, holdout_every, holdout):
+    """
+    Up to `limit` message texts from the training split (every id but each `holdout_every`-th) or, with
+    `holdout`, from the held-out one. The split is fixed by id, so evaluation never sees a training message.
+    """
+    from .fetch_db_messages import fetch_all_messages
+    texts = [m["text"] for m in fetch_all_messages()
+             if m.get("text") and (m["id"] % holdout_every == 0) == holdout]
+    random.Random(seed).shuffle(texts)
+    return texts[:limit]
+
+def llm_labels(texts):
+    from .common_workflow import llm_should_respond
+    labels = []
+    for i, text in enumerate(texts):
+        labels.append(llm_should_respond(text))
+        if (i + 1) % 25 == 0:
+            print(f"  labelled {i + 1}/{len(texts)}")
+    return labels
+
+def train(args):
+    from .resources import get_embedding_model
+    embed_fn = get_embedding_model().embed_query
+
+    texts = sample_messages(args.limit, args.seed, args.holdout_every, holdout=False)
+    # heuristic cases never reach the model, so don't spend LLM calls labelling them
+    texts = [t for t in texts if heuristic_decision(t)[0] is None]
+    print(f"Labelling {len(texts)} historical messages with the should_respond LLM...")
+    labels = llm_labels(texts)
+
+    gate = IntentGate(embed_fn).fit(texts, labels)
+    gate.save(args.model)
+
+def evaluate(args):
+    from .resources import get_embedding_model
+    gate = IntentGate.load(get_embedding_model().embed_query, path=args.model,
+                           respond_threshold=args.respond_threshold, skip_threshold=args.skip_threshold)
+
+    # only the held-out ids, which train never samples
+    texts = sample_messages(args.limit, args.seed, args.holdout_every, holdout=True)
+    labels = llm_labels(texts)
+
+    agree_local, decided = 0, 0
+    for text, llm_yes in zip(texts, labels):
+        intent, _, source = gate.decide(text)
+        if intent is None:
+            continue
+        decided += 1
+        agree_local += int((intent == "should_respond") == llm_yes)
+
+    report = {
+        "messages": len(texts),
+        "llm_calls_avoided_pct": round(100.0 * decided / len(texts), 1) if texts else 0.0,
+        "agreement_on_local_decisions_pct": round(100.0 * agree_local / decided, 1) if decided else None,
+        # escalated messages get the LLM's answer, so they always agree
+        "overall_agreement_pct": round(100.0 * (agree_local + len(texts) - decided) / len(texts), 1) if texts else None,
+        "respond_threshold": gate.respond_threshold,
+        "skip_threshold": gate.skip_threshold,
+    }
+    print(json.dumps(report, indent=2))
+    return report
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Train or evaluate the local should_respond gate.")
+    parser.add_argument("command", choices=["train", "evaluate"])
+    parser.add_argument("--limit", type=int, default=500, help="number of historical messages to sample")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--holdout-every", type=int, default=10,
+                        help="every n-th message id is held out of training and used for evaluation")
+    parser.add_argument("--model", type=Path, default=INTENT_GATE_MODEL_PATH)
+    parser.add_argument("--respond-threshold", type=float, default=INTENT_GATE_RESPOND_THRESHOLD)
+    parser.add_argument("--skip-threshold", type=float, default=INTENT_GATE_SKIP_THRESHOLD)
+    args = parser.parse_args(argv)
+
+    if args.command == "train":
+        train(args)
+    else:
+        evaluate(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,297 @@
+import os
+import re
+import math
+import time
+import threading
+from decimal import Decimal, InvalidOperation
+from collections import Counter, defaultdict
+
+LEXICAL_REFRESH_SECONDS = float(os.getenv("LEXICAL_REFRESH_SECONDS", "60"))
+# each refresh re-reads rows stamped this long before the last one it saw, catching late commits
+LEXICAL_WATERMARK_OVERLAP_SECONDS = float(os.getenv("LEXICAL_WATERMARK_OVERLAP_SECONDS", "300"))
+BM25_K1 = float(os.getenv("BM25_K1", "1.5"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+# group a thread's question and replies into one indexed document instead of one document per message
+THREAD_DOCUMENTS_ENABLED = os.getenv("THREAD_DOCUMENTS_ENABLED", "true").lower() == "true"
+# longer threads are split into several documents; all-MiniLM-L6-v2 reads ~256 word pieces (~1000 characters)
+THREAD_DOC_MAX_CHARS = int(os.getenv("THREAD_DOC_MAX_CHARS", "1000"))
+MICROSECOND = Decimal("0.000001")
+
+TOKEN = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text):
+    return TOKEN.findall((text or "").lower())
+
+# document format shared by the Chroma ingest (create_and_store_embedding) and the BM25 index
+def document_text(message, category):
+    return f"text: {message}\ncategory: {category}"
+
+def slack_ts(value):
+    """Slack ts as an exact Decimal, so JSON strings and NUMERIC column values compare equal. None if missing."""
+    if value in (None, ""):
+        return None
+    try:
+        return Decimal(str(value)).quantize(MICROSECOND)
+    except InvalidOperation:
+        return None
+
+def thread_of(message):
+    """(channel, thread_ts) of the thread a message belongs to, None for a standalone message."""
+    if not THREAD_DOCUMENTS_ENABLED:
+        return None
+    thread_ts = slack_ts(message.get("thread_ts"))
+    return (message.get("channel") or "", thread_ts) if thread_ts is not None else None
+
+def clip(text, limit):
+    return text if len(text) <= limit else text[:max(limit - 1, 0)].rstrip() + "…"
+
+def thread_documents(messages, max_chars=THREAD_DOC_MAX_CHARS):
+    """
+    Question/reply documents for one thread's message dicts (text, category, ts). The earliest message
+    is the question and its category labels the thread. Replies follow in order, and a thread longer than
+    `max_chars` continues in further documents that repeat the question.
+    Returns (question message, [document text, ...]).
+    """
+    ordered = sorted(messages, key=lambda m: slack_ts(m.get("ts")) or Decimal("Infinity"))
+    question = ordered[0]
+    head = f"question: {clip(question.get('text') or '', max_chars // 2)}\n"
+    tail = f"category: {question.get('category') or 'Unknown'}"
+    budget = max(max_chars - len(head) - len(tail), 1)
+
+    parts, current, size = [], [], 0
+    for reply in ordered[1:]:
+        line = f"reply: {clip(reply.get('text') or '', budget - len('reply: ') - 1)}\n"
+        if current and size + len(line) > budget:
+            parts.append(current)
+            current, size = [], 0
+        current.append(line)
+        size += len(line)
+    parts.append(current)
+    return question, [head + "".join(lines) + tail for lines in parts]
+
+
+class BM25Index:
+    """
+    In-process BM25 inverted index over the messages table.
+    Documents are keyed by their formatted text so rows re-inserted with identical content don't double count.
+    Messages in a thread are indexed as the thread's question/reply documents, rebuilt as replies arrive.
+    Each row's contribution is remembered by messages.id, so a row edited in place replaces its old text.
+    """
+
+    # everything refresh() builds, swapped as a whole when a fresh index replaces this one
+    STATE = ("documents", "lengths", "postings", "total_length", "references", "threads", "thread_docs",
+             "rows", "last_row_id", "updated_through")
+
+    def __init__(self, k1=BM25_K1, b=BM25_B):
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.RLock()          # guards the index structures, only held for in-memory work
+        self._refresh_lock = threading.Lock()   # one refresh at a time
+        self._reset()
+
+    def _reset(self):
+        self.documents = {}                 # {doc: metadata}
+        self.lengths = {}                   # {doc: token count}
+        self.postings = defaultdict(dict)   # {term: {doc: term frequency}}
+        self.total_length = 0
+        self.references = Counter()         # {doc: messages/threads that produced it}
+        self.threads = defaultdict(dict)    # {(channel, thread_ts): {row id: message}}
+        self.thread_docs = {}               # {(channel, thread_ts): [doc, ...]} currently indexed for the thread
+        self.rows = {}                      # {row id: (row fields, standalone doc, thread)} what each row contributed
+        self.last_row_id = 0                # highest messages.id folded into the index
+        self.updated_through = None         # highest messages.updated_at folded into the index
+        self.last_refresh = None            # monotonic time of the last Postgres refresh, None until first use
+        self.stale = False
+
+    def _add_document(self, doc, metadata):
+        self.references[doc] += 1
+        if doc in self.documents:
+            return False
+        terms = Counter(tokenize(doc))
+        self.documents[doc] = metadata
+        self.lengths[doc] = sum(terms.values())
+        self.total_length += self.lengths[doc]
+        for term, tf in terms.items():
+            self.postings[term][doc] = tf
+        return True
+
+    def _remove_document(self, doc):
+        self.references[doc] -= 1
+        if self.references[doc] > 0:
+            return
+        del self.references[doc]
+        for term in set(tokenize(doc)):
+            postings = self.postings.get(term)
+            if postings is not None:
+                postings.pop(doc, None)
+                if not postings:
+                    del self.postings[term]
+        self.total_length -= self.lengths.pop(doc)
+        del self.documents[doc]
+
+    def add(self, message, category):
+        """Index one standalone message. Returns False if an identical document is already indexed."""
+        with self._lock:
+            return self._add_document(document_text(message, category), {"text": message, "category": category})
+
+    def _rebuild_thread(self, thread):
+        for doc in self.thread_docs.pop(thread, []):
+            self._remove_document(doc)
+        members = list(self.threads[thread].values())
+        if not members:
+            del self.threads[thread]  # every message of the thread was edited out of it
+            return 0
+        if len(members) == 1:
+            # a lone thread message (replies not seen yet) is indexed like any other message
+            question, docs = members[0], [document_text(members[0]["text"], members[0]["category"])]
+        else:
+            question, docs = thread_documents(members)
+        metadata = {"text": question["text"], "category": question["category"]}
+        self.thread_docs[thread] = docs
+        return sum(self._add_document(doc, metadata) for doc in docs)
+
+    def _forget_row(self, row_id, touched):
+        _, doc, thread = self.rows.pop(row_id)
+        if doc is not None:
+            self._remove_document(doc)
+        if thread is not None:
+            self.threads[thread].pop(row_id, None)
+            touched.add(thread)
+
+    def add_rows(self, rows):
+        """
+        Index rows of the messages table (id, text, category and optionally ts, channel, thread_ts, updated_at).
+        A row already indexed with other values replaces what it contributed before, an unchanged one is skipped.
+        Each thread touched by `rows` is rebuilt once, however many of its replies arrived.
+        Returns the number of new documents.
+        """
+        added, touched = 0, set()
+        with self._lock:
+            for row in rows:
+                row_id = row["id"]
+                fields = (row.get("text"), row.get("category"), row.get("ts"), row.get("channel"), row.get("thread_ts"))
+                if row_id in self.rows:
+                    if self.rows[row_id][0] == fields:
+                        continue
+                    self._forget_row(row_id, touched)
+                self.last_row_id = max(self.last_row_id, row_id)
+                if row.get("updated_at") is not None and (self.updated_through is None
+                                                          or row["updated_at"] > self.updated_through):
+                    self.updated_through = row["updated_at"]
+                if not row.get("text"):
+                    self.rows[row_id] = (fields, None, None)
+                    continue
+                category = row.get("category") or "Unknown"
+                thread = thread_of(row)
+                if thread is None:
+                    doc = document_text(row["text"], category)
+                    added += self._add_document(doc, {"text": row["text"], "category": category})
+                    self.rows[row_id] = (fields, doc, None)
+                    continue
+                self.threads[thread][row_id] = {"text": row["text"], "category": category, "ts": row.get("ts")}
+                self.rows[row_id] = (fields, None, thread)
+                touched.add(thread)
+            for thread in touched:
+                added += self._rebuild_thread(thread)
+        return added
+
+    @property
+    def loaded(self):
+        return self.last_refresh is not None
+
+    def search(self, query, k=20):
+        """Return up to k (document, metadata, score) tuples, best first."""
+        with self._lock:
+            n = len(self.documents)
+            if not n:
+                return []
+            avg_length = self.total_length / n
+            scores = defaultdict(float)
+            for term in set(tokenize(query)):
+                postings = self.postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+                for doc, tf in postings.items():
+                    norm = self.k1 * (1 - self.b + self.b * self.lengths[doc] / avg_length)
+                    scores[doc] += idf * tf * (self.k1 + 1) / (tf + norm)
+            best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+            return [(doc, self.documents[doc], score) for doc, score in best]
+
+    def mark_stale(self):
+        """Make the next search check Postgres right away (e.g. after an upload or a range delete)."""
+        with self._lock:
+            self.stale = self.loaded
+
+    def _due(self):
+        return (not self.loaded or self.stale
+                or time.monotonic() - self.last_refresh >= LEXICAL_REFRESH_SECONDS)
+
+    def _rebuild(self):
+        """Load every row into a fresh index without holding the lock, then swap it in."""
+        from .fetch_db_messages import fetch_messages_changed
+
+        start = time.perf_counter()
+        fresh = BM25Index(self.k1, self.b)
+        fresh.add_rows(fetch_messages_changed(None))
+        with self._lock:
+            for name in self.STATE:
+                setattr(self, name, getattr(fresh, name))
+            self.last_refresh = time.monotonic()
+        print(f"Lexical index: loaded {len(fresh.rows)} rows in {time.perf_counter() - start:.2f}s "
+              f"({len(fresh.documents)} documents).")
+
+    def refresh(self, force=False):
+        """
+        Fold in rows inserted or edited since the last refresh (at most every LEXICAL_REFRESH_SECONDS),
+        found through messages.updated_at. The first load, and a rebuild after rows were deleted (a range
+        delete ran), happen in a fresh index swapped in once complete, so searches keep answering from the
+        current one. Only one refresh runs at a time, other callers search what is there instead of waiting
+        (`force` waits for a running refresh and then runs its own).
+        """
+        from .fetch_db_messages import fetch_messages_changed, count_messages_through
+
+        if not force and not self._due():
+            return
+        if not self._refresh_lock.acquire(blocking=force):
+            return
+        try:
+            if not force and not self._due():
+                return
+            self.stale = False
+            if not self.loaded:
+                # updated_at and thread_ts are read below, fail clearly on a table that hasn't been migrated
+                from database.schema_manager import SchemaManager
+                with SchemaManager() as schema_manager:
+                    schema_manager.check_schema()
+                self._rebuild()
+                return
+            if count_messages_through(self.last_row_id) < len(self.rows):
+                print("Lexical index: rows were deleted, rebuilding.")
+                self._rebuild()
+                return
+
+            start = time.perf_counter()
+            rows = fetch_messages_changed(self.updated_through, LEXICAL_WATERMARK_OVERLAP_SECONDS)
+            added = self.add_rows(rows)
+            self.last_refresh = time.monotonic()
+            if added:
+                print(f"Lexical index: folded in {added} new documents in {time.perf_counter() - start:.2f}s "
+                      f"({len(self.documents)} documents).")
+        finally:
+            self._refresh_lock.release()
+
+
+def reciprocal_rank_fusion(rankings, weights=None, k=60):
+    """
+    Fuse several ranked lists of keys. `rankings` is {retriever name: [key, ...]} best first,
+    `weights` scales each retriever's contribution. Returns keys ordered by fused score.
+    """
+    weights = weights or {}
+    scores = defaultdict(float)
+    for name, keys in rankings.items():
+        weight = weights.get(name, 1.0)
+        for rank, key in enumerate(keys):
+            scores[key] += weight / (k + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)
@@ -0,0 +1,184 @@
+'''in-process latency/token metrics for the LangGraph workflows, rendered in Prometheus text format'''
+import os
+import time
+import threading
+from collections import deque, defaultdict
+from functools import wraps
+
+# when disabled every recording call returns immediately and nodes are left unwrapped
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+# percentiles are computed over the most recent samples of each series
+METRICS_WINDOW = int(os.getenv("METRICS_WINDOW", "2048"))
+METRICS_PREFIX = "rtc_"
+QUANTILES = (0.5, 0.95, 0.99)
+
+_lock = threading.Lock()
+_histograms = {}               # {(name, labels): [deque of samples, count, sum]}
+_counters = defaultdict(float)  # {(name, labels): value}
+_collectors = []               # callables returning {gauge name: value}
+_help = {}
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+def describe(name, text):
+    _help[name] = text
+
+def observe(name, value, **labels):
+    """Record one sample (seconds, tokens, documents...) into a windowed histogram."""
+    if not METRICS_ENABLED:
+        return
+    key = _key(name, labels)
+    with _lock:
+        series = _histograms.get(key)
+        if series is None:
+            series = _histograms[key] = [deque(maxlen=METRICS_WINDOW), 0, 0.0]
+        series[0].append(value)
+        series[1] += 1
+        series[2] += value
+
+def inc(name, amount=1, **labels):
+    if not METRICS_ENABLED:
+        return
+    with _lock:
+        _counters[_key(name, labels)] += amount
+
+def register_collector(fn):
+    """fn() -> {gauge name: value}, evaluated at scrape time (cache sizes, queue depth, ...)."""
+    _collectors.append(fn)
+
+def percentile(samples, q):
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, int(round(q * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+# ------- instrumentation helpers ----------
+
+def instrument_node(graph, node, fn):
+    """Wrap a LangGraph node so its latency and failures are recorded. Returns fn untouched when disabled."""
+    if not METRICS_ENABLED:
+        return fn
+
+    @wraps(fn)
+    def wrapper(state):
+        start = time.perf_counter()
+        try:
+            return fn(state)
+        except Exception:
+            inc("langgraph_node_errors_total", graph=graph, node=node)
+            raise
+        finally:
+            observe("langgraph_node_seconds", time.perf_counter() - start, graph=graph, node=node)
+    return wrapper
+
+def record_llm_call(call, response, seconds):
+    """Latency plus prompt/completion token counts reported by the provider for one LLM call."""
+    if not METRICS_ENABLED:
+        return
+    observe("llm_call_seconds", seconds, call=call)
+    usage = getattr(response, "usage_metadata", None) or {}
+    prompt_tokens = usage.get("input_tokens")
+    completion_tokens = usage.get("output_tokens")
+    if prompt_tokens is None:
+        token_usage = (getattr(response, "response_metadata", None) or {}).get("token_usage") or {}
+        prompt_tokens = token_usage.get("prompt_tokens")
+        completion_tokens = token_usage.get("completion_tokens")
+    record_llm_tokens(call, prompt_tokens, completion_tokens)
+
+def record_llm_tokens(call, prompt_tokens, completion_tokens):
+    if not METRICS_ENABLED:
+        return
+    if prompt_tokens is not None:
+        observe("llm_prompt_tokens", prompt_tokens, call=call)
+        inc("llm_prompt_tokens_total", prompt_tokens, call=call)
+    if completion_tokens is not None:
+        observe("llm_completion_tokens", completion_tokens, call=call)
+        inc("llm_completion_tokens_total", completion_tokens, call=call)
+
+
+# ------- export ----------
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"')
+
+def _format_labels(labels, extra=None):
+    pairs = list(labels) + list((extra or {}).items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+def snapshot():
+    """Percentiles/counters as a plain dict, handy for logging."""
+    with _lock:
+        histograms = {key: (list(s[0]), s[1], s[2]) for key, s in _histograms.items()}
+        counters = dict(_counters)
+    summary = {}
+    for (name, labels), (samples, count, total) in histograms.items():
+        label_text = ",".join(f"{k}={v}" for k, v in labels)
+        summary[f"{name}{{{label_text}}}"] = {
+            "count": count,
+            **{f"p{int(q * 100)}": percentile(samples, q) for q in QUANTILES},
+        }
+    for (name, labels), value in counters.items():
+        label_text = ",".join(f"{k}={v}" for k, v in labels)
+        summary[f"{name}{{{label_text}}}"] = value
+    return summary
+
+def render_prometheus():
+    """Prometheus text exposition format (summaries with p50/p95/p99, counters and gauges)."""
+    with _lock:
+        histograms = {key: (list(s[0]), s[1], s[2]) for key, s in _histograms.items()}
+        counters = dict(_counters)
+
+    lines = []
+    seen_types = set()
+    def header(name, kind):
+        if name in seen_types:
+            return
+        seen_types.add(name)
+        if name in _help:
+            lines.append(f"# HELP {METRICS_PREFIX}{name} {_help[name]}")
+        lines.append(f"# TYPE {METRICS_PREFIX}{name} {kind}")
+
+    for (name, labels), (samples, count, total) in sorted(histograms.items()):
+        header(name, "summary")
+        for q in QUANTILES:
+            lines.append(f"{METRICS_PREFIX}{name}{_format_labels(labels, {'quantile': q})} {percentile(samples, q)}")
+        lines.append(f"{METRICS_PREFIX}{name}_sum{_format_labels(labels)} {total}")
+        lines.append(f"{METRICS_PREFIX}{name}_count{_format_labels(labels)} {count}")
+
+    for (name, labels), value in sorted(counters.items()):
+        header(name, "counter")
+        lines.append(f"{METRICS_PREFIX}{name}{_format_labels(labels)} {value}")
+
+    for collector in _collectors:
+        try:
+            gauges = collector()
+        except Exception as e:
+            print(f"[Metrics Error] collector {getattr(collector, '__name__', collector)} failed: {e}")
+            continue
+        for name, value in gauges.items():
+            header(name, "gauge")
+            lines.append(f"{METRICS_PREFIX}{name} {value}")
+
+    return "\n".join(lines) + "\n"
+
+def flask_metrics_view():
+    """View function for a Flask `/metrics` route."""
+    from flask import Response
+    return Response(render_prometheus(), mimetype="text/plain; version=0.0.4")
+
+
+describe("langgraph_node_seconds", "Wall time of each LangGraph node.")
+describe("langgraph_node_errors_total", "LangGraph node invocations that raised.")
+describe("llm_call_seconds", "LLM round trip time per call site.")
+describe("llm_prompt_tokens", "Prompt tokens per LLM call.")
+describe("llm_completion_tokens", "Completion tokens per LLM call.")
+describe("chroma_query_seconds", "Chroma query latency.")
+describe("retrieval_documents", "Documents returned per retriever.")
+describe("slack_stream_errors_total", "Streamed Slack answers that failed part way.")
+describe("slack_events_dropped_total", "Slack events turned away by a full worker queue (left for Slack to redeliver).")
@@ -0,0 +1,54 @@
+import os
+import threading
+from collections import OrderedDict
+
+QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", "2048"))
+
+
+class QueryEmbeddingCache:
+    """
+    In-process LRU cache of question -> embedding vector.
+    Queries are embedded locally with the same model used at ingest, so Chroma never embeds server side.
+    """
+
+    def __init__(self, embed_fn, max_entries=QUERY_EMBEDDING_CACHE_SIZE):
+        self.embed_fn = embed_fn
+        self.max_entries = max_entries
+        self._vectors = OrderedDict()  # {text: vector}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def embed(self, text):
+        """Return the embedding for `text`, computing it only on a cache miss."""
+        with self._lock:
+            vector = self._vectors.get(text)
+            if vector is not None:
+                self._vectors.move_to_end(text)
+                self.hits += 1
+                return vector
+            self.misses += 1
+
+        # embed outside the lock so concurrent workers don't serialize on the model
+        vector = list(self.embed_fn(text))
+
+        with self._lock:
+            self._vectors[text] = vector
+            self._vectors.move_to_end(text)
+            while len(self._vectors) > self.max_entries:
+                self._vectors.popitem(last=False)
+        return vector
+
+    def clear(self):
+        with self._lock:
+            self._vectors.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._vectors),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
@@ -1,37 +1,158 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from langgraph.graph import StateGraph
-from .common_workflow import QueryState, should_respond, retrieve_context, generate_response
+from .common_workflow import QueryState, should_respond, local_intent, llm_should_respond, retrieve_context, generate_response, stream_response, answer_cache
+from .answer_cache import ANSWER_CACHE_ENABLED
+from .metrics import instrument_node
 
-graph = StateGraph(QueryState)
+# 'speculative' starts the Chroma retrieval alongside the should_respond LLM call (for messages the
+# local intent gate can't decide), 'sequential' only retrieves once the gate has said yes
+QUERY_EXECUTION_MODE = os.getenv("QUERY_EXECUTION_MODE", "speculative").lower()
 
-graph.add_node("should_respond", should_respond)
-graph.add_node("retrieve_context", retrieve_context)
-graph.add_node("respond", generate_response)
+# shared by speculative runs, retrievals for skipped messages are left to finish here in the background
+speculative_executor = ThreadPoolExecutor(max_workers=int(os.getenv("SPECULATIVE_WORKERS", "8")))
 
-graph.set_entry_point("should_respond")
+# wrap a node so its wall time ends up in state.timings (and in the latency histograms)
+def timed_node(name, fn):
+    def wrapper(state: QueryState):
+        start = time.perf_counter()
+        result = fn(state)
+        result.timings = {**(result.timings or {}), name: time.perf_counter() - start}
+        return result
+    return instrument_node("rag_bot", name, wrapper)
+
+# the local intent gate runs first; only messages it escalates to the LLM yes/no call
+# get their retrieval started alongside that call, keeping it only if we're going to answer
+def gate_and_retrieve(state: QueryState) -> QueryState:
+    start = time.perf_counter()
+    intent = local_intent(state.question)
+    gate_timings = {"local_intent": time.perf_counter() - start}
+    if intent == "skip":
+        return QueryState(question=state.question, intent=intent,
+                          timings={**gate_timings, "gate_and_retrieve": time.perf_counter() - start})
+
+    if intent == "should_respond":
+        # decided locally, nothing to overlap the retrieval with
+        retrieved = timed_node("retrieve_context", retrieve_context)(state.model_copy())
+    else:
+        retrieval = speculative_executor.submit(timed_node("retrieve_context", retrieve_context), state.model_copy())
+        gate_start = time.perf_counter()
+        intent = "should_respond" if llm_should_respond(state.question) else "skip"
+        gate_timings["should_respond"] = time.perf_counter() - gate_start
+        if intent != "should_respond":
+            # retrieval result is discarded, no need to wait for it
+            return QueryState(question=state.question, intent=intent,
+                              timings={**gate_timings, "gate_and_retrieve": time.perf_counter() - start})
+        retrieved = retrieval.result()
+
+    return QueryState(
+        question=state.question,
+        intent=intent,
+        category=retrieved.category,
+        response=retrieved.response,
+        timings={**gate_timings, **retrieved.timings, "gate_and_retrieve": time.perf_counter() - start}
+    )
 
 # edges differ if the query should actually be responded to by the LLM!
 def route_response(state: QueryState) -> str:
     return "retrieve_context" if state.intent == "should_respond" else "end"
 
-graph.add_conditional_edges("should_respond", route_response, {
-    "retrieve_context": "retrieve_context",
-    "end": "__end__"
-})
+def route_speculative(state: QueryState) -> str:
+    return "respond" if state.intent == "should_respond" else "end"
+
+# without a respond node the graph stops after retrieval, so the answer can be streamed by the caller
+def build_query_graph(mode=QUERY_EXECUTION_MODE, respond=True):
+    graph = StateGraph(QueryState)
+    if respond:
+        graph.add_node("respond", timed_node("respond", generate_response))
+    next_step = "respond" if respond else "__end__"
 
-graph.add_edge("retrieve_context", "respond")
+    if mode == "speculative":
+        graph.add_node("gate_and_retrieve", instrument_node("rag_bot", "gate_and_retrieve", gate_and_retrieve))
+        graph.set_entry_point("gate_and_retrieve")
+        graph.add_conditional_edges("gate_and_retrieve", route_speculative, {
+            "respond": next_step,
+            "end": "__end__"
+        })
+    elif mode == "sequential":
+        graph.add_node("should_respond", timed_node("should_respond", should_respond))
+        graph.add_node("retrieve_context", timed_node("retrieve_context", retrieve_context))
+        graph.set_entry_point("should_respond")
+        graph.add_conditional_edges("should_respond", route_response, {
+            "retrieve_context": "retrieve_context",
+            "end": "__end__"
+        })
+        graph.add_edge("retrieve_context", next_step)
+    else:
+        raise ValueError(f"Unknown QUERY_EXECUTION_MODE '{mode}', expected 'speculative' or 'sequential'.")
 
-rag_bot = graph.compile()
+    return graph.compile()
+
+rag_bot = build_query_graph()
+retrieval_bot = build_query_graph(respond=False)
 
 def invoke_question(text):
+    # near-repeats of recently answered questions skip the graph entirely
+    if ANSWER_CACHE_ENABLED:
+        cached = answer_cache.lookup(text)
+        if cached:
+            return cached
+
     input_question = QueryState(question=text)
+    start = time.perf_counter()
     final_state = rag_bot.invoke(input_question)
+    timings = {**(final_state.get("timings") or {}), "total": time.perf_counter() - start}
+    print(f"Stage timings ({QUERY_EXECUTION_MODE}): " + ", ".join(f"{k}={v:.3f}s" for k, v in timings.items()))
 
-    return {
+    result = {
         "should_respond": final_state.get("intent") == "should_respond",
         "response": final_state.get("response"),
-        "category": final_state.get("category")
+        "category": final_state.get("category"),
+        "timings": timings
     }
 
+    if ANSWER_CACHE_ENABLED and result["should_respond"] and result["response"]:
+        answer_cache.store(text, {k: v for k, v in result.items() if k != "timings"})
+
+    return result
+
+def invoke_question_streaming(text):
+    """
+    Same as invoke_question, but stops before generation. When the bot should respond (and the answer
+    isn't cached) the result carries a "stream" generator of response chunks instead of a "response".
+    """
+    if ANSWER_CACHE_ENABLED:
+        cached = answer_cache.lookup(text)
+        if cached:
+            return cached
+
+    start = time.perf_counter()
+    final_state = retrieval_bot.invoke(QueryState(question=text))
+    timings = {**(final_state.get("timings") or {}), "retrieval_total": time.perf_counter() - start}
+    print(f"Stage timings ({QUERY_EXECUTION_MODE}, streaming): " + ", ".join(f"{k}={v:.3f}s" for k, v in timings.items()))
+
+    result = {
+        "should_respond": final_state.get("intent") == "should_respond",
+        "response": None,
+        "category": final_state.get("category"),
+        "timings": timings
+    }
+    if not result["should_respond"]:
+        return result
+
+    def stream():
+        chunks = []
+        for chunk in stream_response(QueryState(**final_state)):
+            chunks.append(chunk)
+            yield chunk
+        # only complete answers are cached
+        if ANSWER_CACHE_ENABLED:
+            answer_cache.store(text, {"should_respond": True, "response": "".join(chunks), "category": result["category"]})
+
+    result["stream"] = stream()
+    return result
+
 # Example: Running the workflow
 def test_query_workflow():
     # intended to be a message that the llm DOES NOT respond to
@@ -40,6 +161,7 @@ def test_query_workflow():
     input_question = QueryState(question="Does RTC have any affinity groups? If so, for what groups?")
     response = rag_bot.invoke(input_question)
     print(response.get("response"))
+    print(response.get("timings"))
 
 if __name__ == "__main__":
-    test_query_workflow()
\ No newline at end of file
+    test_query_workflow()
@@ -0,0 +1,122 @@
+'''lazy registry for the heavy clients (LLM, embedding model, Chroma) so each process only loads what it uses'''
+import os
+import time
+import threading
+from dotenv import load_dotenv
+
+# measured from the first import of this module, which happens early in every entry point
+PROCESS_START = time.perf_counter()
+
+load_dotenv(dotenv_path='./.env')
+
+LLM_MODEL = "mistralai/Mistral-7B-Instruct-v0.2"
+EMBEDDING_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+COLLECTION_NAME = "slack-faqs"
+
+
+class LazyResource:
+    """Builds its value on first `get()` (thread-safe) and remembers how long that took."""
+
+    def __init__(self, name, factory):
+        self.name = name
+        self.factory = factory
+        self.load_seconds = None
+        self._value = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self.load_seconds is not None
+
+    def get(self):
+        if self.load_seconds is None:
+            with self._lock:
+                if self.load_seconds is None:
+                    start = time.perf_counter()
+                    self._value = self.factory()
+                    self.load_seconds = time.perf_counter() - start
+                    print(f"Loaded {self.name} in {self.load_seconds:.2f}s")
+        return self._value
+
+
+_registry = {}
+
+def register(name, factory):
+    _registry[name] = LazyResource(name, factory)
+    return _registry[name]
+
+def get(name):
+    return _registry[name].get()
+
+def is_loaded(name):
+    return _registry[name].loaded
+
+def warm_up(*names):
+    """Load the given resources now (all registered ones if none are given) instead of on first use."""
+    for name in names or list(_registry):
+        get(name)
+
+def startup_report(label="process"):
+    """Print and return how long startup took and which resources were loaded along the way."""
+    report = {
+        "startup_seconds": round(time.perf_counter() - PROCESS_START, 3),
+        "loaded": {name: round(r.load_seconds, 3) for name, r in _registry.items() if r.loaded},
+        "not_loaded": [name for name, r in _registry.items() if not r.loaded],
+    }
+    print(f"🚀 {label} ready in {report['startup_seconds']:.2f}s, loaded: {report['loaded']}, "
+          f"deferred: {report['not_loaded']}")
+    return report
+
+
+# ------- factories ----------
+# imports live inside the factories so importing this module doesn't pull in torch, chromadb, etc.
+
+def _build_llm():
+    from langchain_together import ChatTogether
+    api_key = os.getenv("TOGETHER_API_KEY")
+    # Ensure API key is set
+    if not api_key:
+        raise ValueError("TOGETHER_API_KEY is missing. Please check your .env file.")
+    return ChatTogether(model=LLM_MODEL, together_api_key=api_key)
+
+def _build_embedding_model():
+    from langchain_huggingface import HuggingFaceEmbeddings
+    from .embedding_store import EMBEDDING_CACHE_ENABLED, EmbeddingStore, CachedEmbeddings
+    from .embedding_engine import EMBED_WORKERS, EmbeddingEngine
+    model = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL_NAME)
+    if EMBED_WORKERS > 1:
+        # large document batches are sharded across worker processes, cache misses included
+        model = EmbeddingEngine(model, EMBEDDING_MODEL_NAME)
+    if not EMBEDDING_CACHE_ENABLED:
+        return model
+    # document embeddings are reused across re-ingests and processes from the on-disk store
+    return CachedEmbeddings(model, EmbeddingStore(EMBEDDING_MODEL_NAME))
+
+def _build_chroma_client():
+    import chromadb
+    host = os.getenv("CHROMA_HOST")
+    port = int(os.getenv("CHROMA_PORT", "8000"))
+    # Ensure ChromaDB is running on your EC2
+    if not host:
+        raise ValueError("CHROMA_HOST not set")
+    return chromadb.HttpClient(host=host, port=port)
+
+def _build_collection():
+    return get("chroma_client").get_or_create_collection(name=COLLECTION_NAME)
+
+register("llm", _build_llm)
+register("embedding_model", _build_embedding_model)
+register("chroma_client", _build_chroma_client)
+register("collection", _build_collection)
+
+def get_llm():
+    return get("llm")
+
+def get_embedding_model():
+    return get("embedding_model")
+
+def get_chroma_client():
+    return get("chroma_client")
+
+def get_collection():
+    return get("collection")
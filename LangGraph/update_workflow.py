@@ -1,106 +1,315 @@
-from .common_workflow import create_and_store_embedding, delete_chroma_by_date
+from .common_workflow import (create_and_store_embedding, delete_chroma_by_date, delete_chroma_ids,
+                              delete_existing_chroma_ids, rebuild_chroma_threads, answer_cache, lexical_index)
 from langgraph.graph import StateGraph, END
 from database.schema_manager import SchemaManager
-import json
+import os
+import time
+import shutil
+import operator
+import tempfile
+from contextlib import ExitStack
 from pydantic import BaseModel
-from typing import List
+from .metrics import instrument_node
+from JSON_processing.category_classifier import retrain_in_background
+from JSON_processing.records import iter_record_batches
+from typing import Annotated, List
+
+# when one store fails an upload, remove the rows this run added to the other so both stay in step
+UPDATE_COMPENSATE = os.getenv("UPDATE_COMPENSATE", "true").lower() == "true"
 
 # Define the update state schema
+# the Postgres and Chroma branches run in parallel, so each node returns only the fields it owns
 class UpdateState(BaseModel):
     json_files: List  # will contain Werkzeug FileStorage objects from Flask
-    delete_from: str | None = None
-    delete_to: str | None = None
+    delete_from: float | None = None  # unix seconds, compared against the numeric ts column
+    delete_to: float | None = None
     postgres_success: bool | None = None
     chroma_success: bool | None = None
 
+    # uploads copied to private temp files, each branch opens its own handles
+    spooled_files: List[str] = []
+    # keys of rows added by this run, used to undo an upload that only reached one store
+    inserted_postgres_keys: List[str] = []
+    inserted_chroma_ids: List[str] = []
+    # per-message vectors replaced by thread documents, only deleted once both stores succeeded
+    superseded_chroma_ids: List[str] = []
+    # old keys of channel-less rows this upload moved onto their channel key, their vectors are stale copies
+    replaced_postgres_keys: List[str] = []
+    # [channel, thread_ts] of thread documents the range delete removed, rebuilt from Postgres at the end
+    deleted_chroma_threads: List[List[str]] = []
+    errors: Annotated[List[str], operator.add] = []
+    timings: Annotated[dict[str, float], operator.or_] = {}
+
     #For summary tracking
     deleted_postgres_count: int = 0
     deleted_chroma_count: int = 0
     inserted_postgres_count: int = 0
     inserted_chroma_count: int = 0
+    # re-uploaded messages are upserted on their message key instead of duplicated
+    updated_postgres_count: int = 0
+    updated_chroma_count: int = 0
+    skipped_postgres_count: int = 0
+    skipped_chroma_count: int = 0
+    # rows in batches Postgres rejected; the rest of the upload was still stored
+    failed_postgres_count: int = 0
+    summary: dict | None = None
+
+def file_name(file):
+    return getattr(file, "filename", None) or getattr(file, "name", "upload")
+
+def spool_uploads(state: UpdateState) -> dict:
+    """Copy each upload to a temp file once, so the parallel branches never share a file position."""
+    paths = []
+    for file in state.json_files:
+        file.seek(0)
+        # keep the extension, the readers go by it (JSON array, JSONL or Parquet)
+        suffix = os.path.splitext(file_name(file))[1] or ".json"
+        with tempfile.NamedTemporaryFile("wb", suffix=suffix, delete=False) as spool:
+            shutil.copyfileobj(file, spool)
+        paths.append(spool.name)
+    return {"spooled_files": paths}
 
-def update_chroma_db(state):
-    if not state.json_files:
+def remove_spooled(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def update_chroma_db(state: UpdateState) -> dict:
+    if not state.spooled_files:
         print("Skipping Chroma upload: no files provided.")
-        return state
+        return {}
+    start = time.perf_counter()
+    inserted_ids, superseded_ids = [], []
     try:
-        create_and_store_embedding(state.json_files)
-        state.chroma_success = True
+        with ExitStack() as stack:
+            files = [stack.enter_context(open(path, "rb")) for path in state.spooled_files]
+            summary = create_and_store_embedding(files, inserted_ids=inserted_ids, superseded_ids=superseded_ids)
+        return {
+            "inserted_chroma_count": summary["inserted"],
+            "updated_chroma_count": summary["updated"],
+            "skipped_chroma_count": summary["skipped"],
+            "inserted_chroma_ids": inserted_ids,
+            "superseded_chroma_ids": superseded_ids,
+            "chroma_success": True,
+            "timings": {"update_chroma": time.perf_counter() - start},
+        }
     except Exception as e:
         print(f"[Chroma Update Error]: {e}")
-        state.chroma_success = False
-    return state
+        return {
+            "inserted_chroma_count": len(inserted_ids),
+            "inserted_chroma_ids": inserted_ids,
+            "chroma_success": False,
+            "errors": [f"chroma upload: {type(e).__name__} - {e}"],
+            "timings": {"update_chroma": time.perf_counter() - start},
+        }
 
-def update_postgres_db(state: UpdateState) -> UpdateState:
-    if not state.json_files:
+def update_postgres_db(state: UpdateState) -> dict:
+    if not state.spooled_files:
         print("Skipping Postgres upload: no files provided.")
-        return state
+        return {}
+    start = time.perf_counter()
     schema_manager = None
+    inserted_keys, replaced_keys = [], []
+    inserted, updated, skipped, failed = 0, 0, 0, 0
+    errors = []
+    # False only if the branch itself broke; rejected batches are reported, the rows that made it stay
+    completed = False
     try:
         schema_manager = SchemaManager()
-        inserted = 0
-
-        for file in state.json_files:
-            file.seek(0)  # make sure file pointer is at the start
-            raw_json = file.read().decode("utf-8")
-            messages = json.loads(raw_json)
 
-            for message in messages:
-                schema_manager.insert_message(message)
-                inserted += 1
+        for path, file in zip(state.spooled_files, state.json_files):
+            # streamed one record batch at a time, the upload is never held in memory whole
+            summary = {"inserted": 0, "updated": 0, "skipped": 0, "failed": 0, "errors": []}
+            file_start = time.perf_counter()
+            for messages in iter_record_batches(path):
+                batch_summary = schema_manager.insert_messages(messages, inserted_keys=inserted_keys,
+                                                               replaced_keys=replaced_keys)
+                for key in ("inserted", "updated", "skipped", "failed"):
+                    summary[key] += batch_summary[key]
+                summary["errors"] += batch_summary["errors"]
+            inserted += summary["inserted"]
+            updated += summary["updated"]
+            skipped += summary["skipped"]
+            failed += summary["failed"]
+            if summary["errors"]:
+                print(f"[Postgres Update Error]: {summary['failed']} rows failed in {file_name(file)}: {summary['errors']}")
+                errors.append(f"postgres upload: {summary['failed']} rows failed in {file_name(file)}")
+            written = summary["inserted"] + summary["updated"] + summary["skipped"]
+            elapsed = time.perf_counter() - file_start
+            print(f"Upserted {file_name(file)}: {summary['inserted']} inserted, {summary['updated']} updated, "
+                  f"{summary['skipped']} unchanged ({written / elapsed if elapsed else 0:.1f} rows/sec)")
 
-        state.inserted_postgres_count = inserted
-        state.postgres_success = True
         schema_manager.connection.commit()  # commit to db
-        print(f"✅ Inserted {inserted} messages into PostgreSQL.")
+        completed = True
+        lexical_index.mark_stale()  # the next search folds the new and edited rows in
+        print(f"✅ PostgreSQL: {inserted} messages inserted, {updated} updated, {skipped} unchanged, {failed} failed.")
     except Exception as e:
         print(f"[Postgres Update Error]: {type(e).__name__} - {e}")
-        state.postgres_success = False
+        errors.append(f"postgres upload: {type(e).__name__} - {e}")
     finally:
-        schema_manager.close_connection()  # close the connection
+        if schema_manager is not None:
+            schema_manager.close_connection()  # return the connection to the pool
 
-    return state
+    return {
+        "inserted_postgres_count": inserted,
+        "updated_postgres_count": updated,
+        "skipped_postgres_count": skipped,
+        "failed_postgres_count": failed,
+        "inserted_postgres_keys": inserted_keys,
+        "replaced_postgres_keys": replaced_keys,
+        "postgres_success": completed,
+        "errors": errors,
+        "timings": {"update_postgres": time.perf_counter() - start},
+    }
 
-def delete_postgres_node(state: UpdateState) -> UpdateState:
+def delete_postgres_node(state: UpdateState) -> dict:
     if not (state.delete_from and state.delete_to):
         print("Skipping Postgres deletion: no date range provided.")
-        return state
+        return {}
+    start = time.perf_counter()
     try:
-        if state.delete_from and state.delete_to:
-            schema_manager = SchemaManager()
+        with SchemaManager() as schema_manager:
             row_count = schema_manager.delete_messages(state.delete_from, state.delete_to)
-            state.deleted_postgres_count = row_count
             schema_manager.connection.commit()  # ensure deletion is committed
-            schema_manager.close_connection()
-            print("Deleted old messages from Postgres.")
+        lexical_index.mark_stale()
+        print("Deleted old messages from Postgres.")
+        return {"deleted_postgres_count": row_count, "timings": {"delete_postgres": time.perf_counter() - start}}
     except Exception as e:
         print(f"[Postgres Delete Error]: {e}")
-    return state
+        return {"errors": [f"postgres delete: {type(e).__name__} - {e}"]}
 
-def delete_chroma_node(state: UpdateState) -> UpdateState:
+def delete_chroma_node(state: UpdateState) -> dict:
     if not (state.delete_from and state.delete_to):
         print("Skipping Chroma deletion: no date range provided.")
-        return state
+        return {}
+    start = time.perf_counter()
     try:
-        if state.delete_from and state.delete_to:
-            count = delete_chroma_by_date(state.delete_from, state.delete_to)
-            state.deleted_chroma_count = count
-        state.chroma_success = None  # not a failure, just delete phase
+        threads = []
+        count = delete_chroma_by_date(state.delete_from, state.delete_to, deleted_threads=threads)
+        return {"deleted_chroma_count": count, "deleted_chroma_threads": threads,
+                "timings": {"delete_chroma": time.perf_counter() - start}}
     except Exception as e:
         print(f"[Chroma Delete Error]: {e}")
-    return state
+        return {"errors": [f"chroma delete: {type(e).__name__} - {e}"]}
+
+def compensate_partial_upload(state: UpdateState) -> dict:
+    """
+    Undo the rows this run inserted, in both stores, after one side failed.
+    Updates to rows that already existed can't be reverted. Per-message vectors that thread documents
+    would replace are never deleted on a failed run, so they need no restoring. Uploads are idempotent, so
+    re-uploading the same files once the failing store is healthy finishes the job.
+    """
+    report = {"postgres_rows_removed": 0, "chroma_ids_removed": 0, "errors": []}
+    if state.inserted_postgres_keys:
+        try:
+            with SchemaManager() as schema_manager:
+                report["postgres_rows_removed"] = schema_manager.delete_messages_by_keys(state.inserted_postgres_keys)
+                schema_manager.connection.commit()
+            lexical_index.mark_stale()
+        except Exception as e:
+            report["errors"].append(f"postgres compensation: {type(e).__name__} - {e}")
+    if state.inserted_chroma_ids:
+        try:
+            report["chroma_ids_removed"] = delete_chroma_ids(state.inserted_chroma_ids)
+        except Exception as e:
+            report["errors"].append(f"chroma compensation: {type(e).__name__} - {e}")
+    print(f"↩️ Compensated partial upload: {report}")
+    return report
+
+def summarize_update(state: UpdateState) -> dict:
+    """Join node: runs once both branches finish, reconciles a one-sided failure and builds the combined summary."""
+    try:
+        failed_stores = [store for store, ok in (("postgres", state.postgres_success), ("chroma", state.chroma_success))
+                         if ok is False]
+        compensation = compensate_partial_upload(state) if failed_stores and UPDATE_COMPENSATE else None
+
+        # thread documents only replace the per-message vectors once both stores hold the upload,
+        # so a compensated run leaves Chroma as it was
+        superseded_removed, cleanup_errors = 0, []
+        stale_ids = state.superseded_chroma_ids + state.replaced_postgres_keys
+        if stale_ids and not failed_stores:
+            try:
+                superseded_removed = delete_existing_chroma_ids(stale_ids)
+            except Exception as e:
+                cleanup_errors.append(f"chroma superseded cleanup: {type(e).__name__} - {e}")
+                print(f"[Chroma Cleanup Error]: {cleanup_errors[-1]}")
+        # threads the range delete cut into keep their messages outside the range, and Postgres has
+        # finished deleting by now, so their documents are rebuilt from what it holds
+        threads_rebuilt = 0
+        if state.deleted_chroma_threads:
+            try:
+                rebuild_chroma_threads(state.deleted_chroma_threads)
+                threads_rebuilt = len(state.deleted_chroma_threads)
+            except Exception as e:
+                cleanup_errors.append(f"chroma thread rebuild: {type(e).__name__} - {e}")
+                print(f"[Chroma Rebuild Error]: {cleanup_errors[-1]}")
+        errors = state.errors + cleanup_errors
+
+        delete_failed = any(error.split(":")[0].endswith("delete") for error in state.errors)
+        # rejected Postgres batches leave their rows in Chroma only
+        consistent = (not failed_stores and not delete_failed and not state.failed_postgres_count
+                      and (compensation is None or not compensation["errors"]))
+        if state.delete_from and state.delete_to and bool(state.deleted_postgres_count) != bool(state.deleted_chroma_count):
+            # one thread document covers several rows, so the counts differ, but only one side matching
+            # anything means Postgres and Chroma had already drifted
+            print(f"⚠️ Deleted {state.deleted_postgres_count} Postgres rows but {state.deleted_chroma_count} Chroma vectors.")
+
+        summary = {
+            "success": not errors,
+            "consistent": consistent,
+            "failed_stores": failed_stores,
+            "errors": errors,
+            "postgres": {
+                "deleted": state.deleted_postgres_count,
+                "inserted": state.inserted_postgres_count,
+                "updated": state.updated_postgres_count,
+                "unchanged": state.skipped_postgres_count,
+                "failed": state.failed_postgres_count,
+            },
+            "chroma": {
+                "deleted": state.deleted_chroma_count,
+                "inserted": state.inserted_chroma_count,
+                "updated": state.updated_chroma_count,
+                "unchanged": state.skipped_chroma_count,
+                # per-message vectors now covered by thread documents or by a re-keyed copy; kept when the run was compensated
+                "superseded_removed": superseded_removed,
+                "superseded_kept": len(stale_ids) if failed_stores else 0,
+                # threads partly inside the delete range, re-indexed from their remaining messages
+                "threads_rebuilt": threads_rebuilt,
+            },
+            "compensation": compensation,
+            "timings": state.timings,
+        }
+        if state.postgres_success and state.inserted_postgres_count + state.updated_postgres_count:
+            # fold the new labelled rows into the local category classifier
+            retrain_in_background()
+
+        if not consistent:
+            print(f"⚠️ Update left Postgres and Chroma out of step, re-upload the same files to repair: {summary}")
+        else:
+            print(f"✅ Update finished: {summary}")
+        return {"summary": summary}
+    finally:
+        remove_spooled(state.spooled_files)
 
 graph = StateGraph(UpdateState)
-graph.add_node("delete_postgres", delete_postgres_node)
-graph.add_node("delete_chroma", delete_chroma_node)
-graph.add_node("update_postgres", update_postgres_db)
-graph.add_node("update_chroma", update_chroma_db)
+graph.add_node("spool_uploads", instrument_node("update_bot", "spool_uploads", spool_uploads))
+graph.add_node("delete_postgres", instrument_node("update_bot", "delete_postgres", delete_postgres_node))
+graph.add_node("delete_chroma", instrument_node("update_bot", "delete_chroma", delete_chroma_node))
+graph.add_node("update_postgres", instrument_node("update_bot", "update_postgres", update_postgres_db))
+graph.add_node("update_chroma", instrument_node("update_bot", "update_chroma", update_chroma_db))
+graph.add_node("summarize", instrument_node("update_bot", "summarize", summarize_update))
 
-graph.set_entry_point("delete_postgres")
-graph.add_edge("delete_postgres", "delete_chroma")
-graph.add_edge("delete_chroma", "update_postgres")
-graph.add_edge("update_postgres", "update_chroma")
-graph.add_edge("update_chroma", END)
+# fan out: each store deletes then uploads on its own branch, the join waits for both
+graph.set_entry_point("spool_uploads")
+graph.add_edge("spool_uploads", "delete_postgres")
+graph.add_edge("spool_uploads", "delete_chroma")
+graph.add_edge("delete_postgres", "update_postgres")
+graph.add_edge("delete_chroma", "update_chroma")
+graph.add_edge(["update_postgres", "update_chroma"], "summarize")
+graph.add_edge("summarize", END)
 
 update_bot = graph.compile()
 
@@ -110,4 +319,12 @@ def invoke_update(json_files, delete_from, delete_to):
         delete_from=delete_from,
         delete_to=delete_to,
     )
-    return update_bot.invoke(state)
\ No newline at end of file
+    try:
+        result = update_bot.invoke(state)
+        # upload handles and per-row keys aren't JSON serializable / useful to the front-end
+        return {key: value for key, value in result.items()
+                if key not in ("json_files", "spooled_files", "inserted_postgres_keys", "inserted_chroma_ids",
+                               "superseded_chroma_ids", "replaced_postgres_keys", "deleted_chroma_threads")}
+    finally:
+        # cached answers may reference deleted or outdated knowledge
+        answer_cache.invalidate()
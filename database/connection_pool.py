@@ -1,14 +1,33 @@
 import psycopg2
+import psycopg2.extensions
 import os
+import time
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# pool tunables
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))             # max seconds to wait for a free connection
+DB_POOL_IDLE_TIMEOUT = float(os.getenv("DB_POOL_IDLE_TIMEOUT", "300"))   # idle connections above min size are closed after this
+DB_POOL_HEALTHCHECK_AFTER = float(os.getenv("DB_POOL_HEALTHCHECK_AFTER", "30"))  # ping connections idle longer than this
+
+
+class PoolTimeout(Exception):
+    """No connection became available within the checkout timeout."""
+
+
 class ConnectionPool:
     """Manages database connections efficiently."""
 
-    def __init__(self):
-        """Initialize the connection pool with database credentials."""
+    def __init__(self, min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE, timeout=DB_POOL_TIMEOUT,
+                 idle_timeout=DB_POOL_IDLE_TIMEOUT, healthcheck_after=DB_POOL_HEALTHCHECK_AFTER):
+        """Initialize the connection pool with database credentials. min_size connections are opened up front, the rest on demand."""
         self.host = os.getenv("DB_HOST")
         self.database = os.getenv("DB_NAME")
         self.user = os.getenv("DB_USER")
@@ -18,22 +37,207 @@ class ConnectionPool:
         print("Database:", self.database)
         print("User:", self.user)
         print("Port:", self.port)
-        self.connection = None  # Placeholder for active connection
-
-    def get_connection(self):
-        """Establish and return a new database connection."""
-        if self.connection is None or self.connection.closed:
-            self.connection = psycopg2.connect(
-                host=self.host,
-                port = self.port,
-                database=self.database,
-                user=self.user,
-                password=self.password
-            )
-        return self.connection
-
-    def close_connection(self):
-        """Close the active database connection."""
-        if self.connection and not self.connection.closed:
-            self.connection.close()
-            print("✅ Database connection closed.")
\ No newline at end of file
+
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.healthcheck_after = healthcheck_after
+
+        self._idle = deque()   # (connection, returned_at), most recently returned on the right
+        self._in_use = set()
+        self._pending = 0      # connections being opened outside the lock
+        self._cond = threading.Condition()
+
+        # metrics
+        self._wait_times = deque(maxlen=1024)
+        self.checkouts = 0
+        self.timeouts = 0
+        self.created = 0
+        self.discarded = 0
+        self.reaped = 0
+
+        self._open_min()
+
+    @property
+    def size(self):
+        return len(self._idle) + len(self._in_use) + self._pending
+
+    def _connect(self):
+        connection = psycopg2.connect(
+            host=self.host,
+            port=self.port,
+            database=self.database,
+            user=self.user,
+            password=self.password
+        )
+        return connection
+
+    def _open_min(self):
+        """Open idle connections until the pool holds min_size, so the first requests don't wait on connecting."""
+        while True:
+            with self._cond:
+                if self.size >= self.min_size:
+                    return
+                # reserve the slot before connecting outside the lock, like getconn does
+                self._pending += 1
+            connection = None
+            try:
+                connection = self._connect()
+            except psycopg2.Error as e:
+                logging.warning(f"Could not pre-open database connections, opening them on demand: {e}")
+                return
+            finally:
+                with self._cond:
+                    self._pending -= 1
+                    if connection is not None:
+                        self.created += 1
+                        self._idle.append((connection, time.monotonic()))
+                    self._cond.notify()
+
+    def _is_healthy(self, connection, idle_for):
+        if connection.closed:
+            return False
+        if idle_for < self.healthcheck_after:
+            return True
+        # long-idle connections may have been dropped by RDS or a NAT, ping before handing out
+        try:
+            with connection.cursor() as cur:
+                cur.execute("SELECT 1")
+            connection.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _close_quietly(self, connection):
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
+
+    def _reap_idle(self):
+        """Close connections idle past idle_timeout while keeping at least min_size open. Caller holds the lock."""
+        now = time.monotonic()
+        while self._idle and self.size > self.min_size and now - self._idle[0][1] > self.idle_timeout:
+            connection, _ = self._idle.popleft()
+            self._close_quietly(connection)
+            self.reaped += 1
+
+    def getconn(self, timeout=None):
+        """Check a healthy connection out of the pool, opening a new one if below max_size."""
+        timeout = self.timeout if timeout is None else timeout
+        start = time.monotonic()
+        deadline = start + timeout
+
+        with self._cond:
+            while True:
+                self._reap_idle()
+                if self._idle:
+                    connection, returned_at = self._idle.pop()
+                    self._in_use.add(connection)
+                    break
+                if self.size < self.max_size:
+                    connection, returned_at = None, None
+                    # reserve the slot while connecting outside the lock
+                    self._pending += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise PoolTimeout(f"No database connection available after {timeout:.1f}s "
+                                      f"({self.max_size} in use)")
+                self._cond.wait(remaining)
+
+        if connection is None:
+            try:
+                connection = self._connect()
+            finally:
+                with self._cond:
+                    self._pending -= 1
+                    if connection is not None:
+                        self.created += 1
+                        self._in_use.add(connection)
+                    self._cond.notify()
+        elif not self._is_healthy(connection, time.monotonic() - returned_at):
+            logging.warning("Discarding broken database connection.")
+            self._close_quietly(connection)
+            with self._cond:
+                self._in_use.discard(connection)
+                self.discarded += 1
+            return self.getconn(max(0.0, deadline - time.monotonic()))
+
+        with self._cond:
+            self.checkouts += 1
+            self._wait_times.append(time.monotonic() - start)
+        return connection
+
+    def putconn(self, connection, discard=False):
+        """Return a connection to the pool. Open transactions are rolled back, broken connections dropped."""
+        if not discard and not connection.closed:
+            try:
+                if connection.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    connection.rollback()
+            except psycopg2.Error:
+                discard = True
+
+        with self._cond:
+            self._in_use.discard(connection)
+            if discard or connection.closed:
+                self._close_quietly(connection)
+                self.discarded += 1
+            else:
+                self._idle.append((connection, time.monotonic()))
+            self._reap_idle()
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """`with pool.connection() as conn:` - commits are left to the caller, anything uncommitted is rolled back."""
+        connection = self.getconn(timeout)
+        try:
+            yield connection
+        except Exception:
+            if not connection.closed:
+                connection.rollback()
+            raise
+        finally:
+            self.putconn(connection)
+
+    def close_all(self):
+        """Close every idle connection (e.g. at shutdown)."""
+        with self._cond:
+            while self._idle:
+                connection, _ = self._idle.popleft()
+                self._close_quietly(connection)
+        print("✅ Database connections closed.")
+
+    def stats(self):
+        with self._cond:
+            waits = sorted(self._wait_times)
+            return {
+                "size": self.size,
+                "idle": len(self._idle),
+                "in_use": len(self._in_use),
+                "max_size": self.max_size,
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "created": self.created,
+                "discarded": self.discarded,
+                "reaped": self.reaped,
+                "wait_p50_seconds": waits[len(waits) // 2] if waits else 0.0,
+                "wait_p95_seconds": waits[int(len(waits) * 0.95)] if waits else 0.0,
+                "wait_max_seconds": waits[-1] if waits else 0.0,
+            }
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """The process-wide pool every database call site shares."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool()
+    return _pool
@@ -0,0 +1,328 @@
+'''versioned, resumable migrations for the messages table - `python -m database.migrations status|migrate`'''
+from .connection_pool import get_pool
+import os
+import logging
+import argparse
+
+# rows converted per transaction, so a large table never sits under one long lock
+DB_MIGRATION_BATCH_SIZE = int(os.getenv("DB_MIGRATION_BATCH_SIZE", "5000"))
+# any fixed number works, it only has to be the same for every process running migrations
+MIGRATION_LOCK_ID = 72016001
+NUMERIC_TS = r"^\s*[0-9]+(\.[0-9]+)?\s*$"
+# key of a row without a channel, Slack ts values are only unique per channel so the text goes in as well
+CHANNELLESS_KEY_SQL = "md5(coalesce(team, '') || '::' || ts::text || ':' || coalesce(text, ''))"
+# msg_key in SQL, the same md5 as schema_manager.message_key (team:channel:ts, or the text when there is no ts)
+MESSAGE_KEY_SQL = f"""CASE
+    WHEN ts IS NULL OR ts::text = '' THEN md5('text:' || coalesce(text, ''))
+    WHEN coalesce(channel, '') <> '' THEN md5(coalesce(team, '') || ':' || channel || ':' || ts::text)
+    ELSE {CHANNELLESS_KEY_SQL}
+END"""
+
+
+class SchemaOutdated(RuntimeError):
+    """The messages table is behind the code; pending migrations have to be applied first."""
+
+
+# ------- helpers ----------
+
+def table_exists(cursor, table):
+    cursor.execute("SELECT to_regclass(%s) IS NOT NULL", (table,))
+    return cursor.fetchone()[0]
+
+def column_type(cursor, table, column):
+    cursor.execute("""
+        SELECT data_type FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = %s AND column_name = %s
+    """, (table, column))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+def id_batches(cursor, table, batch_size):
+    """(first id, last id) ranges covering the table, `batch_size` ids wide."""
+    cursor.execute(f"SELECT MIN(id), MAX(id) FROM {table}")
+    low, high = cursor.fetchone()
+    if low is None:
+        return
+    for start in range(low, high + 1, batch_size):
+        yield start, min(start + batch_size - 1, high)
+
+def batched_update(connection, sql, batch_size, label):
+    """Run `sql` (with %(low)s / %(high)s id bounds) over the table one committed batch at a time."""
+    cursor = connection.cursor()
+    updated = 0
+    batches = list(id_batches(cursor, "messages", batch_size))
+    for i, (low, high) in enumerate(batches):
+        cursor.execute(sql, {"low": low, "high": high})
+        updated += cursor.rowcount
+        connection.commit()
+        if (i + 1) % 20 == 0 or i + 1 == len(batches):
+            logging.info(f"{label}: {i + 1}/{len(batches)} batches, {updated} rows updated")
+    return updated
+
+
+# ------- migrations ----------
+# each one checks the current shape first, so it is a no-op on tables created with the new schema
+# and can be re-run after an interruption
+
+def add_message_keys(connection, batch_size):
+    """
+    msg_key identity column, backfilled with the channel-less form of schema_manager.message_key (the
+    channel column comes in migration 3, rekey_messages moves rows onto their final keys), duplicates removed.
+    """
+    cursor = connection.cursor()
+    cursor.execute("ALTER TABLE messages ADD COLUMN IF NOT EXISTS msg_key VARCHAR(64)")
+    connection.commit()
+    batched_update(connection, f"""
+        UPDATE messages SET msg_key = CASE
+            WHEN ts IS NULL OR ts::text = '' THEN md5('text:' || coalesce(text, ''))
+            ELSE {CHANNELLESS_KEY_SQL}
+        END
+        WHERE id BETWEEN %(low)s AND %(high)s AND msg_key IS NULL
+    """, batch_size, "msg_key backfill")
+    # rows that collapse onto the same key are earlier re-uploads, keep the oldest
+    cursor.execute("""
+        DELETE FROM messages a USING messages b
+        WHERE a.msg_key = b.msg_key AND a.id > b.id
+    """)
+    logging.info(f"Removed {cursor.rowcount} duplicate rows.")
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS messages_msg_key_key ON messages (msg_key)")
+
+def convert_ts_to_numeric(connection, batch_size):
+    """
+    ts VARCHAR -> NUMERIC(17, 6). Slack ts values are seconds with microsecond decimals and double as
+    message ids, so an exact numeric keeps them intact while making range comparisons numeric.
+    Values are copied into a shadow column batch by batch and swapped in under a short lock at the end.
+    """
+    cursor = connection.cursor()
+    if column_type(cursor, "messages", "ts") == "numeric":
+        return
+    cursor.execute("ALTER TABLE messages ADD COLUMN IF NOT EXISTS ts_numeric NUMERIC(17, 6)")
+    connection.commit()
+
+    convert = f"""
+        UPDATE messages SET ts_numeric = btrim(ts)::numeric
+        WHERE ts_numeric IS NULL AND ts ~ '{NUMERIC_TS}'
+    """
+    batched_update(connection, convert + " AND id BETWEEN %(low)s AND %(high)s", batch_size, "ts conversion")
+
+    # catch rows written while the batches ran, then swap the columns
+    cursor.execute("LOCK TABLE messages IN SHARE ROW EXCLUSIVE MODE")
+    cursor.execute(convert)
+    cursor.execute("SELECT COUNT(*) FROM messages WHERE ts_numeric IS NULL AND coalesce(btrim(ts), '') <> ''")
+    unparseable = cursor.fetchone()[0]
+    if unparseable:
+        logging.warning(f"{unparseable} rows have a non-numeric ts and will be stored with ts NULL.")
+    cursor.execute("ALTER TABLE messages DROP COLUMN ts")
+    cursor.execute("ALTER TABLE messages RENAME COLUMN ts_numeric TO ts")
+
+def normalize_channel_and_user(connection, batch_size):
+    """Keep the channel a message came from and store missing users/teams as NULL instead of ''."""
+    cursor = connection.cursor()
+    cursor.execute("ALTER TABLE messages ADD COLUMN IF NOT EXISTS channel VARCHAR(100)")
+    connection.commit()
+    batched_update(connection, """
+        UPDATE messages SET username = NULLIF(username, ''), team = NULLIF(team, '')
+        WHERE id BETWEEN %(low)s AND %(high)s AND (username = '' OR team = '')
+    """, batch_size, "user/team normalization")
+
+def create_indexes_concurrently(connection, indexes):
+    """Build (name, columns) indexes CONCURRENTLY, outside a transaction, so writes keep flowing."""
+    cursor = connection.cursor()
+    connection.commit()
+    connection.autocommit = True
+    try:
+        for name, columns in indexes:
+            # an interrupted CONCURRENTLY build leaves an invalid index behind, rebuild it
+            cursor.execute("""
+                SELECT NOT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+                WHERE c.relname = %s
+            """, (name,))
+            row = cursor.fetchone()
+            if row and row[0]:
+                cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+            cursor.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON messages ({columns})")
+    finally:
+        connection.autocommit = False
+
+def add_ts_and_category_indexes(connection, batch_size):
+    """B-tree indexes so range deletes and MIN/MAX(ts) are index lookups."""
+    create_indexes_concurrently(connection, [("messages_ts_idx", "ts"), ("messages_category_idx", "category")])
+
+def add_thread_ts(connection, batch_size):
+    """
+    Keep the Slack thread a message belongs to, so replies can be grouped with their question.
+    Existing rows stay NULL (the old exports dropped thread_ts), re-uploading the processed files fills it in.
+    """
+    cursor = connection.cursor()
+    cursor.execute("ALTER TABLE messages ADD COLUMN IF NOT EXISTS thread_ts NUMERIC(17, 6)")
+    connection.commit()
+    create_indexes_concurrently(connection, [("messages_thread_idx", "channel, thread_ts")])
+
+def rekey_messages(connection, batch_size):
+    """
+    msg_key used to be md5(team:user:ts), but rows loaded before users were stored have no user, so
+    re-uploading them produced a second row under a different key. Keys are now md5(team:channel:ts), and rows
+    without a channel keep their text in the key (MESSAGE_KEY_SQL), since a ts alone is only unique per channel.
+    Rows that collapse onto one key are the same message in the same channel, the newest copy (the one with
+    user and thread_ts filled in) is kept. Chroma vectors stored under the old keys are replaced by
+    `python -m LangGraph.common_workflow reindex`. Runs again as migration 9 for tables rekeyed by the
+    first version of this migration, which left the channel out of the key.
+    """
+    cursor = connection.cursor()
+    dedupe = f"""
+        DELETE FROM messages WHERE id IN (
+            SELECT id FROM (
+                SELECT id, row_number() OVER (PARTITION BY channel, {MESSAGE_KEY_SQL} ORDER BY id DESC) AS copy
+                FROM messages
+            ) keyed WHERE copy > 1
+        )
+    """
+    cursor.execute(dedupe)
+    logging.info(f"Removed {cursor.rowcount} duplicate rows.")
+    connection.commit()
+
+    # rows an upload inserted meanwhile already carry the new key, their older copies are left for the final pass
+    batched_update(connection, f"""
+        UPDATE messages m SET msg_key = keyed.new_key
+        FROM (SELECT id, {MESSAGE_KEY_SQL} AS new_key FROM messages WHERE id BETWEEN %(low)s AND %(high)s) keyed
+        WHERE m.id = keyed.id AND m.msg_key IS DISTINCT FROM keyed.new_key
+        AND NOT EXISTS (SELECT 1 FROM messages b WHERE b.msg_key = keyed.new_key)
+    """, batch_size, "msg_key rekey")
+
+    # catch copies written while the batches ran, then key what is left
+    cursor.execute("LOCK TABLE messages IN SHARE ROW EXCLUSIVE MODE")
+    cursor.execute(dedupe)
+    cursor.execute(f"UPDATE messages SET msg_key = {MESSAGE_KEY_SQL} WHERE msg_key IS DISTINCT FROM {MESSAGE_KEY_SQL}")
+
+def add_updated_at(connection, batch_size):
+    """
+    updated_at, bumped whenever an upsert changes a row, so in-process indexes can pick up edits as well as inserts.
+    Added with a now() default (existing rows get the migration time without a table rewrite), new rows then
+    take clock_timestamp() so rows from a long upload transaction aren't all stamped with its start.
+    """
+    cursor = connection.cursor()
+    cursor.execute("ALTER TABLE messages ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ NOT NULL DEFAULT now()")
+    cursor.execute("ALTER TABLE messages ALTER COLUMN updated_at SET DEFAULT clock_timestamp()")
+    connection.commit()
+    create_indexes_concurrently(connection, [("messages_updated_at_idx", "updated_at")])
+
+def add_category_source(connection, batch_size):
+    """
+    Where each category came from (llm, local, fallback or human), so the local classifier only trains on
+    LLM or human labels and never on its own predictions. Every category stored before this came from the
+    LLM, so existing rows are backfilled as 'llm' (backfill_category_source).
+    """
+    cursor = connection.cursor()
+    cursor.execute("ALTER TABLE messages ADD COLUMN IF NOT EXISTS category_source VARCHAR(20)")
+    connection.commit()
+    backfill_category_source(connection, batch_size)
+
+def backfill_category_source(connection, batch_size):
+    """
+    Mark categorized rows without a source as LLM labels. Also runs as migration 10 for tables that got the
+    column from the first version of migration 8, which left them NULL. updated_at is bumped so an incremental
+    classifier retrain picks the rows up.
+    """
+    batched_update(connection, """
+        UPDATE messages SET category_source = 'llm', updated_at = clock_timestamp()
+        WHERE id BETWEEN %(low)s AND %(high)s AND category IS NOT NULL AND category_source IS NULL
+    """, batch_size, "category_source backfill")
+
+MIGRATIONS = [
+    (1, "message_keys", add_message_keys),
+    (2, "numeric_ts", convert_ts_to_numeric),
+    (3, "channel_and_user", normalize_channel_and_user),
+    (4, "ts_category_indexes", add_ts_and_category_indexes),
+    (5, "thread_ts", add_thread_ts),
+    (6, "rekey_messages", rekey_messages),
+    (7, "updated_at", add_updated_at),
+    (8, "category_source", add_category_source),
+    (9, "channel_message_keys", rekey_messages),
+    (10, "category_source_backfill", backfill_category_source),
+]
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+# ------- runner ----------
+
+def ensure_migrations_table(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name VARCHAR(100) NOT NULL,
+            applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+    """)
+
+def applied_versions(cursor):
+    ensure_migrations_table(cursor)
+    cursor.execute("SELECT version FROM schema_migrations")
+    return {row[0] for row in cursor.fetchall()}
+
+def pending_versions(cursor):
+    """Versions not applied yet. Only reads, so it is safe on request paths (creates nothing, takes no lock)."""
+    if not table_exists(cursor, "schema_migrations"):
+        return [version for version, _, _ in MIGRATIONS]
+    cursor.execute("SELECT version FROM schema_migrations")
+    applied = {row[0] for row in cursor.fetchall()}
+    return [version for version, _, _ in MIGRATIONS if version not in applied]
+
+def migrate(connection, target=LATEST_VERSION, batch_size=DB_MIGRATION_BATCH_SIZE):
+    """
+    Apply every pending migration up to `target`, in order. Returns the versions applied.
+    Run as a deploy step (`python -m database.migrations migrate`), never from request paths: some
+    migrations rewrite the whole table. An advisory lock makes concurrent runs wait for one another.
+    """
+    cursor = connection.cursor()
+    if not table_exists(cursor, "messages"):
+        logging.info("No messages table yet, nothing to migrate.")
+        return []
+    connection.commit()
+    cursor.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+    applied = []
+    try:
+        done = applied_versions(cursor)
+        connection.commit()
+        for version, name, migration in MIGRATIONS:
+            if version in done or version > target:
+                continue
+            logging.info(f"Applying migration {version} ({name})...")
+            migration(connection, batch_size)
+            cursor.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (version, name))
+            connection.commit()
+            applied.append(version)
+            logging.info(f"✅ Migration {version} ({name}) applied.")
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+        connection.commit()
+    return applied
+
+def status(connection):
+    cursor = connection.cursor()
+    applied = {}
+    if table_exists(cursor, "schema_migrations"):
+        cursor.execute("SELECT version, applied_at FROM schema_migrations")
+        applied = dict(cursor.fetchall())
+    connection.rollback()
+    return [
+        {"version": version, "name": name, "applied_at": str(applied[version]) if version in applied else None}
+        for version, name, _ in MIGRATIONS
+    ]
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Show or apply messages table migrations.")
+    parser.add_argument("command", choices=["status", "migrate"], nargs="?", default="status")
+    parser.add_argument("--target", type=int, default=LATEST_VERSION, help="stop after this version")
+    parser.add_argument("--batch-size", type=int, default=DB_MIGRATION_BATCH_SIZE)
+    args = parser.parse_args()
+
+    with get_pool().connection() as connection:
+        if args.command == "migrate":
+            applied = migrate(connection, args.target, args.batch_size)
+            print(f"Applied migrations: {applied or 'none, already up to date'}")
+        for migration in status(connection):
+            print(f"{migration['version']:>3}  {migration['name']:<22} {migration['applied_at'] or 'pending'}")
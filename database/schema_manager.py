@@ -1,53 +1,269 @@
-from .connection_pool import ConnectionPool
+from .connection_pool import get_pool
+from . import migrations
 import logging
 import os
+import io
+import csv
+import time
+import argparse
+import hashlib
+import threading
+from decimal import Decimal, InvalidOperation
+from itertools import islice
 from pathlib import Path
 import json
+from psycopg2.extras import execute_values
+
+# bulk ingestion tunables
+DB_BATCH_SIZE = int(os.getenv("DB_BATCH_SIZE", "1000"))
+DB_COMMIT_INTERVAL = int(os.getenv("DB_COMMIT_INTERVAL", "10"))  # batches per commit
+DB_INSERT_METHOD = os.getenv("DB_INSERT_METHOD", "values")  # 'values' (multi-row INSERT) or 'copy'
+
+MICROSECOND = Decimal("0.000001")
+
+MESSAGE_COLUMNS = ("msg_key", "text", "username", "ts", "team", "channel", "thread_ts", "category", "category_source")
+
+def message_key(message):
+    """
+    Deterministic identity for a Slack message: md5 of team:channel:ts, or of the text when there is no ts.
+    Used as messages.msg_key in Postgres and as the vector id in Chroma, so re-uploads upsert instead of duplicating.
+    A ts is only unique within its channel, so a message without one also keys on its text. The user isn't
+    part of it (older rows have none), and ts is written the way the NUMERIC(17, 6) column prints it.
+    Keep in sync with migrations.MESSAGE_KEY_SQL.
+    """
+    ts = message.get("ts")
+    if ts:
+        try:
+            ts = Decimal(str(ts).strip()).quantize(MICROSECOND)
+        except InvalidOperation:
+            pass
+        team, channel = message.get("team") or "", message.get("channel") or ""
+        identity = f"{team}:{channel}:{ts}" if channel else f"{team}::{ts}:{message.get('text') or ''}"
+    else:
+        identity = f"text:{message.get('text') or ''}"
+    return hashlib.md5(identity.encode("utf-8")).hexdigest()
+
+def message_row(message):
+    """
+    Column values for one message dict. Processed exports carry the Slack user id under 'user'.
+    Missing values (including '') are stored as NULL, ts and thread_ts go into NUMERIC columns.
+    """
+    return (
+        message_key(message),
+        message.get("text"),
+        message.get("username") or message.get("user") or None,
+        message.get("ts") or None,
+        message.get("team") or None,
+        message.get("channel") or None,
+        message.get("thread_ts") or None,
+        message.get("category"),
+        message.get("category_source") or None
+    )
+
+_schema_checked = False
+_schema_lock = threading.Lock()
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
 
 class SchemaManager:
     """Handles database schema creation and updates."""
 
     def __init__(self):
-        """Initialize SchemaManager with a connection from ConnectionPool."""
-        self.pool = ConnectionPool()
-        self.connection = self.pool.get_connection()
+        """Initialize SchemaManager with a connection checked out of the shared pool."""
+        self.pool = get_pool()
+        self.connection = self.pool.getconn()
         self.cursor = self.connection.cursor()
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close_connection()
+
     def create_tables(self):
         """Create all necessary tables for the Slack bot."""
         self.create_messages_table()
         self.connection.commit()
+        # the table already has the latest shape, this only records the migrations as applied
+        migrations.migrate(self.connection)
         logging.info("Database tables created successfully.")
 
     def create_messages_table(self):
-        """Create the messages table with one row per message."""
+        """Create the messages table with one row per message (the shape migrations.LATEST_VERSION produces)."""
         self.cursor.execute("""
             CREATE TABLE messages (
                 id SERIAL PRIMARY KEY,
+                msg_key VARCHAR(64) UNIQUE,
                 text VARCHAR(100000),
                 username VARCHAR(50),
-                ts VARCHAR(50),
+                ts NUMERIC(17, 6),
                 team VARCHAR(50),
-                category VARCHAR(255)
+                channel VARCHAR(100),
+                thread_ts NUMERIC(17, 6),
+                category VARCHAR(255),
+                category_source VARCHAR(20),
+                updated_at TIMESTAMPTZ NOT NULL DEFAULT clock_timestamp()
             );
+            CREATE INDEX messages_ts_idx ON messages (ts);
+            CREATE INDEX messages_category_idx ON messages (category);
+            CREATE INDEX messages_thread_idx ON messages (channel, thread_ts);
+            CREATE INDEX messages_updated_at_idx ON messages (updated_at);
         """)
 
+    def check_schema(self):
+        """
+        Raise migrations.SchemaOutdated, saying what to run, if the table is behind the code.
+        Only reads, so the caller's transaction is left as it was. Migrations themselves only run through
+        `python -m database.migrations migrate`. Once the schema is current the check is skipped for the process.
+        """
+        global _schema_checked
+        if _schema_checked:
+            return
+        with _schema_lock:
+            if _schema_checked:
+                return
+            if not migrations.table_exists(self.cursor, "messages"):
+                raise migrations.SchemaOutdated("There is no messages table yet, create it with `python -m database.schema_manager`.")
+            pending = migrations.pending_versions(self.cursor)
+            if pending:
+                raise migrations.SchemaOutdated(
+                    f"The messages table is missing migrations {pending}, "
+                    f"apply them with `python -m database.migrations migrate` and restart."
+                )
+            _schema_checked = True
+
     def delete_messages_table(self):
         """Delete the messages table."""
         self.cursor.execute("DROP TABLE IF EXISTS messages;")
 
+    def _upsert_sql(self, table, source):
+        # unchanged rows are left alone (and return nothing), so they count as skipped
+        # changed ones get a new updated_at, which is how the lexical index notices edits
+        updates = ", ".join([f"{col} = EXCLUDED.{col}" for col in MESSAGE_COLUMNS[1:]] + ["updated_at = clock_timestamp()"])
+        current = ", ".join(f"{table}.{col}" for col in MESSAGE_COLUMNS[1:])
+        incoming = ", ".join(f"EXCLUDED.{col}" for col in MESSAGE_COLUMNS[1:])
+        return f"""
+            INSERT INTO {table} ({', '.join(MESSAGE_COLUMNS)}) {source}
+            ON CONFLICT (msg_key) DO UPDATE SET {updates}
+            WHERE ({current}) IS DISTINCT FROM ({incoming})
+            RETURNING msg_key, (xmax = 0)
+        """
+
     def insert_message(self, message):
-        """Insert a message into the messages table."""
-        self.cursor.execute("""
-            INSERT INTO messages (text, username, ts, team, category)
-            VALUES (%s, %s, %s, %s, %s)
-        """, (
-            message.get("text"),
-            message.get("username"),
-            message.get("ts"),
-            message.get("team"),
-            message.get("category")
-        ))
+        """Insert (or update) a message into the messages table."""
+        self.check_schema()
+        placeholders = ", ".join(["%s"] * len(MESSAGE_COLUMNS))
+        self.cursor.execute(self._upsert_sql("messages", f"VALUES ({placeholders})"), message_row(message))
+
+    def _adopt_channelless_rows(self, rows, table):
+        """
+        Rows stored before messages kept their channel are keyed without one. When an upload brings the same
+        message (team, ts and text) with its channel, the stored row takes the channel and the new key, so the
+        upsert updates it instead of adding a second copy. Returns the keys the adopted rows had.
+        """
+        incoming = [(row[0], row[3], row[4], row[5], row[1]) for row in rows if row[3] and row[5]]
+        if not incoming:
+            return []
+        self.cursor.execute(f"""
+            WITH adopted AS (
+                SELECT DISTINCT ON (n.msg_key) m.id, m.msg_key AS old_key, n.msg_key, n.channel
+                FROM unnest(%s::text[], %s::numeric[], %s::text[], %s::text[], %s::text[])
+                    AS n(msg_key, ts, team, channel, text)
+                JOIN {table} m ON m.ts = n.ts AND m.channel IS NULL
+                    AND coalesce(m.team, '') = coalesce(n.team, '') AND m.text IS NOT DISTINCT FROM n.text
+                WHERE NOT EXISTS (SELECT 1 FROM {table} e WHERE e.msg_key = n.msg_key)
+                ORDER BY n.msg_key, m.id DESC
+            )
+            UPDATE {table} m SET msg_key = adopted.msg_key, channel = adopted.channel, updated_at = clock_timestamp()
+            FROM adopted WHERE m.id = adopted.id
+            RETURNING adopted.old_key
+        """, [list(column) for column in zip(*incoming)])
+        return [key for key, in self.cursor.fetchall()]
+
+    def _upsert_batch(self, rows, table, method):
+        """Upsert one batch of rows, returns (msg_key, inserted) for every row written (inserted False = updated)."""
+        if method == "copy":
+            # COPY can't resolve conflicts itself, so load a staging table and upsert from it
+            # same column types as the target, so the upsert below needs no casts
+            self.cursor.execute(f"""
+                CREATE TEMP TABLE IF NOT EXISTS {table}_staging AS
+                SELECT {', '.join(MESSAGE_COLUMNS)} FROM {table} WITH NO DATA
+            """)
+            self.cursor.execute(f"TRUNCATE {table}_staging")
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            for row in rows:
+                # CSV has no NULL by default, \\N marks it
+                writer.writerow(["\\N" if value is None else value for value in row])
+            buffer.seek(0)
+            self.cursor.copy_expert(
+                f"COPY {table}_staging ({', '.join(MESSAGE_COLUMNS)}) FROM STDIN WITH (FORMAT csv, NULL '\\N')",
+                buffer
+            )
+            self.cursor.execute(self._upsert_sql(table, f"SELECT {', '.join(MESSAGE_COLUMNS)} FROM {table}_staging"))
+            return self.cursor.fetchall()
+
+        returned = execute_values(
+            self.cursor,
+            self._upsert_sql(table, "VALUES %s"),
+            rows,
+            page_size=len(rows),
+            fetch=True
+        )
+        return returned
+
+    def insert_messages(self, messages, batch_size=DB_BATCH_SIZE, commit_interval=DB_COMMIT_INTERVAL,
+                        method=DB_INSERT_METHOD, table="messages", inserted_keys=None, replaced_keys=None):
+        """
+        Bulk upsert an iterable of message dicts, `batch_size` rows per round trip, keyed on msg_key.
+        Each batch runs under a savepoint so a bad batch is reported and skipped without aborting the rest,
+        and the transaction is committed every `commit_interval` batches (and at the end).
+        Returns a summary with inserted/updated/skipped/failed counts, per-batch errors and rows/sec.
+        If `inserted_keys` is a list, the msg_key of every newly inserted row is appended to it as batches complete.
+        If `replaced_keys` is a list, it gets the old msg_key of every channel-less row an upload moved onto its
+        channel key (the Chroma vector stored under it is a stale copy).
+        """
+        self.check_schema()
+        summary = {"inserted": 0, "updated": 0, "skipped": 0, "failed": 0, "batches": 0, "errors": []}
+        start = time.perf_counter()
+
+        for index, batch in enumerate(batched(messages, batch_size)):
+            # a key may only be touched once per statement, the last copy in the batch wins
+            rows = list({row[0]: row for row in map(message_row, batch)}.values())
+            self.cursor.execute("SAVEPOINT bulk_batch")
+            try:
+                adopted = self._adopt_channelless_rows(rows, table)
+                results = self._upsert_batch(rows, table, method)
+                self.cursor.execute("RELEASE SAVEPOINT bulk_batch")
+                inserted = sum(1 for _, is_new in results if is_new)
+                if inserted_keys is not None:
+                    inserted_keys.extend(key for key, is_new in results if is_new)
+                if replaced_keys is not None:
+                    replaced_keys.extend(adopted)
+                summary["inserted"] += inserted
+                summary["updated"] += len(results) - inserted
+                summary["skipped"] += len(batch) - len(results)
+            except Exception as e:
+                self.cursor.execute("ROLLBACK TO SAVEPOINT bulk_batch")
+                summary["failed"] += len(batch)
+                summary["errors"].append({"batch": index, "rows": len(batch), "error": f"{type(e).__name__}: {e}"})
+                logging.error(f"Batch {index} ({len(batch)} rows) failed: {e}")
+            summary["batches"] += 1
+
+            if commit_interval and summary["batches"] % commit_interval == 0:
+                self.connection.commit()
+
+        self.connection.commit()
+        written = summary["inserted"] + summary["updated"] + summary["skipped"]
+        summary["seconds"] = round(time.perf_counter() - start, 3)
+        summary["rows_per_sec"] = round(written / summary["seconds"], 1) if summary["seconds"] else None
+        logging.info(f"Bulk upsert ({method}): {summary['inserted']} inserted, {summary['updated']} updated, "
+                     f"{summary['skipped']} unchanged in {summary['seconds']}s ({summary['rows_per_sec']} rows/sec), "
+                     f"{summary['failed']} failed")
+        return summary
 
     def process_channel_data(self, channel_data):
         """
@@ -58,61 +274,118 @@ class SchemaManager:
             logging.error("Expected channel_data to be a list.")
             return
 
-        for message in channel_data:
-            self.insert_message(message)
+        return self.insert_messages(channel_data)
 
     def add_jsons(self, channel_threads_directory: Path):
         """
-        Process JSON files from the directory and insert the data into the database.
-        Each JSON file is expected to contain a list of message objects.
+        Process record files (JSONL, Parquet or the older JSON arrays) from the directory and insert the data
+        into the database. Files are streamed into the bulk upsert, so none is ever loaded whole.
         """
+        from JSON_processing.records import iter_records, record_files
+
         if not channel_threads_directory.exists():
             logging.error(f"Directory {channel_threads_directory} does not exist.")
             return
 
-        for json_file in os.listdir(channel_threads_directory):
-            if json_file.endswith(".json"):
-                file_path = channel_threads_directory / json_file
-                with open(file_path, 'r') as f:
-                    try:
-                        channel_data = json.load(f)
-                        self.process_channel_data(channel_data)
-                    except json.JSONDecodeError as e:
-                        logging.error(f"Error decoding JSON from {file_path}: {e}")
-                    except Exception as e:
-                        logging.error(f"Error processing file {file_path}: {e}")
+        inserted, start = 0, time.perf_counter()
+        for file_path in record_files(channel_threads_directory):
+            try:
+                summary = self.insert_messages(iter_records(file_path))
+                inserted += summary["inserted"]
+            except json.JSONDecodeError as e:
+                logging.error(f"Error decoding JSON from {file_path}: {e}")
+            except Exception as e:
+                logging.error(f"Error processing file {file_path}: {e}")
 
         self.connection.commit()
-        logging.info("✅ Message data inserted into the database.")
+        elapsed = time.perf_counter() - start
+        logging.info(f"✅ Message data inserted into the database: {inserted} rows in {elapsed:.1f}s "
+                     f"({inserted / elapsed if elapsed else 0:.0f} rows/sec).")
 
     def close_connection(self):
-        """Release the database connection back to the pool."""
+        """Release the database connection back to the pool (uncommitted work is rolled back)."""
+        if self.connection is None:
+            return
         self.cursor.close()
-        self.connection.close()
-        logging.info("🔌 Database connection closed.")
+        self.pool.putconn(self.connection)
+        self.connection = None
+        logging.info("🔌 Database connection returned to the pool.")
 
     #to be used for frontend - get the first and last timestamps
     def get_timerange(self):
-        self.cursor.execute("SELECT MAX(ts) FROM messages")
-        latest_ts = self.cursor.fetchone()[0]
-        self.cursor.execute("SELECT MIN(ts) FROM messages")
-        earliest_ts = self.cursor.fetchone()[0]
+        # both ends are read off messages_ts_idx
+        self.check_schema()
+        self.cursor.execute("SELECT MIN(ts), MAX(ts) FROM messages")
+        earliest_ts, latest_ts = self.cursor.fetchone()
         return (earliest_ts, latest_ts)
     
      #params in unix timestamps
     def delete_messages(self, delete_from, delete_to):
+        self.check_schema()
         self.cursor.execute(
-            "DELETE FROM messages WHERE ts >= %s AND ts <= %s RETURNING *",
+            "DELETE FROM messages WHERE ts BETWEEN %s AND %s",
             (delete_from, delete_to))
         return self.cursor.rowcount
     
+    def delete_messages_by_keys(self, keys, batch_size=DB_BATCH_SIZE):
+        """Delete messages by msg_key (used to undo an upload that only reached one store)."""
+        deleted = 0
+        for batch in batched(keys, batch_size):
+            self.cursor.execute("DELETE FROM messages WHERE msg_key = ANY(%s)", (batch,))
+            deleted += self.cursor.rowcount
+        return deleted
+
     def get_usage(self):
         self.cursor.execute("SELECT pg_size_pretty(pg_relation_size('messages'))")
         return self.cursor.fetchone()[0]
 
+    def benchmark_inserts(self, num_rows=5000, batch_size=DB_BATCH_SIZE):
+        """
+        Compare row-by-row inserts with the bulk paths on a temporary copy of the messages table.
+        Nothing is written to the real table. Returns {method: rows/sec}.
+        """
+        messages = [
+            {"text": f"benchmark message {i}", "user": "U000", "ts": f"{1700000000 + i}.000100", "team": "T000", "category": "Other"}
+            for i in range(num_rows)
+        ]
+        self.check_schema()
+        self.cursor.execute("CREATE TEMP TABLE messages_benchmark (LIKE messages INCLUDING ALL)")
+        results = {}
+        try:
+            start = time.perf_counter()
+            for message in messages:
+                self.cursor.execute(
+                    f"INSERT INTO messages_benchmark ({', '.join(MESSAGE_COLUMNS)}) "
+                    f"VALUES ({', '.join(['%s'] * len(MESSAGE_COLUMNS))})",
+                    message_row(message)
+                )
+            self.connection.commit()
+            results["row_by_row"] = round(num_rows / (time.perf_counter() - start), 1)
+
+            for method in ("values", "copy"):
+                self.cursor.execute("TRUNCATE messages_benchmark")
+                summary = self.insert_messages(messages, batch_size=batch_size, method=method, table="messages_benchmark")
+                results[method] = summary["rows_per_sec"]
+        finally:
+            self.cursor.execute("DROP TABLE IF EXISTS messages_benchmark")
+            self.connection.commit()
+
+        print(f"Insert throughput for {num_rows} rows (rows/sec): {results}")
+        return results
+
 # Example usage 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Rebuild the messages table from the categorized record files.")
+    parser.add_argument("--benchmark", type=int, metavar="ROWS",
+                        help="only measure insert throughput with this many synthetic rows")
+    args = parser.parse_args()
+    if args.benchmark:
+        schema_manager = SchemaManager()
+        schema_manager.benchmark_inserts(args.benchmark)
+        schema_manager.close_connection()
+        raise SystemExit(0)
+
     # Get the directory where this file (schema_manager.py) is located
     current_dir = Path(__file__).parent
 
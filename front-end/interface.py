@@ -7,6 +7,7 @@ import sys
 import os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from LangGraph.update_workflow import invoke_update
+from LangGraph import resources, metrics
 from datetime import datetime #get class from module - used to convert timsestamps
 from database.schema_manager import SchemaManager
 
@@ -14,17 +15,19 @@ app = Flask(__name__)
 # CORS(app)
 CORS(app, resources={r"/api/*": {"origins": "http://localhost:3000"}})
 
+# Prometheus scrape endpoint
+app.add_url_rule('/metrics', 'metrics', metrics.flask_metrics_view, methods=['GET'])
+
 # get information regarding state of database
 @app.route('/api/db', methods=['GET']) 
 def get_db_state():
     db_state = {}
  
     # fetch time range of first + last upload + convert from ts to utc
-    schema_manager = SchemaManager()
-    usage = schema_manager.get_usage()
-    db_state["usage"] = usage
-    first_date, last_date = schema_manager.get_timerange()
-    schema_manager.close_connection()
+    with SchemaManager() as schema_manager:  # connection comes from (and goes back to) the shared pool
+        usage = schema_manager.get_usage()
+        db_state["usage"] = usage
+        first_date, last_date = schema_manager.get_timerange()
     if not first_date or not last_date:
         return jsonify({"error": "No data found in database"}), 404
     first_dt = datetime.fromtimestamp(int(float(first_date)))
@@ -177,4 +180,7 @@ def update_staff_list():
         return jsonify({"error": str(e)}), 500
 
 if __name__ == '__main__':
+    # nothing is warmed up by default: GET /api/db only needs Postgres, uploads load the embedding model on demand
+    resources.warm_up(*[r for r in os.getenv("WARM_UP_RESOURCES", "").split(",") if r])
+    resources.startup_report("interface")
     app.run(debug=True)
\ No newline at end of file
@@ -1,12 +1,21 @@
 import slack
 import os
 import json
+import atexit
+import signal
+import sys
+import threading
+import time
+from collections import OrderedDict
 from pathlib import Path
 from flask import Flask
 from slackeventsapi import SlackEventAdapter
 from slack_sdk import WebClient
+from slack_sdk.errors import SlackApiError
 from dotenv import load_dotenv
-from LangGraph.query_workflow import QueryState, rag_bot, invoke_question
+from LangGraph.query_workflow import QueryState, rag_bot, invoke_question, invoke_question_streaming
+from LangGraph import resources, metrics
+from slackbot.worker_pool import EventWorkerPool
 
 #load env vars
 env_path = Path('.') / '.env'
@@ -16,10 +25,37 @@ load_dotenv(dotenv_path=env_path)
 app = Flask(__name__)
 slack_events_adapter = SlackEventAdapter(os.environ["SLACK_SIGNING_SECRET"], "/slack/events", app)
 client = WebClient(token=os.environ["SLACK_TOKEN"])
-BOT_ID = client.api_call("auth.test")["user_id"]
+
+# resolved on first use instead of calling auth.test at import time
+resources.register("bot_id", lambda: client.api_call("auth.test")["user_id"])
+
+def get_bot_id():
+    return resources.get("bot_id")
+
+# loaded before serving so the first Slack message doesn't pay for model/client start-up
+WARM_UP_RESOURCES = [r for r in os.getenv("WARM_UP_RESOURCES", "bot_id,llm,embedding_model,collection,lexical_index").split(",") if r]
 
 # path to escalation schema file
 ESCALATION_FILE = os.path.join(os.path.dirname(__file__), "escalation.json")
+escalation_lock = threading.Lock()  # workers run concurrently, keep the round-robin index consistent
+
+# events are acked right away and processed here so Slack's 3s deadline is never missed
+SLACK_WORKER_COUNT = int(os.getenv("SLACK_WORKER_COUNT", "4"))
+SLACK_QUEUE_SIZE = int(os.getenv("SLACK_QUEUE_SIZE", "100"))
+SLACK_SHUTDOWN_TIMEOUT = float(os.getenv("SLACK_SHUTDOWN_TIMEOUT", "30"))
+worker_pool = EventWorkerPool(num_workers=SLACK_WORKER_COUNT, max_queue_size=SLACK_QUEUE_SIZE)
+atexit.register(worker_pool.shutdown, SLACK_SHUTDOWN_TIMEOUT)
+metrics.register_collector(lambda: {f"slack_worker_{k}": v for k, v in worker_pool.stats().items()})
+
+# stream answers into a placeholder reply instead of waiting for the full completion
+SLACK_STREAM_RESPONSES = os.getenv("SLACK_STREAM_RESPONSES", "true").lower() == "true"
+# chat.update is rate limited (tier 3, ~50/min), so edits to one message are spaced out
+SLACK_UPDATE_INTERVAL = float(os.getenv("SLACK_UPDATE_INTERVAL", "1.0"))
+SLACK_FINAL_UPDATE_ATTEMPTS = int(os.getenv("SLACK_FINAL_UPDATE_ATTEMPTS", "4"))
+STREAMING_PLACEHOLDER = "_Thinking..._"
+# what the placeholder becomes if the answer fails before any of it arrived
+STREAM_ERROR_MESSAGE = "Sorry, I ran into a problem answering this. Please try again in a bit."
+STREAM_CUT_OFF_NOTE = "\n\n_(This answer was cut off by an error.)_"
 
 # utility functions
 def load_escalation_data():
@@ -32,15 +68,90 @@ def update_escalation_data(data): # do we need this ..
 
 # ------- core logic ----------
 
+def add_feedback_reactions(channel_id, bot_ts):
+    client.reactions_add(channel=channel_id, name="smile", timestamp=bot_ts)
+    client.reactions_add(channel=channel_id, name="sob", timestamp=bot_ts)
+
+def retry_after(error, default):
+    """Seconds Slack asked us to wait in a rate limited response (its Retry-After header), else `default`."""
+    headers = getattr(error.response, "headers", None) or {}
+    value = next((v for k, v in headers.items() if k.lower() == "retry-after"), None)
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+# an edit that has to land (the final text), waiting out rate limits up to SLACK_FINAL_UPDATE_ATTEMPTS times
+def update_reply(channel_id, bot_ts, text):
+    for attempt in range(SLACK_FINAL_UPDATE_ATTEMPTS):
+        try:
+            return client.chat_update(channel=channel_id, ts=bot_ts, text=text)
+        except SlackApiError as e:
+            if e.response.get("error") != "ratelimited" or attempt + 1 == SLACK_FINAL_UPDATE_ATTEMPTS:
+                raise
+            delay = retry_after(e, SLACK_UPDATE_INTERVAL * 2 ** attempt)
+            print(f"⚠️ chat_update rate limited, retrying the final edit in {delay:.1f}s")
+            time.sleep(delay)
+
+# post a placeholder in the thread and keep editing it as chunks arrive, returns the reply ts
+# (None if the answer failed: the placeholder then shows what had arrived, or an error message)
+def stream_reply(channel_id, thread_ts, chunks, started_at):
+    reply = client.chat_postMessage(channel=channel_id, text=STREAMING_PLACEHOLDER, thread_ts=thread_ts)
+    bot_ts = reply['ts']
+
+    text = ""
+    interval = SLACK_UPDATE_INTERVAL
+    last_update = None
+    first_token_at = None
+    updates = 0
+
+    try:
+        for chunk in chunks:
+            text += chunk
+            now = time.monotonic()
+            # the first real text goes out right away, after that every edit (sent or rate limited) is throttled
+            if last_update is not None and now - last_update < interval:
+                continue
+            last_update = now
+            try:
+                client.chat_update(channel=channel_id, ts=bot_ts, text=text + " ...")
+            except SlackApiError as e:
+                if e.response.get("error") != "ratelimited":
+                    raise
+                # back off (at least as long as Slack asks) and let the final update carry the text
+                interval = max(interval * 2, retry_after(e, 0))
+                print(f"⚠️ chat_update rate limited, update interval now {interval:.1f}s")
+                continue
+            updates += 1
+            if first_token_at is None:
+                first_token_at = now
+                print(f"  ➤ Time to first visible token: {first_token_at - started_at:.2f}s")
+
+        # final edit drops the "..." marker and always lands, even if the last chunks were throttled
+        update_reply(channel_id, bot_ts, text)
+    except Exception as e:
+        print(f"[Stream Error]: {type(e).__name__} - {e} after {len(text)} characters")
+        metrics.inc("slack_stream_errors_total")
+        try:
+            update_reply(channel_id, bot_ts, text + STREAM_CUT_OFF_NOTE if text.strip() else STREAM_ERROR_MESSAGE)
+        except SlackApiError as update_error:
+            print(f"[Stream Error]: could not replace the placeholder: {update_error.response.get('error')}")
+        return None
+
+    print(f"  ➤ Streamed reply in {time.monotonic() - started_at:.2f}s with {updates + 1} update(s)")
+    return bot_ts
+
 # using QueryState + rag_bot to classify the question
 # If it's a valid question (i.e., has a response), respond and react to the message.
 def classify_and_respond_to_message(channel_id, text, thread_ts):
-    result = invoke_question(text)
+    started_at = time.monotonic()
+    result = invoke_question_streaming(text) if SLACK_STREAM_RESPONSES else invoke_question(text)
     print("🔍 classify_and_respond_to_message():")
     print("  ➤ Question:", text)
     print("  ➤ Should respond?", result.get("should_respond"))
     print("  ➤ Response:", result.get("response"))
     print("  ➤ Category (for escalation):", result.get("category"))
+    print("  ➤ Stage timings:", result.get("timings"))
 
     if not result.get("should_respond"):
         return None, None
@@ -48,6 +159,14 @@ def classify_and_respond_to_message(channel_id, text, thread_ts):
     category = result.get("category")
     response = result.get("response")
 
+    if result.get("stream") is not None:
+        bot_ts = stream_reply(channel_id, thread_ts, result["stream"], started_at)
+        if bot_ts is None:
+            return None, None  # no feedback or escalation on a failed answer
+        # reactions go on once the final text is in place
+        add_feedback_reactions(channel_id, bot_ts)
+        return bot_ts, category
+
     if response:
         reply = client.chat_postMessage(
             channel=channel_id,
@@ -55,31 +174,20 @@ def classify_and_respond_to_message(channel_id, text, thread_ts):
             thread_ts=thread_ts
         )
         bot_ts = reply['ts']
+        print(f"  ➤ Time to first visible token: {time.monotonic() - started_at:.2f}s")
 
-        client.reactions_add(channel=channel_id, name="smile", timestamp=bot_ts)
-        client.reactions_add(channel=channel_id, name="sob", timestamp=bot_ts)
+        add_feedback_reactions(channel_id, bot_ts)
 
         return bot_ts, category
 
     return None, None
 
-# escalate a message to the appropriate member based on category.
-def escalate_issue(channel_id, message_ts, category):
-    print("🚨 Escalating issue...")
-    print("  ➤ Using category:", category)
-
+# pick the next member for a category and persist the rotation (None if the category is unknown)
+def rotate_escalation_member(category):
     escalation_data = load_escalation_data()
     schema = escalation_data.get("escalation_schema", {})
-
     if category not in schema:
-        # DO NOT ACTUALLY SEND THIS TO SLACK LATER, LEAVING FOR DEBUGGING ATM
-        print(f"  ❌ Category '{category}' not found in escalation schema.")
-        client.chat_postMessage(
-            channel=channel_id,
-            text=f"Could not find escalation category for *{category}*.",
-            thread_ts=message_ts
-        )
-        return
+        return None
 
     category_data = schema[category]
     members = category_data["member_ids"]
@@ -92,6 +200,25 @@ def escalate_issue(channel_id, message_ts, category):
     # rotating to next member (not terribly sure)
     category_data["last_assigned_index"] = next_index
     update_escalation_data(escalation_data)
+    return assigned_member
+
+# escalate a message to the appropriate member based on category.
+def escalate_issue(channel_id, message_ts, category):
+    print("🚨 Escalating issue...")
+    print("  ➤ Using category:", category)
+
+    with escalation_lock:
+        assigned_member = rotate_escalation_member(category)
+
+    if assigned_member is None:
+        # DO NOT ACTUALLY SEND THIS TO SLACK LATER, LEAVING FOR DEBUGGING ATM
+        print(f"  ❌ Category '{category}' not found in escalation schema.")
+        client.chat_postMessage(
+            channel=channel_id,
+            text=f"Could not find escalation category for *{category}*.",
+            thread_ts=message_ts
+        )
+        return
 
     # ping the assigned member based on escalation json
     client.chat_postMessage(
@@ -104,6 +231,47 @@ def escalate_issue(channel_id, message_ts, category):
 # tracking messages and bot replies for escalation mapping
 bot_message_map = {}  # {bot_ts: category}
 
+# Slack redelivers events it thinks we missed, remember recent event ids so each one is handled once
+MAX_SEEN_EVENTS = 1000
+seen_events = OrderedDict()
+seen_events_lock = threading.Lock()
+
+class WorkerQueueFull(RuntimeError):
+    """Raised out of an event handler so the adapter answers with an error and Slack redelivers the event."""
+
+def is_duplicate_event(event_id):
+    """Claims the event id, True if it was already claimed. release_event gives it back."""
+    if not event_id:
+        return False
+    with seen_events_lock:
+        if event_id in seen_events:
+            return True
+        seen_events[event_id] = True
+        if len(seen_events) > MAX_SEEN_EVENTS:
+            seen_events.popitem(last=False)
+    return False
+
+def release_event(event_id):
+    with seen_events_lock:
+        seen_events.pop(event_id, None)
+
+def submit_event(event_id, fn, *args):
+    """
+    Queue an event's work. If the pool turns it away (queue full, shutting down) the event id is released
+    and WorkerQueueFull is raised, so the event isn't acked: Slack retries it and the retry is processed.
+    """
+    if worker_pool.submit(fn, *args):
+        return
+    release_event(event_id)
+    metrics.inc("slack_events_dropped_total", handler=getattr(fn, "__name__", str(fn)))
+    print(f"⚠️ Event {event_id} not queued ({worker_pool.stats()['queue_depth']} waiting), asking Slack to redeliver it")
+    raise WorkerQueueFull(f"worker queue full, event {event_id} not accepted")
+
+def process_message(channel_id, text, thread_ts):
+    bot_ts, category = classify_and_respond_to_message(channel_id, text, thread_ts)
+    if bot_ts and category:
+        bot_message_map[bot_ts] = category  # store for escalation YOOOO CHECK THIS LOGIC
+
 @slack_events_adapter.on("message")
 def handle_message(payload):
     event = payload.get("event", {})
@@ -112,12 +280,14 @@ def handle_message(payload):
     thread_ts = event.get("ts")
 
     # only respond to user messages (not bots so we don't categorize our own bot's replies)
-    if event.get("subtype") == "bot_message" or user == BOT_ID or user is None:
+    if event.get("subtype") == "bot_message" or user == get_bot_id() or user is None:
         return
 
-    bot_ts, category = classify_and_respond_to_message(event["channel"], text, thread_ts)
-    if bot_ts and category:
-        bot_message_map[bot_ts] = category  # store for escalation YOOOO CHECK THIS LOGIC
+    if is_duplicate_event(payload.get("event_id")):
+        return
+
+    # hand off to the worker pool so the adapter can ack immediately
+    submit_event(payload.get("event_id"), process_message, event["channel"], text, thread_ts)
 
 
 @slack_events_adapter.on("reaction_added")
@@ -130,13 +300,13 @@ def handle_reaction(payload):
     message_ts = item.get("ts")
 
     # ignore bot's own reactions
-    if user == BOT_ID or reaction != "sob":
+    if user == get_bot_id() or reaction != "sob":
         return
 
     # if this reaction is on a bot message that we replied with, escalate
-    if message_ts in bot_message_map:
-        category = bot_message_map[message_ts]
-        escalate_issue(channel_id, message_ts, category)
+    if message_ts not in bot_message_map or is_duplicate_event(payload.get("event_id")):
+        return
+    submit_event(payload.get("event_id"), escalate_issue, channel_id, message_ts, bot_message_map[message_ts])
 #
 # current_question_text = None
 # current_category = None
@@ -237,10 +407,18 @@ def handle_reaction(payload):
 #     )
 
         
+# Prometheus scrape endpoint
+app.add_url_rule('/metrics', 'metrics', metrics.flask_metrics_view, methods=['GET'])
+
 @app.route('/help', methods=['POST']) #command for intro for the slack bot
 def help():
     return "This is RTC's Slack bot. You can ask me anything and I will try to help you."
 
 
 if __name__ == "__main__":
-    app.run(debug=True, host='0.0.0.0', port=3000)
\ No newline at end of file
+    resources.warm_up(*WARM_UP_RESOURCES)
+    resources.startup_report("slackbot")
+    # turn SIGTERM into a normal exit so atexit drains the worker pool
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    # threaded so concurrent Slack deliveries aren't serialized behind one request thread
+    app.run(debug=True, host='0.0.0.0', port=3000, threaded=True)
\ No newline at end of file
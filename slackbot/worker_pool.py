@@ -0,0 +1,105 @@
+import queue
+import threading
+import time
+
+
+class EventWorkerPool:
+    """
+    Bounded pool of worker threads that process Slack events off the request thread.
+    Slack only needs a 200 within 3 seconds, so handlers enqueue work here and return immediately.
+    """
+
+    def __init__(self, num_workers=4, max_queue_size=100, name="slack-worker"):
+        self.num_workers = num_workers
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._shutting_down = threading.Event()
+        self._workers = []
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+        self.in_flight = 0
+
+        for i in range(num_workers):
+            worker = threading.Thread(target=self._run, name=f"{name}-{i}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Queue `fn(*args, **kwargs)` for a worker. Returns False (and drops the job) when the queue is full
+        or the pool is shutting down, so callers can shed load instead of blocking Slack's request.
+        """
+        if self._shutting_down.is_set():
+            with self._lock:
+                self.rejected += 1
+            return False
+        try:
+            self._queue.put_nowait((fn, args, kwargs, time.monotonic()))
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            print(f"⚠️ Worker queue full ({self._queue.maxsize}); dropping {getattr(fn, '__name__', fn)}")
+            return False
+        with self._lock:
+            self.submitted += 1
+        return True
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:  # shutdown sentinel
+                self._queue.task_done()
+                return
+            fn, args, kwargs, enqueued_at = job
+            with self._lock:
+                self.in_flight += 1
+            try:
+                fn(*args, **kwargs)
+                with self._lock:
+                    self.completed += 1
+            except Exception as e:
+                with self._lock:
+                    self.failed += 1
+                print(f"[Worker Error] {getattr(fn, '__name__', fn)} failed after "
+                      f"{time.monotonic() - enqueued_at:.2f}s: {type(e).__name__} - {e}")
+            finally:
+                with self._lock:
+                    self.in_flight -= 1
+                self._queue.task_done()
+
+    def shutdown(self, timeout=30.0):
+        """Stop accepting work, let queued + in-flight jobs finish, then stop the workers."""
+        if self._shutting_down.is_set():
+            return
+        self._shutting_down.set()
+        print(f"Draining worker pool ({self._queue.qsize()} queued, {self.in_flight} in flight)...")
+
+        # sentinels queue up behind any pending work, so everything already accepted still runs
+        deadline = time.monotonic() + timeout
+        for _ in self._workers:
+            remaining = max(0.0, deadline - time.monotonic())
+            try:
+                self._queue.put(None, timeout=remaining)
+            except queue.Full:
+                break
+        for worker in self._workers:
+            worker.join(timeout=max(0.0, deadline - time.monotonic()))
+
+        alive = sum(worker.is_alive() for worker in self._workers)
+        if alive:
+            print(f"⚠️ Worker pool shutdown timed out with {alive} worker(s) still busy.")
+        else:
+            print("✅ Worker pool drained.")
+
+    def stats(self):
+        return {
+            "workers": self.num_workers,
+            "queue_depth": self._queue.qsize(),
+            "in_flight": self.in_flight,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+        }